@@ -1,113 +1,244 @@
-# backtest.py
-from datetime import datetime
-import backtrader as bt
-from strategy import EMAStochMACDRSI
-import telegram_bot as td
-import math
-import pandas as pd
-from database import fetch_data_from_db
-
-
-class PositionAwareSizer(bt.Sizer):
-    params = (
-        ('percent', 25), 
-        ('max_positions', None),
-    )
-
-    def _getsizing(self, comminfo, cash, data, isbuy):
-        # Получаем позицию через брокера, а не через стратегию
-        position = self.broker.getposition(data)
-        current_size = position.size if position else 0
-        
-        # Рассчитываем желаемый размер
-        price = data.close[0]
-        if price == 0:
-            return 0
-        desired_size = (cash * self.p.percent / 100) / price
-        
-        # Корректируем размер с учетом лимита
-        available_size = self.p.max_positions - current_size if isbuy else self.p.max_positions + current_size
-        size = min(desired_size, available_size)
-        
-        return math.floor(size) if math.floor(size) > 0 else 1 if available_size > 0 else 0
-
-# Колличество денег для совершения сделок
-cash = 150000
-
-
-def run_backtest(fast_ema_period, slow_ema_period, stoch_period, rsi_period, stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold, plot=False):
-    cerebro = bt.Cerebro()
-    if plot:
-        cerebro.addstrategy(EMAStochMACDRSI,
-                        fast_ema_period=fast_ema_period,
-                        slow_ema_period=slow_ema_period,
-                        stoch_period=stoch_period,
-                        rsi_period=rsi_period,
-                        stoch_overbought=stoch_overbought,
-                        stoch_oversold=stoch_oversold,
-                        rsi_overbought=rsi_overbought,
-                        rsi_oversold=rsi_oversold, is_final_run=True)
-    else:
-        cerebro.addstrategy(EMAStochMACDRSI,
-                        fast_ema_period=fast_ema_period,
-                        slow_ema_period=slow_ema_period,
-                        stoch_period=stoch_period,
-                        rsi_period=rsi_period,
-                        stoch_overbought=stoch_overbought,
-                        stoch_oversold=stoch_oversold,
-                        rsi_overbought=rsi_overbought,
-                        rsi_oversold=rsi_oversold)
-
-     # Загрузка данных из базы данных
-    data = fetch_data_from_db()
-    
-    # Преобразуем данные в формат, понятный Backtrader
-    data_feed = bt.feeds.PandasData(
-        dataname=pd.DataFrame(data, columns=['DateTime', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOL>']),
-        datetime='DateTime',
-        open='<OPEN>',
-        high='<HIGH>',
-        low='<LOW>',
-        close='<CLOSE>',
-        volume='<VOL>',
-    )
-    
-    cerebro.adddata(data_feed)
-    cerebro.broker.setcash(cash)
-    cerebro.addsizer(
-        PositionAwareSizer, 
-        percent=25, 
-        max_positions=10  # Берём значение из стратегии
-    )
-    cerebro.broker.setcommission(commission=0.0005)
-
-    try:
-        results = cerebro.run()
-        strat = results[0]
-    except ZeroDivisionError:
-        print("Ошибка: Деление на ноль в индикаторе.")
-        return 0, 0
-
-    broker_final_value = cerebro.broker.getvalue()
-    td.update_balance(broker_final_value)
-    total_profit = broker_final_value - cash
-
-    trades_count = strat.total_trades
-    profitable_trades = strat.profitable_trades
-
-    profitable_trades_percentage = (profitable_trades / trades_count) * 100 if trades_count > 0 else 0
-
-    if plot:
-        print("Лучшие параметры:", (fast_ema_period, slow_ema_period, stoch_period, rsi_period, stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold))
-        print("Максимальная доходность:", total_profit)
-        print("Количество прибыльных сделок в %:", profitable_trades_percentage)
-        print(f'Общее количество сделок: {trades_count}')
-        td.get_balance()
-        cerebro.plot(style='candle', 
-                barup='green', 
-                bardown='red',
-                volume=False,  # Отключаем объемы для чистоты графика
-                locnum=True)  
-        cerebro.plot(style='line')
-        
+# backtest.py
+from datetime import datetime
+import backtrader as bt
+from strategy import EMAStochMACDRSI
+import telegram_bot as td
+import math
+import numpy as np
+import pandas as pd
+from database import DEFAULT_SYMBOL, DEFAULT_TIMEFRAME, load_bars
+from vector_backtest import run_vector_backtest, run_vector_backtest_batch, BacktestPruned, \
+    BATCH_ZERO_DIVISION, BATCH_PRUNED
+from indicator_store import get_indicator_store
+from recorder import TradeRecorder
+from report import REPORT_MAX_BARS, submit_report
+
+
+class PositionAwareSizer(bt.Sizer):
+    params = (
+        ('percent', 25), 
+        ('max_positions', None),
+    )
+
+    def _getsizing(self, comminfo, cash, data, isbuy):
+        # Получаем позицию через брокера, а не через стратегию
+        position = self.broker.getposition(data)
+        current_size = position.size if position else 0
+        
+        # Рассчитываем желаемый размер
+        price = data.close[0]
+        if price == 0:
+            return 0
+        desired_size = (cash * self.p.percent / 100) / price
+        
+        # Корректируем размер с учетом лимита
+        available_size = self.p.max_positions - current_size if isbuy else self.p.max_positions + current_size
+        size = min(desired_size, available_size)
+        
+        return math.floor(size) if math.floor(size) > 0 else 1 if available_size > 0 else 0
+
+# Колличество денег для совершения сделок
+cash = 150000
+
+
+# Комиссия брокера и параметры сайзера, общие для обоих движков бэктеста
+commission = 0.0005
+sizer_percent = 25
+sizer_max_positions = 10
+
+
+def pruned_result(value):
+    """Результат досрочно остановленного бэктеста: доходность на момент остановки
+    и нулевой процент прибыльных сделок как штраф."""
+    return value - cash, 0
+
+def run_numpy_backtest(params, data=None, bar_store=None, prune=None, symbol=DEFAULT_SYMBOL,
+                       timeframe=DEFAULT_TIMEFRAME):
+    """Расчет доходности и процента прибыльных сделок векторным движком без backtrader."""
+    if data is None:
+        data = load_bars(bar_store, symbol, timeframe)
+
+    try:
+        broker_final_value, trades_count, profitable_trades = run_vector_backtest(
+            *params, store=get_indicator_store(data), cash=cash, commission=commission,
+            percent=sizer_percent, max_positions=sizer_max_positions, prune=prune)
+    except ZeroDivisionError:
+        print("Ошибка: Деление на ноль в индикаторе.")
+        return 0, 0
+    except BacktestPruned as e:
+        return pruned_result(e.value)
+
+    td.update_balance(broker_final_value)
+    total_profit = broker_final_value - cash
+    profitable_trades_percentage = (profitable_trades / trades_count) * 100 if trades_count > 0 else 0
+    return total_profit, profitable_trades_percentage
+
+
+def run_backtest_batch(params_list, data=None, bar_store=None, prune=None, symbol=DEFAULT_SYMBOL,
+                       timeframe=DEFAULT_TIMEFRAME):
+    """Доходность и процент прибыльных сделок для многих наборов параметров за один вызов векторного движка.
+
+    params_list - матрица k x 8 (поколение ГА, сетка параметров). Возвращает массив k x 2
+    с теми же значениями, что и run_backtest(..., engine='numpy') для каждого набора.
+    symbol и timeframe - инструмент, бары которого загружаются, если data не переданы."""
+    if data is None:
+        data = load_bars(bar_store, symbol, timeframe)
+
+    results = run_vector_backtest_batch(params_list, store=get_indicator_store(data), cash=cash,
+                                        commission=commission, percent=sizer_percent,
+                                        max_positions=sizer_max_positions, prune=prune)
+    values, trades_count, profitable_trades, status = results.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profitable_trades_percentage = np.where(trades_count > 0, profitable_trades / trades_count * 100, 0.0)
+    output = np.column_stack([values - cash, profitable_trades_percentage])
+    for row in np.flatnonzero(status == BATCH_ZERO_DIVISION):
+        print("Ошибка: Деление на ноль в индикаторе.")
+        output[row] = 0, 0
+    for row in np.flatnonzero(status == BATCH_PRUNED):
+        output[row] = pruned_result(values[row])
+    return output
+
+
+def _report_done(future):
+    """Завершение фонового построения отчета: путь выводится, изображение отправляется в Telegram."""
+    try:
+        path = future.result()
+    except Exception as e:
+        print(f'Ошибка построения отчета: {e}')
+        return
+    print(f'Отчет о прогоне сохранен: {path}')
+    if path.endswith('.png'):
+        td.send_photo(path, caption='Отчет о прогоне бэктеста')
+
+
+def run_backtest(fast_ema_period, slow_ema_period, stoch_period, rsi_period, stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold, plot=False, data=None, engine='backtrader', bar_store=None, prune=None, report=None,
+                 symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Бэктест стратегии с заданными параметрами.
+
+    engine - 'backtrader' (полная симуляция с логами и графиками) или 'numpy' (быстрый
+    векторный движок для оптимизации; при plot=True всегда используется backtrader).
+    bar_store - каталог хранилища баров (database.export_bar_store), из которого данные
+    открываются через np.memmap без копирования, если data не переданы.
+    prune - правила досрочной остановки заведомо плохих прогонов (vector_backtest.PruneRules);
+    остановленный прогон получает штрафной результат pruned_result. При plot=True не применяются.
+    report - файл отчета (.png или .html) вместо графиков cerebro.plot при plot=True; отчет строится
+    в фоновом процессе (report.submit_report). Если баров больше REPORT_MAX_BARS, отчет строится
+    и без report (в report_<номер прогона>.png).
+    symbol и timeframe - инструмент, бары которого загружаются, если data не переданы; сохраняются
+    в журнале прогона, чтобы отчет строился по тем же барам."""
+    if engine == 'numpy' and not plot:
+        return run_numpy_backtest((fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+                                   stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold),
+                                  data, bar_store, prune, symbol, timeframe)
+
+     # Загрузка данных из базы данных, если они не были переданы заранее (например, воркером оптимизатора)
+    if data is None:
+        data = load_bars(bar_store, symbol, timeframe)
+
+    cerebro = bt.Cerebro()
+    recorder = None
+    if plot:
+        # Журнал финального прогона сохраняется в базу для последующей статистики
+        recorder = TradeRecorder()
+        recorder.start(params=','.join(map(str, (fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+                                                 stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold))),
+                       cash=cash, symbol=symbol, timeframe=timeframe)
+        cerebro.addstrategy(EMAStochMACDRSI,
+                        fast_ema_period=fast_ema_period,
+                        slow_ema_period=slow_ema_period,
+                        stoch_period=stoch_period,
+                        rsi_period=rsi_period,
+                        stoch_overbought=stoch_overbought,
+                        stoch_oversold=stoch_oversold,
+                        rsi_overbought=rsi_overbought,
+                        rsi_oversold=rsi_oversold, is_final_run=True, recorder=recorder)
+    else:
+        cerebro.addstrategy(EMAStochMACDRSI,
+                        fast_ema_period=fast_ema_period,
+                        slow_ema_period=slow_ema_period,
+                        stoch_period=stoch_period,
+                        rsi_period=rsi_period,
+                        stoch_overbought=stoch_overbought,
+                        stoch_oversold=stoch_oversold,
+                        rsi_overbought=rsi_overbought,
+                        rsi_oversold=rsi_oversold,
+                        prune=prune,
+                        indicator_store=get_indicator_store(data))  # Индикаторы общие для всех прогонов оптимизации
+
+    # Преобразуем данные в формат, понятный Backtrader
+    if isinstance(data, pd.DataFrame):
+        # Колоночные данные из get_bars используются без копирования
+        data_feed = bt.feeds.PandasData(
+            dataname=data,
+            datetime='date',
+            open='open_price',
+            high='high_price',
+            low='low_price',
+            close='close_price',
+            volume='volume',
+        )
+    else:
+        data_feed = bt.feeds.PandasData(
+            dataname=pd.DataFrame(data, columns=['DateTime', '<OPEN>', '<HIGH>', '<LOW>', '<CLOSE>', '<VOL>']),
+            datetime='DateTime',
+            open='<OPEN>',
+            high='<HIGH>',
+            low='<LOW>',
+            close='<CLOSE>',
+            volume='<VOL>',
+        )
+
+    cerebro.adddata(data_feed)
+    cerebro.broker.setcash(cash)
+    cerebro.addsizer(
+        PositionAwareSizer, 
+        percent=sizer_percent, 
+        max_positions=sizer_max_positions  # Берём значение из стратегии
+    )
+    cerebro.broker.setcommission(commission=commission)
+
+    try:
+        results = cerebro.run()
+        strat = results[0]
+    except ZeroDivisionError:
+        print("Ошибка: Деление на ноль в индикаторе.")
+        if recorder is not None:
+            recorder.close()
+        return 0, 0
+
+    broker_final_value = cerebro.broker.getvalue()
+    if recorder is not None:
+        recorder.close(final_value=broker_final_value, total_trades=strat.total_trades,
+                       profitable_trades=strat.profitable_trades)
+    if strat.pruned:
+        return pruned_result(broker_final_value)
+    td.update_balance(broker_final_value)
+    total_profit = broker_final_value - cash
+
+    trades_count = strat.total_trades
+    profitable_trades = strat.profitable_trades
+
+    profitable_trades_percentage = (profitable_trades / trades_count) * 100 if trades_count > 0 else 0
+
+    if plot:
+        print("Лучшие параметры:", (fast_ema_period, slow_ema_period, stoch_period, rsi_period, stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold))
+        print("Максимальная доходность:", total_profit)
+        print("Количество прибыльных сделок в %:", profitable_trades_percentage)
+        print(f'Общее количество сделок: {trades_count}')
+        print(f'Журнал прогона сохранен в базу данных, прогон {recorder.run_id}')
+        td.get_balance()
+        if report is not None or len(data) > REPORT_MAX_BARS:
+            # cerebro.plot на длинных рядах работает минутами и требует дисплей: строится отчет
+            # с прореживанием по журналу прогона, а процесс продолжает работу
+            future = submit_report(recorder.run_id, report, bar_store=bar_store, symbol=symbol, timeframe=timeframe)
+            future.add_done_callback(_report_done)
+            print('Отчет о прогоне строится в фоновом процессе')
+        else:
+            cerebro.plot(style='candle', 
+                    barup='green', 
+                    bardown='red',
+                    volume=False,  # Отключаем объемы для чистоты графика
+                    locnum=True)  
+            cerebro.plot(style='line')
+        
     return total_profit, profitable_trades_percentage
\ No newline at end of file
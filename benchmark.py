@@ -0,0 +1,265 @@
+# benchmark.py
+# Замеры производительности конвейера: загрузка данных, чтение из базы, бэктест и поколение ГА.
+# Запуск: python benchmark.py --sizes 10000 100000 1000000 --json bench.json [--profile cprofile]
+#         python benchmark.py --rows 200000 (только загрузка, как раньше)
+# Бенчмарк работает с временной базой данных и не затрагивает stocks.db, Telegram заменяется
+# заглушкой, поэтому сеть не нужна.
+import argparse
+import atexit
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Временная папка для файлов и базы бенчмарка; DATABASE_URL подменяется до импорта database
+_workdir = tempfile.mkdtemp(prefix='robot_bench_')
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(_workdir, "bench.db")}'
+
+# Заглушка telegram_bot: бэктест обновляет баланс и отправляет сообщения и отчеты без сети и токена
+_telegram_stub = types.ModuleType('telegram_bot')
+_telegram_stub.send_message = lambda text: None
+_telegram_stub.send_photo = lambda path, caption=None: None
+_telegram_stub.update_balance = lambda new_balance: None
+_telegram_stub.get_balance = lambda: ''
+sys.modules['telegram_bot'] = _telegram_stub
+
+from database import (get_session, StockData, load_data_to_db, fetch_data_from_db, fetch_bars, get_bars, fetch_ga_runs,
+                      refresh_bar_store)
+from backtest import run_backtest
+from ga_optimization import run_ga_optimization
+
+# Размеры синтетических рядов по умолчанию
+DEFAULT_SIZES = (10000, 100000, 1000000)
+# Параметры стратегии для одиночного бэктеста
+BENCH_PARAMS = (12, 26, 14, 14, 80, 20, 70, 30)
+
+
+def generate_bars(rows, seed=0):
+    """Синтетические минутные бары OHLCV в формате текстового файла data_output.txt."""
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.002, rows)))
+    open_ = np.r_[close[0], close[:-1]]
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, 0.001, rows))
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, 0.001, rows))
+    return pd.DataFrame({
+        'DATETIME': pd.date_range('2020-01-01', periods=rows, freq='min'),
+        '<OPEN>': open_,
+        '<HIGH>': high,
+        '<LOW>': low,
+        '<CLOSE>': close,
+        '<VOL>': rng.integers(1, 1000, rows),
+    })
+
+
+def write_bars_file(rows, seed=0):
+    """Запись синтетических баров во временный файл, возвращает путь к нему."""
+    path = os.path.join(_workdir, f'bars_{rows}.txt')
+    generate_bars(rows, seed).to_csv(path, sep='\t', index=False)
+    return path
+
+
+def _legacy_load(file_path):
+    """Прежняя построчная загрузка через ORM (эталон для сравнения)."""
+    session = get_session()
+    session.query(StockData).delete()
+    session.commit()
+    df = pd.read_csv(file_path, sep='\t', parse_dates=['DATETIME'])
+    for _, row in df.iterrows():
+        session.add(StockData(date=row['DATETIME'], open_price=row['<OPEN>'], high_price=row['<HIGH>'],
+                              low_price=row['<LOW>'], close_price=row['<CLOSE>'], volume=row['<VOL>']))
+    session.commit()
+    session.close()
+
+
+def _rows_per_second(func, *args, rows):
+    started = time.perf_counter()
+    func(*args)
+    return rows / (time.perf_counter() - started)
+
+
+def benchmark_load(rows, legacy=True):
+    """Сравнение скорости загрузки: построчная через ORM и пакетная load_data_to_db."""
+    path = write_bars_file(rows)
+    results = {}
+    if legacy:
+        results['legacy_rows_per_sec'] = _rows_per_second(_legacy_load, path, rows=rows)
+    results['bulk_rows_per_sec'] = _rows_per_second(load_data_to_db, path, rows=rows)
+    results['stream_rows_per_sec'] = _rows_per_second(
+        lambda p: load_data_to_db(p, chunksize=max(rows // 10, 1)), path, rows=rows)
+    return results
+
+
+class _Profiler:
+    """Сбор горячих точек этапа через cProfile или pyinstrument (если установлен)."""
+
+    def __init__(self, kind, directory):
+        self.kind = kind
+        self.directory = directory
+        if kind is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def run(self, name, func):
+        if self.kind is None:
+            return func()
+        if self.kind == 'pyinstrument':
+            from pyinstrument import Profiler  # Необязательная зависимость
+            profiler = Profiler()
+            profiler.start()
+            try:
+                return func()
+            finally:
+                profiler.stop()
+                with open(os.path.join(self.directory, f'{name}.html'), 'w') as f:
+                    f.write(profiler.output_html())
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func)
+        finally:
+            profiler.dump_stats(os.path.join(self.directory, f'{name}.prof'))
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(15)
+            print(report.getvalue())
+
+
+def _max_rss_mb():
+    """Пиковый объем памяти процесса (None там, где модуль resource недоступен)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure(profiler, name, func, trace_memory=False):
+    """Время выполнения этапа и пиковая память; возвращает замеры и результат.
+
+    max_rss_mb - пик памяти процесса после этапа. С trace_memory пик выделений Python и NumPy
+    за этап считается через tracemalloc, который заметно замедляет выполнение."""
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = profiler.run(name, func)
+        stage = {'seconds': time.perf_counter() - started, 'max_rss_mb': _max_rss_mb()}
+        if trace_memory:
+            stage['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return stage, result
+
+
+def benchmark_pipeline(rows, population=50, workers=None, backtrader_max_rows=100000, profiler=None,
+                       trace_memory=False):
+    """Замеры этапов main.py на rows синтетических барах."""
+    profiler = profiler or _Profiler(None, None)
+
+    def measure(name, func):
+        return _measure(profiler, f'{name}_{rows}', func, trace_memory)
+
+    path = write_bars_file(rows)
+    results = {'rows': rows}
+
+    stage, _ = measure('load', lambda: load_data_to_db(path))
+    results['load_data_to_db'] = dict(stage, bars_per_sec=rows / stage['seconds'])
+
+    stage, _ = measure('fetch_orm', fetch_data_from_db)
+    results['fetch_data_from_db'] = dict(stage, bars_per_sec=rows / stage['seconds'])
+
+    stage, _ = measure('fetch_bars', fetch_bars)
+    results['fetch_bars'] = dict(stage, bars_per_sec=rows / stage['seconds'])
+
+    data = get_bars()
+    stage, _ = measure('backtest_numpy',
+                        lambda: run_backtest(*BENCH_PARAMS, data=data, engine='numpy'))
+    results['run_backtest_numpy'] = dict(stage, bars_per_sec=rows / stage['seconds'])
+
+    if rows <= backtrader_max_rows:
+        stage, _ = measure('backtest_backtrader',
+                            lambda: run_backtest(*BENCH_PARAMS, data=data))
+        results['run_backtest_backtrader'] = dict(stage, bars_per_sec=rows / stage['seconds'])
+
+    # Одно поколение ГА (начальная популяция и потомки) на векторном движке. Воркеры пула
+    # читают бары сами, поэтому с workers > 1 им передается хранилище баров временной базы
+    if workers is not None and workers > 1:
+        bar_store = refresh_bar_store(os.path.join(_workdir, f'bar_store_{rows}'))
+        ga_data = {'bar_store': bar_store}
+    else:
+        ga_data = {'data': data}
+    stage, _ = measure('ga_generation',
+                        lambda: run_ga_optimization(workers=workers, seed=0, engine='numpy',
+                                                    population_size=population, ngen=1, **ga_data))
+    # Считаются только выполненные бэктесты, без попаданий в кэш фитнеса
+    evaluations = fetch_ga_runs()[0].backtests
+    results['ga_generation'] = dict(stage, evaluations=evaluations, evals_per_sec=evaluations / stage['seconds'])
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, population=50, workers=None, backtrader_max_rows=100000,
+                   profile=None, profile_dir='profiles', trace_memory=False):
+    """Замеры конвейера на всех размерах; результат с метаданными для сравнения между коммитами."""
+    profiler = _Profiler(profile, profile_dir)
+    report = {
+        'commit': _git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': [],
+    }
+    for rows in sizes:
+        results = benchmark_pipeline(rows, population, workers, backtrader_max_rows, profiler, trace_memory)
+        report['results'].append(results)
+        for name, stage in results.items():
+            if isinstance(stage, dict):
+                print(f'{rows} баров, {name}: ' + ', '.join(f'{key}={value:.2f}' for key, value in stage.items()
+                                                           if value is not None))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк конвейера оптимизации и бэктеста')
+    parser.add_argument('--rows', type=int, default=None, help='только замер загрузки на указанном числе баров')
+    parser.add_argument('--skip-legacy', action='store_true', help='не замерять построчную загрузку')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help='размеры рядов')
+    parser.add_argument('--population', type=int, default=50, help='размер популяции для поколения ГА')
+    parser.add_argument('--workers', type=int, default=None, help='процессов для оценки индивидов')
+    parser.add_argument('--backtrader-max-rows', type=int, default=100000,
+                        help='не запускать бэктест backtrader на рядах длиннее')
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], default=None,
+                        help='сохранить горячие точки каждого этапа')
+    parser.add_argument('--profile-dir', default='profiles', help='папка для профилей')
+    parser.add_argument('--trace-memory', action='store_true', help='пик памяти каждого этапа через tracemalloc')
+    parser.add_argument('--json', default='benchmark_results.json', help='файл результатов')
+    args = parser.parse_args()
+
+    if args.rows is not None:
+        for name, value in benchmark_load(args.rows, legacy=not args.skip_legacy).items():
+            print(f'{name}: {value:.0f}')
+    else:
+        report = run_benchmarks(args.sizes, args.population, args.workers, args.backtrader_max_rows,
+                                args.profile, args.profile_dir, args.trace_memory)
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Результаты сохранены в {args.json}')
@@ -1,57 +1,544 @@
-# database.py
-from sqlalchemy import create_engine, Column, Integer, Float, String, DateTime
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import pandas as pd
-from datetime import datetime
-
-# Определяем базу данных и создаем подключение
-DATABASE_URL = 'sqlite:///stocks.db'
-Base = declarative_base()
-
-class StockData(Base):
-    __tablename__ = 'stock_data'
-    
-    id = Column(Integer, primary_key=True)
-    date = Column(DateTime)
-    open_price = Column(Float)
-    high_price = Column(Float)
-    low_price = Column(Float)
-    close_price = Column(Float)
-    volume = Column(Integer)
-
-# Инициализация базы данных
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-
-def load_data_to_db(file_path):
-    """Загрузка данных из текстового файла в базу данных."""
-    session = Session()
-    
-    # Очистка существующих данных перед загрузкой новых
-    session.query(StockData).delete()
-    session.commit()
-    
-    df = pd.read_csv(file_path, sep='\t', parse_dates=['DATETIME'])
-    for _, row in df.iterrows():
-        stock_data = StockData(
-            date=row['DATETIME'],
-            open_price=row['<OPEN>'],
-            high_price=row['<HIGH>'],
-            low_price=row['<LOW>'],
-            close_price=row['<CLOSE>'],
-            volume=row['<VOL>']
-        )
-        session.add(stock_data)
-    session.commit()
-    session.close()
-
-def fetch_data_from_db():
-    """Извлечение данных из базы данных."""
-    session = Session()
-    result = session.query(StockData).all()
-    data = [(record.date, record.open_price, record.high_price, 
-             record.low_price, record.close_price, record.volume) for record in result]
-    session.close()
-    return data
\ No newline at end of file
+# database.py
+from sqlalchemy import create_engine, event, inspect, delete, func, select, Column, Integer, Float, String, Text, DateTime, Index
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+
+# Определяем базу данных и создаем подключение (путь можно переопределить переменной окружения)
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///stocks.db')
+
+# Сколько миллисекунд соединение ждет блокировку записи, прежде чем вернуть "database is locked":
+# параллельные фолды walk-forward и острова пишут в одну базу
+SQLITE_BUSY_TIMEOUT_MS = 60000
+Base = declarative_base()
+
+# Инструмент и таймфрейм по умолчанию (данные из data_output.txt и базы прежних версий)
+DEFAULT_SYMBOL = 'DEFAULT'
+DEFAULT_TIMEFRAME = 'DEFAULT'
+
+class StockData(Base):
+    __tablename__ = 'stock_data'
+    
+    id = Column(Integer, primary_key=True)
+    symbol = Column(String, nullable=False, default=DEFAULT_SYMBOL, server_default=DEFAULT_SYMBOL)
+    timeframe = Column(String, nullable=False, default=DEFAULT_TIMEFRAME, server_default=DEFAULT_TIMEFRAME)
+    date = Column(DateTime)
+    open_price = Column(Float)
+    high_price = Column(Float)
+    low_price = Column(Float)
+    close_price = Column(Float)
+    volume = Column(Integer)
+
+    # Уникальный составной индекс: выборка диапазона дат одного инструмента идет по индексу,
+    # а повторная дозагрузка не создает дубликатов
+    __table_args__ = (Index('ix_stock_data_symbol_timeframe_date', 'symbol', 'timeframe', 'date', unique=True),)
+
+class LoadState(Base):
+    __tablename__ = 'load_state'
+
+    file_path = Column(String, primary_key=True)  # Абсолютный путь к загруженному файлу
+    symbol = Column(String, primary_key=True)
+    timeframe = Column(String, primary_key=True)
+    size = Column(Integer)
+    mtime = Column(Float)
+    sha1 = Column(String)
+    rows = Column(Integer)  # Количество строк, загруженных из файла за последний запуск
+
+class FitnessCacheEntry(Base):
+    __tablename__ = 'fitness_cache'
+
+    fingerprint = Column(String, primary_key=True)  # Отпечаток набора данных
+    params = Column(String, primary_key=True)  # Параметры стратегии через запятую
+    total_profit = Column(Float)
+    profitable_trades_percentage = Column(Float)
+
+class GARun(Base):
+    """Результат запуска генетического алгоритма."""
+    __tablename__ = 'ga_runs'
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    symbol = Column(String)
+    timeframe = Column(String)
+    engine = Column(String)
+    seed = Column(Integer)
+    population_size = Column(Integer)
+    generations = Column(Integer)
+    params = Column(String)  # Лучшие параметры стратегии через запятую
+    total_profit = Column(Float)
+    profitable_trades_percentage = Column(Float)
+    backtests = Column(Integer)  # Выполнено бэктестов (промахи кэша фитнеса)
+    logbook = Column(Text)  # Журнал поколений DEAP в JSON
+
+class BacktestRun(Base):
+    """Финальный прогон бэктеста, журнал которого сохранен в backtest_fills, backtest_trades и backtest_equity."""
+    __tablename__ = 'backtest_runs'
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    symbol = Column(String)
+    timeframe = Column(String)
+    params = Column(String)  # Параметры стратегии через запятую
+    cash = Column(Float)
+    final_value = Column(Float)
+    total_trades = Column(Integer)
+    profitable_trades = Column(Integer)
+
+class BacktestFill(Base):
+    """Исполненный ордер прогона."""
+    __tablename__ = 'backtest_fills'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, nullable=False, index=True)
+    date = Column(DateTime)
+    size = Column(Float)  # Больше нуля - покупка, меньше нуля - продажа
+    price = Column(Float)
+    comm = Column(Float)
+
+class BacktestTrade(Base):
+    """Закрытая сделка прогона."""
+    __tablename__ = 'backtest_trades'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, nullable=False, index=True)
+    open_date = Column(DateTime)
+    close_date = Column(DateTime)
+    long = Column(Integer)  # 1 - длинная позиция, 0 - короткая
+    price = Column(Float)  # Средняя цена открытия
+    pnl = Column(Float)
+    pnlcomm = Column(Float)  # Результат с учетом комиссии
+    bars = Column(Integer)  # Длительность сделки в барах
+
+class BacktestEquity(Base):
+    """Стоимость портфеля прогона на закрытии бара."""
+    __tablename__ = 'backtest_equity'
+
+    run_id = Column(Integer, primary_key=True)
+    date = Column(DateTime, primary_key=True)
+    value = Column(Float)
+
+# Соответствие колонок текстового файла и таблицы stock_data
+CSV_COLUMNS = {
+    'DATETIME': 'date',
+    '<OPEN>': 'open_price',
+    '<HIGH>': 'high_price',
+    '<LOW>': 'low_price',
+    '<CLOSE>': 'close_price',
+    '<VOL>': 'volume',
+}
+
+# Количество строк в одной пачке вставки
+INSERT_BATCH_SIZE = 50000
+
+# Формат хранения DateTime в SQLite, совпадающий с форматом SQLAlchemy
+SQLITE_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Подключение создается при инициализации (init_db), а не при импорте модуля: процессам,
+# которые берут бары из хранилища np.memmap, база данных не нужна вовсе
+engine = None
+Session = sessionmaker()
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настройка SQLite для быстрой массовой записи и ожидания блокировки другими процессами."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 МБ страничного кэша
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+    cursor.close()
+
+def _migrate_schema():
+    """Приведение баз данных, созданных прежними версиями, к текущей схеме."""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        columns = {column['name'] for column in inspector.get_columns(StockData.__tablename__)}
+        for column, default in (('symbol', DEFAULT_SYMBOL), ('timeframe', DEFAULT_TIMEFRAME)):
+            if column not in columns:
+                connection.exec_driver_sql(f"ALTER TABLE {StockData.__tablename__} "
+                                           f"ADD COLUMN {column} VARCHAR NOT NULL DEFAULT '{default}'")
+        connection.exec_driver_sql('DROP INDEX IF EXISTS ix_stock_data_date')
+
+        # Состояние загрузок - служебная таблица, ее проще пересоздать
+        if 'symbol' not in {column['name'] for column in inspector.get_columns(LoadState.__tablename__)}:
+            connection.exec_driver_sql(f'DROP TABLE {LoadState.__tablename__}')
+
+        if 'backtests' not in {column['name'] for column in inspector.get_columns(GARun.__tablename__)}:
+            connection.exec_driver_sql(f'ALTER TABLE {GARun.__tablename__} ADD COLUMN backtests INTEGER')
+
+        # У прогонов, сохраненных без инструмента, symbol и timeframe пустые (инструмент по умолчанию)
+        columns = {column['name'] for column in inspector.get_columns(BacktestRun.__tablename__)}
+        for column in ('symbol', 'timeframe'):
+            if column not in columns:
+                connection.exec_driver_sql(f'ALTER TABLE {BacktestRun.__tablename__} ADD COLUMN {column} VARCHAR')
+
+def init_db(database_url=None):
+    """Подключение к базе данных и приведение схемы к текущей версии; повторный вызов ничего не делает."""
+    global engine
+    if engine is not None:
+        return engine
+    engine = create_engine(database_url or DATABASE_URL)
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    _migrate_schema()
+    Base.metadata.create_all(engine)
+    # Индексы добавляются и в базы, созданные до их появления в схеме
+    for index in StockData.__table__.indexes:
+        index.create(engine, checkfirst=True)
+    Session.configure(bind=engine)
+    return engine
+
+def get_engine():
+    """Подключение к базе данных (при первом обращении выполняется init_db)."""
+    return engine if engine is not None else init_db()
+
+def get_session():
+    """Новая сессия ORM (при первом обращении выполняется init_db)."""
+    get_engine()
+    return Session()
+
+def _read_bars(file_path, chunksize=None):
+    """Чтение текстового файла с барами целиком или по частям (chunksize строк)."""
+    reader = pd.read_csv(file_path, sep='\t', usecols=list(CSV_COLUMNS), parse_dates=['DATETIME'],
+                         chunksize=chunksize)
+    return [reader] if chunksize is None else reader
+
+def _frame_to_rows(df, symbol, timeframe):
+    """Преобразование DataFrame с барами в список кортежей для executemany."""
+    columns = [df[column].tolist() for column in CSV_COLUMNS]
+    columns[0] = df['DATETIME'].dt.strftime(SQLITE_DATETIME_FORMAT).tolist()
+    return [(symbol, timeframe) + row for row in zip(*columns)]
+
+def _insert_bars_sql():
+    """SQL вставки строк (symbol, timeframe, date, open, high, low, close, volume)."""
+    columns = ['symbol', 'timeframe'] + list(CSV_COLUMNS.values())
+    # OR IGNORE вместе с уникальным индексом по дате делает дозагрузку идемпотентной
+    return (f'INSERT OR IGNORE INTO {StockData.__tablename__} ({", ".join(columns)}) '
+            f'VALUES ({", ".join("?" * len(columns))})')
+
+def append_bars(bars, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Дозапись баров (дата, open, high, low, close, volume) одной транзакцией; уже записанные пропускаются."""
+    rows = [(symbol, timeframe, date.strftime(SQLITE_DATETIME_FORMAT)) + tuple(bar)
+            for date, *bar in bars]
+    with get_engine().begin() as connection:
+        connection.exec_driver_sql(_insert_bars_sql(), rows)
+    clear_bars_cache()
+
+def _file_sha1(file_path):
+    """Хэш содержимого файла, читаемого блоками по 1 МБ."""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _file_unchanged(session, file_path, symbol, timeframe, stat):
+    """Проверка, что файл не менялся с прошлой загрузки (размер и mtime, затем хэш)."""
+    state = session.get(LoadState, (file_path, symbol, timeframe))
+    if state is None or state.size != stat.st_size:
+        return False
+    if state.mtime == stat.st_mtime:
+        return True
+    if state.sha1 == _file_sha1(file_path):
+        # Файл был перезаписан тем же содержимым - запоминаем новое время изменения
+        state.mtime = stat.st_mtime
+        session.commit()
+        return True
+    return False
+
+def load_data_to_db(file_path, chunksize=None, incremental=False,
+                    symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Загрузка данных инструмента symbol с таймфреймом timeframe из текстового файла в базу данных.
+
+    Строки вставляются пачками в одной транзакции. Если задан chunksize, файл читается
+    потоково по chunksize строк, и расход памяти не зависит от размера файла.
+    В режиме incremental таблица не очищается: загрузка пропускается, если файл не
+    изменился, иначе дописываются только бары новее последнего сохраненного.
+    Возвращает количество вставленных строк (дубликаты, пропущенные INSERT OR IGNORE, не учитываются)."""
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    session = get_session()
+    if incremental and _file_unchanged(session, file_path, symbol, timeframe, stat):
+        session.close()
+        print('Данные не изменились, загрузка пропущена')
+        return 0
+
+    insert_sql = _insert_bars_sql()
+
+    started = time.perf_counter()
+    rows = 0  # Прочитано строк файла
+    inserted = 0  # Вставлено строк (rowcount не учитывает пропущенные дубликаты)
+    with get_engine().begin() as connection:
+        last_date = None
+        if incremental:
+            last_date = connection.execute(
+                select(func.max(StockData.date)).where(StockData.symbol == symbol,
+                                                       StockData.timeframe == timeframe)).scalar()
+        else:
+            # Очистка существующих данных инструмента перед загрузкой новых
+            connection.execute(delete(StockData).where(StockData.symbol == symbol,
+                                                       StockData.timeframe == timeframe))
+
+        for df in _read_bars(file_path, chunksize):
+            if last_date is not None:
+                df = df[df['DATETIME'] > last_date]
+            batch = _frame_to_rows(df, symbol, timeframe)
+            for start in range(0, len(batch), INSERT_BATCH_SIZE):
+                result = connection.exec_driver_sql(insert_sql, batch[start:start + INSERT_BATCH_SIZE])
+                inserted += result.rowcount
+            rows += len(batch)
+
+    session.merge(LoadState(file_path=file_path, symbol=symbol, timeframe=timeframe, size=stat.st_size, mtime=stat.st_mtime,
+                            sha1=_file_sha1(file_path), rows=inserted))
+    session.commit()
+    session.close()
+
+    elapsed = time.perf_counter() - started
+    print(f'Загружено строк: {inserted} из {rows} прочитанных за {elapsed:.2f} с '
+          f'({rows / elapsed if elapsed > 0 else 0:.0f} строк/с)')
+    if inserted:
+        clear_bars_cache()
+    return inserted
+
+def fetch_data_from_db(symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Извлечение данных инструмента из базы данных."""
+    session = get_session()
+    result = session.query(StockData).filter_by(symbol=symbol, timeframe=timeframe).order_by(StockData.date).all()
+    data = [(record.date, record.open_price, record.high_price, 
+             record.low_price, record.close_price, record.volume) for record in result]
+    session.close()
+    return data
+
+# Типы колонок stock_data при колоночном чтении
+BAR_COLUMN_TYPES = {
+    'open_price': np.float64,
+    'high_price': np.float64,
+    'low_price': np.float64,
+    'close_price': np.float64,
+    'volume': np.int64,
+}
+
+def fetch_bars(start=None, end=None, columns=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Колоночное чтение баров инструмента в DataFrame напрямую через курсор, без ORM-объектов.
+
+    start, end - границы диапазона дат (включительно), columns - список колонок
+    из BAR_COLUMN_TYPES (по умолчанию все). Колонка date возвращается всегда.
+    Выборка идет по составному индексу (symbol, timeframe, date)."""
+    columns = list(BAR_COLUMN_TYPES) if columns is None else list(columns)
+    conditions, args = ['symbol = ?', 'timeframe = ?'], [symbol, timeframe]
+    if start is not None:
+        conditions.append('date >= ?')
+        args.append(start.strftime(SQLITE_DATETIME_FORMAT))
+    if end is not None:
+        conditions.append('date <= ?')
+        args.append(end.strftime(SQLITE_DATETIME_FORMAT))
+    sql = (f'SELECT date, {", ".join(columns)} FROM {StockData.__tablename__} '
+           f'WHERE {" AND ".join(conditions)} ORDER BY date')
+
+    connection = get_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        rows = cursor.execute(sql, args).fetchall()
+        cursor.close()
+    finally:
+        connection.close()
+
+    values = list(zip(*rows)) if rows else [()] * (len(columns) + 1)
+    frame = {'date': pd.to_datetime(pd.Series(values[0], dtype=object), format='ISO8601')}
+    for column, column_values in zip(columns, values[1:]):
+        frame[column] = np.array(column_values, dtype=BAR_COLUMN_TYPES[column])
+    return pd.DataFrame(frame)
+
+# Кэш баров текущего процесса: повторные бэктесты используют одну копию данных в памяти
+_bars_cache = {}
+
+def get_bars(start=None, end=None, columns=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Бары из кэша процесса (при первом обращении читаются через fetch_bars).
+
+    Возвращаемый DataFrame общий для всех вызывающих и не должен изменяться."""
+    key = (symbol, timeframe, start, end, tuple(columns) if columns is not None else None)
+    if key not in _bars_cache:
+        _bars_cache[key] = fetch_bars(start, end, columns, symbol, timeframe)
+    return _bars_cache[key]
+
+def clear_bars_cache():
+    """Сброс кэша баров (после загрузки новых данных)."""
+    _bars_cache.clear()
+
+# Корневой каталог бинарного хранилища баров: у каждой пары (инструмент, таймфрейм) свой
+# подкаталог с файлами .npy по одному на колонку, которые открываются через np.memmap
+BAR_STORE_PATH = 'bars_store'
+BAR_STORE_COLUMNS = ('date',) + tuple(BAR_COLUMN_TYPES)
+
+def bar_store_path(symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Каталог хранилища баров инструмента."""
+    return os.path.join(BAR_STORE_PATH, symbol, timeframe)
+
+def _db_bars_state(symbol, timeframe):
+    """Количество баров и дата последнего бара инструмента в stock_data."""
+    with get_engine().connect() as connection:
+        rows, last_date = connection.execute(
+            select(func.count(), func.max(StockData.date)).where(StockData.symbol == symbol,
+                                                                 StockData.timeframe == timeframe)).one()
+    return {'symbol': symbol, 'timeframe': timeframe, 'rows': rows,
+            'last_date': last_date.strftime(SQLITE_DATETIME_FORMAT) if last_date else None}
+
+def _read_bar_store_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def export_bar_store(path=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Выгрузка баров инструмента из stock_data в бинарное хранилище.
+
+    Файлы заменяются атомарно, поэтому процессы, уже открывшие хранилище,
+    продолжают работать со своей копией страниц."""
+    path = bar_store_path(symbol, timeframe) if path is None else path
+    state = _db_bars_state(symbol, timeframe)
+    frame = fetch_bars(symbol=symbol, timeframe=timeframe)
+    os.makedirs(path, exist_ok=True)
+    for column in BAR_STORE_COLUMNS:
+        tmp_path = os.path.join(path, f'{column}.tmp.npy')
+        np.save(tmp_path, frame[column].to_numpy())
+        os.replace(tmp_path, os.path.join(path, f'{column}.npy'))
+
+    # Метаданные пишутся последними: по ним определяется актуальность хранилища
+    tmp_path = os.path.join(path, 'meta.tmp.json')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+    return path
+
+def refresh_bar_store(path=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Выгрузка хранилища баров инструмента, только если оно отсутствует или отстает от базы данных.
+
+    Возвращает каталог хранилища."""
+    path = bar_store_path(symbol, timeframe) if path is None else path
+    if _read_bar_store_meta(path) != _db_bars_state(symbol, timeframe):
+        export_bar_store(path, symbol, timeframe)
+        _bars_cache.pop(('bar_store', path), None)
+    return path
+
+def open_bar_store(path):
+    """Открытие хранилища баров через np.memmap в DataFrame без копирования данных.
+
+    Страницы файлов общие для всех процессов, открывших хранилище, массивы доступны только для чтения."""
+    meta = _read_bar_store_meta(path)
+    if meta is None:
+        raise FileNotFoundError(f'Хранилище баров не найдено: {path}')
+    columns = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r')
+               for column in BAR_STORE_COLUMNS}
+    if any(len(values) != meta['rows'] for values in columns.values()):
+        raise ValueError(f'Хранилище баров повреждено или обновляется: {path}')
+    return pd.DataFrame(columns, copy=False)
+
+def get_bar_store(path):
+    """Хранилище баров из кэша процесса (открывается один раз)."""
+    key = ('bar_store', path)
+    if key not in _bars_cache:
+        _bars_cache[key] = open_bar_store(path)
+    return _bars_cache[key]
+
+def load_bars(bar_store=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Бары для бэктеста: из хранилища np.memmap, если указан его каталог, иначе из SQLite через get_bars."""
+    return get_bar_store(bar_store) if bar_store is not None else get_bars(symbol=symbol, timeframe=timeframe)
+
+def save_ga_run(**fields):
+    """Сохранение результата запуска генетического алгоритма; возвращает идентификатор запуска."""
+    session = get_session()
+    try:
+        run = GARun(**fields)
+        session.add(run)
+        session.commit()
+        return run.id
+    finally:
+        session.close()
+
+def fetch_ga_runs(symbol=None, timeframe=None):
+    """Прошлые запуски генетического алгоритма (новые первыми)."""
+    session = get_session()
+    try:
+        query = session.query(GARun)
+        if symbol is not None:
+            query = query.filter_by(symbol=symbol)
+        if timeframe is not None:
+            query = query.filter_by(timeframe=timeframe)
+        return query.order_by(GARun.id.desc()).all()
+    finally:
+        session.close()
+
+def create_backtest_run(**fields):
+    """Запись о начале прогона бэктеста; возвращает идентификатор прогона."""
+    session = get_session()
+    try:
+        run = BacktestRun(**fields)
+        session.add(run)
+        session.commit()
+        return run.id
+    finally:
+        session.close()
+
+def finish_backtest_run(run_id, **fields):
+    """Запись итогов прогона бэктеста (final_value, total_trades, ...)."""
+    session = get_session()
+    try:
+        run = session.get(BacktestRun, run_id)
+        for name, value in fields.items():
+            setattr(run, name, value)
+        session.commit()
+    finally:
+        session.close()
+
+def save_backtest_records(table, rows):
+    """Пакетная запись строк журнала прогона в таблицу table (BacktestFill, BacktestTrade или BacktestEquity).
+
+    rows - кортежи значений колонок таблицы в порядке объявления (без автоматического id),
+    даты - строки в формате SQLITE_DATETIME_FORMAT."""
+    if not rows:
+        return
+    columns = [column.name for column in table.__table__.columns if column.name != 'id']
+    sql = (f'INSERT OR REPLACE INTO {table.__tablename__} ({", ".join(columns)}) '
+           f'VALUES ({", ".join("?" * len(columns))})')
+    with get_engine().begin() as connection:
+        for start in range(0, len(rows), INSERT_BATCH_SIZE):
+            connection.exec_driver_sql(sql, rows[start:start + INSERT_BATCH_SIZE])
+
+def fetch_backtest_runs(limit=None, run_id=None):
+    """Прогоны бэктеста с сохраненным журналом (новые первыми); run_id - только указанный прогон."""
+    session = get_session()
+    try:
+        query = session.query(BacktestRun)
+        if run_id is not None:
+            query = query.filter_by(id=run_id)
+        return query.order_by(BacktestRun.id.desc()).limit(limit).all()
+    finally:
+        session.close()
+
+def fetch_backtest_records(table, run_id):
+    """Журнал прогона из таблицы table в DataFrame, упорядоченный по дате (колонки как в таблице, без id)."""
+    columns = [column.name for column in table.__table__.columns
+               if column.name not in ('id', 'run_id')]
+    order = 'date' if 'date' in columns else 'close_date'
+    sql = f'SELECT {", ".join(columns)} FROM {table.__tablename__} WHERE run_id = ? ORDER BY {order}'
+    connection = get_engine().raw_connection()
+    try:
+        cursor = connection.cursor()
+        rows = cursor.execute(sql, (run_id,)).fetchall()
+        cursor.close()
+    finally:
+        connection.close()
+    frame = pd.DataFrame(rows, columns=columns)
+    for column in columns:
+        if column.endswith('date'):
+            frame[column] = pd.to_datetime(frame[column], format='ISO8601')
+    return frame
@@ -0,0 +1,101 @@
+# fitness_cache.py
+# Кэш результатов бэктеста для генетического алгоритма.
+# После cxBlend/mutGaussian и приведения генов к целым числам многие потомки совпадают,
+# поэтому результат бэктеста запоминается по кортежу параметров и отпечатку набора данных.
+import hashlib
+from collections import OrderedDict
+import pandas as pd
+from sqlalchemy import select
+from database import get_engine, FitnessCacheEntry
+
+
+def dataset_fingerprint(data):
+    """Расчет отпечатка набора данных (DataFrame из get_bars или список кортежей из fetch_data_from_db)."""
+    digest = hashlib.sha1()
+    digest.update(str(len(data)).encode())
+    if isinstance(data, pd.DataFrame):
+        digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
+    for row in data:
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+class FitnessCache:
+    """LRU-кэш результатов run_backtest с необязательным хранением в SQLite.
+
+    В режиме persistent сохраненные результаты для отпечатка читаются из базы одним запросом
+    при создании кэша, а новые копятся в памяти и записываются одной транзакцией в flush()
+    (раз в поколение), а не отдельной транзакцией на каждый бэктест."""
+
+    def __init__(self, fingerprint, maxsize=4096, persistent=False):
+        self.fingerprint = fingerprint
+        self.maxsize = maxsize
+        self.persistent = persistent
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._stored = self._load() if persistent else {}  # Результаты, уже записанные в базу
+        self._pending = {}  # Новые результаты, еще не записанные в базу
+
+    @staticmethod
+    def _key(params):
+        return ','.join(str(int(value)) for value in params)
+
+    def _load(self):
+        """Все сохраненные результаты для отпечатка набора данных."""
+        with get_engine().connect() as connection:
+            rows = connection.execute(
+                select(FitnessCacheEntry.params, FitnessCacheEntry.total_profit,
+                       FitnessCacheEntry.profitable_trades_percentage)
+                .where(FitnessCacheEntry.fingerprint == self.fingerprint))
+            return {tuple(int(value) for value in params.split(',')): (total_profit, profitable_trades_percentage)
+                    for params, total_profit, profitable_trades_percentage in rows}
+
+    def get(self, params):
+        """Получение результата из кэша; None, если параметры еще не оценивались."""
+        params = tuple(params)
+        if params in self._entries:
+            self._entries.move_to_end(params)
+            self.hits += 1
+            return self._entries[params]
+
+        result = self._pending.get(params) or self._stored.get(params)
+        if result is not None:
+            self._remember(params, result)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        return None
+
+    def put(self, params, result):
+        """Сохранение результата бэктеста в кэше (в базу он попадает при следующем flush)."""
+        params = tuple(params)
+        self._remember(params, result)
+        if self.persistent:
+            self._pending[params] = result
+
+    def flush(self):
+        """Запись накопленных результатов в базу одной транзакцией."""
+        if not self._pending:
+            return
+        rows = [(self.fingerprint, self._key(params)) + tuple(result) for params, result in self._pending.items()]
+        with get_engine().begin() as connection:
+            connection.exec_driver_sql(
+                f'INSERT OR REPLACE INTO {FitnessCacheEntry.__tablename__} '
+                f'(fingerprint, params, total_profit, profitable_trades_percentage) VALUES (?, ?, ?, ?)', rows)
+        self._stored.update(self._pending)
+        self._pending.clear()
+
+    def _remember(self, params, result):
+        self._entries[params] = result
+        self._entries.move_to_end(params)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """Статистика обращений к кэшу."""
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total > 0 else 0
+        return f'Кэш фитнеса: попаданий={self.hits}, промахов={self.misses}, доля попаданий={hit_rate:.1f}%'
@@ -1,107 +1,516 @@
-# Этот код реализует генетический алгоритм для оптимизации параметров торговой стратегии.
-# Нормализация значений доходности и процента прибыльных сделок выполняется для приведения их к диапазону [0, 1],
-# что позволяет сравнивать и комбинировать метрики в оценке индивидов в популяции,
-# предотвращая доминирование одной метрики над другой и обеспечивая справедливую и стабильную оценку.
-import random
-from deap import base, creator, tools, algorithms
-from backtest import run_backtest
-
-# Задаем веса для каждой из целевых функций
-w1 = 0.7  # Важность доходности
-w2 = 0.3  # Важность процента прибыльных сделок
-
-# Сохраняем минимальные и максимальные значения для нормализации
-min_return = None
-max_return = None
-min_profit_percentage = None
-max_profit_percentage = None
-
-def normalize(value, min_value, max_value):
-    """Нормализация показателя по шкале [0, 1] на основе минимума и максимума."""
-    if max_value > min_value:
-        return (value - min_value) / (max_value - min_value)
-    return 0  # Возврат 0, если нет диапазона
-
-def run_ga_optimization():
-    """Используется генетический алгоритм для мультиобъектной оптимизации параметров торговой стратегии."""
-    
-    global min_return, max_return, min_profit_percentage, max_profit_percentage
-
-    # Создается многоцелевую фитнес-функцию
-    creator.create("FitnessMulti", base.Fitness, weights=(1.0, 1.0))  # Максимизация
-    creator.create("Individual", list, fitness=creator.FitnessMulti)
-
-    toolbox = base.Toolbox()
-
-    toolbox.register("fast_ema_period", random.randint, 5, 30)
-    toolbox.register("slow_ema_period", random.randint, 13, 60)
-    toolbox.register("stoch_period", random.randint, 5, 20)
-    toolbox.register("rsi_period", random.randint, 5, 20)
-    toolbox.register("stoch_overbought", random.randint, 70, 100)
-    toolbox.register("stoch_oversold", random.randint, 0, 30)
-    toolbox.register("rsi_overbought", random.randint, 50, 100)
-    toolbox.register("rsi_oversold", random.randint, 0, 50)
-
-    # Определяется индивидуум
-    toolbox.register("individual", tools.initCycle, creator.Individual,
-                     (toolbox.fast_ema_period, toolbox.slow_ema_period, toolbox.stoch_period,
-                      toolbox.rsi_period, toolbox.stoch_overbought, toolbox.stoch_oversold,
-                      toolbox.rsi_overbought, toolbox.rsi_oversold),
-                     n=1)
-
-    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
-
-    def evaluate(individual):
-        # Применяется ограничения для параметров индивидуума.
-        for idx, value in enumerate(individual):
-            if idx < 4:
-                individual[idx] = max(int(value), 1)
-            else:
-                individual[idx] = max(int(value), 0)
-        # Приводятся параметры к целым числам
-        individual = list(map(int, individual))
-
-        # Получаем результат backtest: доходность и процент прибыльных сделок
-        total_return, profitable_trades_percentage = run_backtest(*individual)
-
-        # Обновлются минимальные и максимальные значения для нормализации
-        global min_return, max_return, min_profit_percentage, max_profit_percentage
-        if total_return is not None:
-            if min_return is None or total_return < min_return:
-                min_return = total_return
-            if max_return is None or total_return > max_return:
-                max_return = total_return
-        if profitable_trades_percentage is not None:
-            if min_profit_percentage is None or profitable_trades_percentage < min_profit_percentage:
-                min_profit_percentage = profitable_trades_percentage
-            if max_profit_percentage is None or profitable_trades_percentage > max_profit_percentage:
-                max_profit_percentage = profitable_trades_percentage
-
-        # Нормализируются значение доходности и процента прибыльных сделок
-        normalized_return = normalize(total_return, min_return, max_return) if min_return is not None and max_return is not None else 0
-        normalized_profit_percentage = normalize(profitable_trades_percentage, 
-                                                min_profit_percentage, max_profit_percentage) if min_profit_percentage is not None and max_profit_percentage is not None else 0
-
-        return (normalized_return * w1, normalized_profit_percentage * w2)
-
-    # Регистрация функций в toolbox
-    toolbox.register("evaluate", evaluate)
-    toolbox.register("mate", tools.cxBlend, alpha=0.5)
-    toolbox.register("mutate", tools.mutGaussian, mu=0, sigma=1, indpb=0.2)
-    toolbox.register("select", tools.selNSGA2)  # Используем NSGA-II для многокритериальной селекции.
-
-    pop = toolbox.population(n=10)  
-    hall_of_fame = tools.HallOfFame(1)
-
-    stats = tools.Statistics(lambda ind: ind.fitness.values)
-    stats.register("avg", lambda values: (sum(v[0] for v in values) / len(values),
-                                           sum(v[1] for v in values) / len(values)))
-    stats.register("min", min)
-    stats.register("max", max)
-
-    # Запуск алгоритма
-    algorithms.eaSimple(pop, toolbox, cxpb=0.8, mutpb=0.2, ngen=10,
-                          stats=stats, halloffame=hall_of_fame, verbose=True)
-
-    best_ind = hall_of_fame[0]
-    return best_ind
\ No newline at end of file
+# Этот код реализует генетический алгоритм для оптимизации параметров торговой стратегии.
+# Нормализация значений доходности и процента прибыльных сделок выполняется для приведения их к диапазону [0, 1],
+# что позволяет сравнивать и комбинировать метрики в оценке индивидов в популяции,
+# предотвращая доминирование одной метрики над другой и обеспечивая справедливую и стабильную оценку.
+import os
+import json
+import math
+import pickle
+import random
+import multiprocessing
+from datetime import datetime
+from deap import base, creator, tools, algorithms
+from backtest import run_backtest, run_backtest_batch
+from database import DEFAULT_SYMBOL, DEFAULT_TIMEFRAME, load_bars, refresh_bar_store, save_ga_run
+from fitness_cache import FitnessCache, dataset_fingerprint
+from indicator_store import get_indicator_store
+from surrogate import KNNSurrogate, rank_correlation
+
+# Задаем веса для каждой из целевых функций
+w1 = 0.7  # Важность доходности
+w2 = 0.3  # Важность процента прибыльных сделок
+
+# Сохраняем минимальные и максимальные значения для нормализации
+min_return = None
+max_return = None
+min_profit_percentage = None
+max_profit_percentage = None
+
+# Названия и границы [low, high] генов индивида в порядке параметров стратегии
+GENE_NAMES = ('fast_ema_period', 'slow_ema_period', 'stoch_period', 'rsi_period',
+              'stoch_overbought', 'stoch_oversold', 'rsi_overbought', 'rsi_oversold')
+GENE_BOUNDS = ((5, 30), (13, 60), (5, 20), (5, 20), (70, 100), (0, 30), (50, 100), (0, 50))
+
+# Режим 'nsga2': стандартное отклонение мутации в долях диапазона гена, параметр
+# распределения скрещивания SBX и вероятности скрещивания и мутации потомка (algorithms.varOr)
+MUTATION_SCALE = 0.1
+SBX_ETA = 15.0
+NSGA2_CXPB, NSGA2_MUTPB = 0.6, 0.3
+
+# Сколько бэктестов должно накопиться, прежде чем суррогатная модель начнет отсеивать потомков
+SURROGATE_MIN_SAMPLES = 20
+
+# Данные баров и движок бэктеста, задаваемые один раз при старте каждого процесса-воркера
+_worker_data = None
+_worker_engine = 'backtrader'
+_worker_prune = None
+
+def normalize(value, min_value, max_value):
+    """Нормализация показателя по шкале [0, 1] на основе минимума и максимума."""
+    if max_value > min_value:
+        return (value - min_value) / (max_value - min_value)
+    return 0  # Возврат 0, если нет диапазона
+
+def clamp_individual(individual):
+    """Применение ограничений к параметрам индивидуума и приведение их к целым числам."""
+    for idx, value in enumerate(individual):
+        if idx < 4:
+            individual[idx] = max(int(value), 1)
+        else:
+            individual[idx] = max(int(value), 0)
+    return tuple(map(int, individual))
+
+def bound_individual(individual):
+    """Округление генов до целых и приведение их в границы GENE_BOUNDS (на месте)."""
+    for idx, (low, high) in enumerate(GENE_BOUNDS):
+        individual[idx] = min(max(int(round(individual[idx])), low), high)
+    return individual
+
+def mutate_bounded(individual, indpb):
+    """Гауссова мутация с масштабом, пропорциональным диапазону каждого гена, в пределах границ."""
+    for idx, (low, high) in enumerate(GENE_BOUNDS):
+        if random.random() < indpb:
+            individual[idx] += random.gauss(0, MUTATION_SCALE * (high - low))
+    return bound_individual(individual),
+
+def mate_bounded(ind1, ind2):
+    """Скрещивание SBX в пределах границ генов."""
+    tools.cxSimulatedBinaryBounded(ind1, ind2, eta=SBX_ETA,
+                                   low=[low for low, _ in GENE_BOUNDS], up=[high for _, high in GENE_BOUNDS])
+    return bound_individual(ind1), bound_individual(ind2)
+
+def population_diversity(population):
+    """Разнообразие популяции: среднее по генам стандартное отклонение в долях диапазона гена."""
+    n = len(population)
+    total = 0.0
+    for idx, (low, high) in enumerate(GENE_BOUNDS):
+        values = [ind[idx] for ind in population]
+        mean = sum(values) / n
+        total += (sum((value - mean) ** 2 for value in values) / n) ** 0.5 / (high - low)
+    return total / len(GENE_BOUNDS)
+
+def _weakly_dominated(result, results):
+    """Результат (доходность, процент прибыльных сделок) не лучше одного из results по обоим критериям."""
+    return any(other[0] >= result[0] and other[1] >= result[1] for other in results)
+
+def reset_normalization():
+    """Сброс границ нормализации перед оптимизацией на новом наборе данных."""
+    global min_return, max_return, min_profit_percentage, max_profit_percentage
+    min_return = max_return = None
+    min_profit_percentage = max_profit_percentage = None
+
+def normalization_state():
+    """Текущие границы нормализации (для контрольной точки)."""
+    return {'min_return': min_return, 'max_return': max_return,
+            'min_profit_percentage': min_profit_percentage, 'max_profit_percentage': max_profit_percentage}
+
+def restore_normalization(state):
+    """Восстановление границ нормализации из контрольной точки."""
+    globals().update(state)
+
+def save_checkpoint(path, state):
+    """Атомарная запись контрольной точки: прерванная запись не портит предыдущую."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    """Чтение контрольной точки; None, если ее нет."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def score_result(total_return, profitable_trades_percentage):
+    """Обновление границ нормализации и расчет взвешенной оценки по результату бэктеста.
+
+    Вызывается только в главном процессе и строго в порядке индивидов,
+    поэтому оценки совпадают при последовательном и параллельном запуске."""
+    global min_return, max_return, min_profit_percentage, max_profit_percentage
+    if total_return is not None:
+        if min_return is None or total_return < min_return:
+            min_return = total_return
+        if max_return is None or total_return > max_return:
+            max_return = total_return
+    if profitable_trades_percentage is not None:
+        if min_profit_percentage is None or profitable_trades_percentage < min_profit_percentage:
+            min_profit_percentage = profitable_trades_percentage
+        if max_profit_percentage is None or profitable_trades_percentage > max_profit_percentage:
+            max_profit_percentage = profitable_trades_percentage
+
+    return normalized_score(total_return, profitable_trades_percentage)
+
+def normalized_score(total_return, profitable_trades_percentage):
+    """Взвешенная оценка результата бэктеста по текущим границам нормализации (границы не меняются)."""
+    # Нормализируются значение доходности и процента прибыльных сделок
+    normalized_return = normalize(total_return, min_return, max_return) if min_return is not None and max_return is not None else 0
+    normalized_profit_percentage = normalize(profitable_trades_percentage, 
+                                            min_profit_percentage, max_profit_percentage) if min_profit_percentage is not None and max_profit_percentage is not None else 0
+
+    return (normalized_return * w1, normalized_profit_percentage * w2)
+
+def _init_worker(engine='backtrader', bar_store=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME,
+                 prune=None):
+    """Инициализация процесса-воркера: данные загружаются один раз и переиспользуются."""
+    global _worker_data, _worker_engine, _worker_prune
+    _worker_data = load_bars(bar_store, symbol, timeframe)
+    _worker_engine = engine
+    _worker_prune = prune
+
+def _worker_backtest(params):
+    """Бэктест одного набора параметров внутри процесса-воркера."""
+    return run_backtest(*params, data=_worker_data, engine=_worker_engine, prune=_worker_prune)
+
+def _worker_backtest_batch(params_list):
+    """Бэктест части поколения одним вызовом векторного движка внутри процесса-воркера."""
+    return [tuple(row) for row in run_backtest_batch(params_list, data=_worker_data, prune=_worker_prune).tolist()]
+
+def evaluate_batch(params_list, cache, backtest_map, raw_results=None):
+    """Оценка списка наборов параметров: бэктест запускается только для наборов, которых нет в кэше.
+
+    В словарь raw_results, если он передан, записываются исходные результаты бэктеста."""
+    results = {}
+    pending = []
+    for params in params_list:
+        if params in results:
+            cache.hits += 1  # Дубликат внутри поколения не бэктестится повторно
+            continue
+        results[params] = cache.get(params)
+        if results[params] is None:
+            pending.append(params)
+
+    for params, result in zip(pending, backtest_map(pending)):
+        cache.put(params, result)
+        results[params] = result
+
+    if raw_results is not None:
+        raw_results.update(results)
+    return [score_result(*results[params]) for params in params_list]
+
+def create_types():
+    """Создание классов фитнеса и индивидуума DEAP (один раз на процесс, повторные запуски их переиспользуют)."""
+    if not hasattr(creator, "FitnessMulti"):
+        creator.create("FitnessMulti", base.Fitness, weights=(1.0, 1.0))  # Максимизация
+        creator.create("Individual", list, fitness=creator.FitnessMulti)
+
+def create_toolbox(cache, backtest_map, bounded=False, raw_results=None):
+    """Toolbox с генами стратегии, операторами и пакетной оценкой индивидов через кэш фитнеса.
+
+    bounded - скрещивание SBX и мутация с масштабом по диапазону гена в пределах GENE_BOUNDS
+    вместо cxBlend и mutGaussian(sigma=1). raw_results - словарь для исходных результатов бэктеста."""
+    toolbox = base.Toolbox()
+
+    for name, (low, high) in zip(GENE_NAMES, GENE_BOUNDS):
+        toolbox.register(name, random.randint, low, high)
+
+    # Определяется индивидуум
+    toolbox.register("individual", tools.initCycle, creator.Individual,
+                     [getattr(toolbox, name) for name in GENE_NAMES], n=1)
+
+    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+
+    def evaluate(individual):
+        return evaluate_batch([clamp_individual(individual)], cache, backtest_map, raw_results)[0]
+
+    def batch_map(func, individuals):
+        # Поколение оценивается целиком, чтобы исключить повторные бэктесты одинаковых индивидов
+        return evaluate_batch([clamp_individual(ind) for ind in individuals], cache, backtest_map, raw_results)
+
+    # Регистрация функций в toolbox
+    toolbox.register("evaluate", evaluate)
+    if bounded:
+        toolbox.register("mate", mate_bounded)
+        toolbox.register("mutate", mutate_bounded, indpb=1.0 / len(GENE_BOUNDS))
+    else:
+        toolbox.register("mate", tools.cxBlend, alpha=0.5)
+        toolbox.register("mutate", tools.mutGaussian, mu=0, sigma=1, indpb=0.2)
+    toolbox.register("select", tools.selNSGA2)  # Используем NSGA-II для многокритериальной селекции.
+
+    toolbox.register("map", batch_map)
+    return toolbox
+
+def create_stats():
+    """Статистика поколения для журнала DEAP."""
+    stats = tools.Statistics(lambda ind: ind.fitness.values)
+    stats.register("avg", lambda values: (sum(v[0] for v in values) / len(values),
+                                           sum(v[1] for v in values) / len(values)))
+    stats.register("min", min)
+    stats.register("max", max)
+    return stats
+
+def run_ga_optimization(workers=None, seed=None, cache_size=4096, persistent_cache=False, engine='backtrader',
+                        bar_store=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME,
+                        population_size=10, ngen=10, checkpoint=None, checkpoint_every=1, resume=False,
+                        prune=None, data=None, algorithm='simple', patience=5, min_diversity=0.05,
+                        surrogate=None):
+    """Используется генетический алгоритм для мультиобъектной оптимизации параметров торговой стратегии.
+
+    workers - количество процессов для параллельной оценки индивидов (None или 1 - последовательно).
+    seed - начальное значение генератора случайных чисел для воспроизводимости результатов.
+    cache_size - максимальное число результатов бэктеста в кэше фитнеса.
+    persistent_cache - хранить кэш фитнеса в SQLite для повторных запусков на тех же данных.
+    engine - движок бэктеста: 'backtrader' или быстрый векторный 'numpy'.
+    bar_store - каталог хранилища баров для чтения данных через np.memmap вместо SQLite.
+    symbol, timeframe - инструмент и таймфрейм, если данные читаются из SQLite.
+    population_size, ngen - размер популяции и количество поколений.
+    checkpoint - файл контрольной точки, которая сохраняется каждые checkpoint_every поколений:
+    популяция, зал славы, журнал, состояние генератора случайных чисел и границы нормализации.
+    resume - продолжить с контрольной точки, если она есть (результат совпадает с запуском без прерывания).
+    prune - правила досрочной остановки заведомо плохих бэктестов (vector_backtest.PruneRules),
+    например PruneRules(max_drawdown=0.3, checkpoints=(0.25, 0.5), min_trades=1); None - без остановки.
+    data - бары для оптимизации (например, обучающее окно walk-forward); по умолчанию
+    загружаются из bar_store или SQLite. С workers > 1 воркеры загружают данные сами, поэтому
+    вместе с workers передавать data нельзя.
+    algorithm - 'simple' (цикл eaSimple с cxBlend и mutGaussian) или 'nsga2' (цикл eaMuPlusLambda
+    с отбором NSGA-II из родителей и потомков, скрещиванием SBX и мутацией в границах генов).
+    В режиме 'nsga2' оптимизация останавливается, если фронт Парето не улучшался patience поколений
+    (None - всегда ngen поколений), а при разнообразии популяции ниже min_diversity
+    (см. population_diversity) все индивиды вне фронта Парето заменяются случайными.
+    surrogate - доля (0, 1] новых наборов параметров поколения, которые получают настоящий бэктест;
+    остальные отсеиваются по предсказанию k-NN модели (surrogate.KNNSurrogate), обученной на всех
+    выполненных бэктестах: в 'simple' отсеянный потомок заменяется родителем, в 'nsga2' отбрасывается.
+    None - без суррогатной модели.
+    Результат запуска сохраняется в таблицу ga_runs."""
+
+    started_at = datetime.now()
+    reset_normalization()
+    if seed is not None:
+        random.seed(seed)
+
+    # Создается многоцелевую фитнес-функцию
+    create_types()
+
+    # Данные загружаются один раз на весь запуск оптимизации
+    if data is None:
+        data = load_bars(bar_store, symbol, timeframe)
+    elif workers is not None and workers > 1:
+        raise ValueError('Параметр data несовместим с workers > 1')
+    fingerprint = dataset_fingerprint(data)
+    if prune is not None:
+        # Результаты с досрочной остановкой не должны попадать в кэш полных прогонов
+        fingerprint = f'{fingerprint}:{tuple(prune)}'
+    cache = FitnessCache(fingerprint, maxsize=cache_size, persistent=persistent_cache)
+
+    pool = None
+    if workers is not None and workers > 1:
+        # Бэктесты выполняются в пуле процессов, а нормализация - в главном процессе по порядку
+        pool = multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(engine, bar_store, symbol, timeframe, prune))
+
+    def backtest_map(params_list):
+        # Получаем результат backtest: доходность и процент прибыльных сделок
+        if not params_list:
+            return []
+        if engine == 'numpy':
+            # Векторный движок оценивает наборы пакетно: по одному пакету на воркер
+            if pool is None:
+                return [tuple(row) for row in run_backtest_batch(params_list, data=data, prune=prune).tolist()]
+            size = -(-len(params_list) // workers)
+            chunks = [params_list[i:i + size] for i in range(0, len(params_list), size)]
+            return [result for chunk in pool.map(_worker_backtest_batch, chunks) for result in chunk]
+        if pool is not None:
+            return pool.map(_worker_backtest, params_list)
+        return [run_backtest(*params, data=data, engine=engine, prune=prune) for params in params_list]
+
+    nsga2 = algorithm == 'nsga2'
+    raw_results = {}  # Исходные результаты бэктеста для переоценки по общим границам нормализации
+    toolbox = create_toolbox(cache, backtest_map, bounded=nsga2, raw_results=raw_results)
+
+    stats = create_stats()
+    cxpb, mutpb = (NSGA2_CXPB, NSGA2_MUTPB) if nsga2 else (0.8, 0.2)
+    stall = 0  # Поколений без улучшения фронта Парето
+    front_results = []  # Результаты бэктеста фронта Парето текущей популяции
+    model = KNNSurrogate(GENE_BOUNDS) if surrogate is not None else None
+    surrogate_saved = 0  # Бэктестов, которых удалось избежать благодаря суррогатной модели
+
+    def evaluate_invalid(individuals):
+        invalid_ind = [ind for ind in individuals if not ind.fitness.valid]
+        for ind, fit in zip(invalid_ind, toolbox.map(toolbox.evaluate, invalid_ind)):
+            ind.fitness.values = fit
+        if model is not None:
+            model.update(raw_results)
+        return len(invalid_ind)
+
+    def screen(offspring):
+        # Новые наборы параметров ранжируются по предсказанной оценке, бэктест получает доля surrogate лучших.
+        # Возвращает номера отсеянных потомков и предсказания для оставленных наборов
+        nonlocal surrogate_saved
+        if model is None or len(model) < SURROGATE_MIN_SAMPLES:
+            return set(), {}
+        candidates = {}
+        for idx, ind in enumerate(offspring):
+            if not ind.fitness.valid:
+                params = clamp_individual(ind)
+                if params not in raw_results:
+                    candidates.setdefault(params, []).append(idx)
+        if not candidates:
+            return set(), {}
+        params_list = list(candidates)
+        predicted = model.predict(params_list).tolist()
+        scores = [sum(normalized_score(*result)) for result in predicted]
+        order = sorted(range(len(params_list)), key=lambda i: scores[i], reverse=True)
+        keep = math.ceil(surrogate * len(params_list))
+        surrogate_saved += len(params_list) - keep
+        rejected = {idx for i in order[keep:] for idx in candidates[params_list[i]]}
+        return rejected, {params_list[i]: (predicted[i], scores[i]) for i in order[:keep]}
+
+    def report_surrogate(kept, rejected):
+        # Точность суррогатной модели на наборах, получивших настоящий бэктест
+        if not kept:
+            return
+        actual = [raw_results[params] for params in kept]
+        mae = sum(abs(prediction[0] - result[0]) for (prediction, _), result in zip(kept.values(), actual)) / len(kept)
+        correlation = rank_correlation([score for _, score in kept.values()],
+                                       [sum(normalized_score(*result)) for result in actual])
+        print(f'Суррогатная модель: бэктестов {len(kept)}, отсеяно потомков {len(rejected)}, '
+              f'сэкономлено бэктестов всего {surrogate_saved}, ошибка доходности (MAE) {mae:.2f}, '
+              f'ранговая корреляция {correlation if correlation is None else round(correlation, 2)}')
+
+    def rescore(individuals):
+        # Оценки, рассчитанные в разных поколениях, приводятся к текущим границам нормализации
+        for ind in individuals:
+            ind.fitness.values = normalized_score(*raw_results[clamp_individual(ind)])
+
+    def pareto_front_results():
+        front = tools.sortNondominated(pop, len(pop), first_front_only=True)[0]
+        return sorted({raw_results[clamp_individual(ind)] for ind in front})
+
+    def nsga2_generation():
+        # Поколение algorithms.eaMuPlusLambda: отбор NSGA-II из родителей и потомков
+        nonlocal stall, front_results
+        offspring = algorithms.varOr(pop, toolbox, population_size, cxpb, mutpb)
+        rejected, kept = screen(offspring)
+        offspring = [ind for idx, ind in enumerate(offspring) if idx not in rejected]
+        nevals = evaluate_invalid(offspring)
+        report_surrogate(kept, rejected)
+        rescore(pop + offspring + hall_of_fame.items)
+        hall_of_fame.update(offspring)
+        pop[:] = toolbox.select(pop + offspring, population_size)
+
+        previous, front_results = front_results, pareto_front_results()
+        improved = any(not _weakly_dominated(result, previous) for result in front_results)
+        stall = 0 if improved else stall + 1
+
+        diversity = population_diversity(pop)
+        if diversity < min_diversity:
+            # Популяция сошлась в одну точку: различные индивиды фронта Парето (не больше половины
+            # популяции) остаются, остальные заменяются случайными
+            front = tools.sortNondominated(pop, len(pop), first_front_only=True)[0]
+            kept = list({tuple(ind): ind for ind in front}.values())[:population_size // 2]
+            pop[:] = kept + toolbox.population(n=population_size - len(kept))
+            nevals += evaluate_invalid(pop)
+            rescore(pop + hall_of_fame.items)
+            hall_of_fame.update(pop)
+            print(f'Разнообразие популяции {diversity:.3f} ниже {min_diversity}, '
+                  f'заменено индивидов: {population_size - len(kept)}')
+            diversity = population_diversity(pop)
+        return nevals, diversity
+
+    def write_checkpoint(gen):
+        save_checkpoint(checkpoint, {'generation': gen, 'seed': seed, 'population': pop, 'halloffame': hall_of_fame,
+                                     'logbook': logbook, 'random_state': random.getstate(),
+                                     'normalization': normalization_state(), 'raw_results': raw_results,
+                                     'stall': stall, 'front_results': front_results,
+                                     'surrogate_saved': surrogate_saved})
+
+    # Запуск алгоритма (цикл algorithms.eaSimple или algorithms.eaMuPlusLambda с контрольными точками)
+    try:
+        state = load_checkpoint(checkpoint) if checkpoint is not None and resume else None
+        if state is not None:
+            pop, hall_of_fame, logbook = state['population'], state['halloffame'], state['logbook']
+            random.setstate(state['random_state'])
+            restore_normalization(state['normalization'])
+            raw_results.update(state.get('raw_results', {}))
+            stall, front_results = state.get('stall', 0), state.get('front_results', [])
+            surrogate_saved = state.get('surrogate_saved', 0)
+            if model is not None:
+                model.update(raw_results)
+            start_gen = state['generation'] + 1
+            seed = state['seed']
+            print(f'Продолжение с поколения {start_gen} ({checkpoint})')
+        else:
+            pop = toolbox.population(n=population_size)
+            hall_of_fame = tools.HallOfFame(1)
+            logbook = tools.Logbook()
+            logbook.header = ['gen', 'nevals'] + (['diversity'] if nsga2 else []) + stats.fields
+
+            nevals = evaluate_invalid(pop)
+            extra = {}
+            if nsga2:
+                rescore(pop)
+                # Отбор NSGA-II назначает начальной популяции ранги и расстояния скученности
+                pop[:] = toolbox.select(pop, population_size)
+                front_results = pareto_front_results()
+                extra['diversity'] = population_diversity(pop)
+            hall_of_fame.update(pop)
+            logbook.record(gen=0, nevals=nevals, **extra, **stats.compile(pop))
+            print(logbook.stream)
+            cache.flush()
+            if checkpoint is not None:
+                write_checkpoint(0)
+            start_gen = 1
+
+        last_gen = start_gen - 1
+        for gen in range(start_gen, ngen + 1):
+            if nsga2 and patience is not None and stall >= patience:
+                print(f'Фронт Парето не улучшался {stall} поколений, оптимизация остановлена')
+                break
+            last_gen = gen
+            extra = {}
+            if nsga2:
+                nevals, extra['diversity'] = nsga2_generation()
+            else:
+                selected = toolbox.select(pop, len(pop))
+                offspring = algorithms.varAnd(selected, toolbox, cxpb, mutpb)
+                rejected, kept = screen(offspring)
+                for idx in rejected:
+                    offspring[idx] = toolbox.clone(selected[idx])  # Отсеянный потомок заменяется родителем
+                nevals = evaluate_invalid(offspring)
+                report_surrogate(kept, rejected)
+                hall_of_fame.update(offspring)
+                pop[:] = offspring
+
+            logbook.record(gen=gen, nevals=nevals, **extra, **stats.compile(pop))
+            print(logbook.stream)
+            cache.flush()  # Результаты поколения записываются в базу одной транзакцией
+            if checkpoint is not None and (gen % checkpoint_every == 0 or gen == ngen):
+                write_checkpoint(gen)
+    finally:
+        cache.flush()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print(cache.stats())
+    if model is not None:
+        print(f'Суррогатная модель: сэкономлено бэктестов {surrogate_saved}')
+    if pool is None:
+        print(get_indicator_store(data).stats())
+
+    best_ind = hall_of_fame[0]
+    best_params = clamp_individual(best_ind)
+    result = cache.get(best_params)
+    if result is None:  # Результат мог быть вытеснен из кэша
+        result = run_backtest(*best_params, data=data, engine=engine, prune=prune)
+    total_profit, profitable_trades_percentage = result
+    save_ga_run(started_at=started_at, finished_at=datetime.now(), symbol=symbol, timeframe=timeframe,
+                engine=engine, seed=seed, population_size=population_size, generations=last_gen,
+                params=','.join(map(str, best_ind)), total_profit=total_profit,
+                profitable_trades_percentage=profitable_trades_percentage, backtests=cache.misses,
+                logbook=json.dumps(list(logbook)))
+    return best_ind
+
+def run_batch_optimization(instruments, **kwargs):
+    """Оптимизация параметров стратегии для нескольких инструментов подряд.
+
+    instruments - список пар (инструмент, таймфрейм). Каждая пара выгружается в свой раздел
+    хранилища баров, поэтому воркеры читают только бары своего инструмента.
+    Остальные аргументы передаются в run_ga_optimization. Возвращает словарь
+    {(инструмент, таймфрейм): лучший индивид}."""
+    results = {}
+    for symbol, timeframe in instruments:
+        print(f'Оптимизация {symbol} {timeframe}')
+        bar_store = refresh_bar_store(symbol=symbol, timeframe=timeframe)
+        results[(symbol, timeframe)] = run_ga_optimization(bar_store=bar_store, symbol=symbol,
+                                                           timeframe=timeframe, **kwargs)
+    return results
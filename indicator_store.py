@@ -0,0 +1,115 @@
+# indicator_store.py
+# Хранилище заранее рассчитанных рядов индикаторов, общее для всех особей генетического алгоритма.
+# Оптимизатор перебирает лишь несколько периодов в небольших целочисленных диапазонах,
+# поэтому каждый ряд (индикатор, период) рассчитывается один раз на набор данных и затем
+# переиспользуется всеми бэктестами. Объем хранилища ограничен бюджетом памяти (LRU).
+from collections import OrderedDict
+import numpy as np
+from indicators import bars_to_arrays, ema, stochastic_k, macd, rsi, pivot_levels
+
+# Функции расчета индикаторов по имени: (хранилище, период) -> кортеж массивов
+INDICATORS = {
+    'ema': lambda store, period: (ema(store.closes, period),),
+    'stoch_k': lambda store, period: (stochastic_k(store.highs, store.lows, store.closes, period),),
+    'macd': lambda store, period: macd(store.closes),
+    'rsi': lambda store, period: (rsi(store.closes, period),),
+    # Крайние цены бара для поиска бара исполнения стоп- и лимит-ордеров
+    'fill_low': lambda store, period: (np.minimum(store.opens, store.lows),),
+    'fill_high': lambda store, period: (np.maximum(store.opens, store.highs),),
+    # Уровни Pivot Points по всему ряду (до начала торговли стратегии уровни не используются)
+    'pivot': lambda store, period: pivot_levels(store.highs, store.lows, store.closes, period),
+    # Таблица поиска бара исполнения для многих ордеров сразу (run_vector_backtest_batch)
+    'fill_search': lambda store, period: _fill_search_table(store),
+}
+
+# Длина блока таблицы поиска бара исполнения
+FILL_SEARCH_BLOCK = 64
+
+# Бюджет памяти хранилища по умолчанию (в байтах)
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class IndicatorStore:
+    """Кэш рядов индикаторов для одного набора данных с ограничением по памяти."""
+
+    def __init__(self, data, max_bytes=DEFAULT_MAX_BYTES):
+        self.data = data
+        self.opens, self.highs, self.lows, self.closes = bars_to_arrays(data)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._series = OrderedDict()
+
+    def get(self, name, period=None):
+        """Получение ряда индикатора; для MACD и Pivot Points возвращается пара рядов."""
+        key = (name, period)
+        if key in self._series:
+            self._series.move_to_end(key)
+            self.hits += 1
+            series = self._series[key]
+        else:
+            self.misses += 1
+            try:
+                series = INDICATORS[name](self, period)
+            except ZeroDivisionError:
+                # Запоминаем и ошибку, чтобы не пересчитывать заведомо невалидный период
+                series = None
+            else:
+                for values in series:
+                    values.setflags(write=False)  # Ряды общие для всех бэктестов
+            self._remember(key, series)
+
+        if series is None:
+            raise ZeroDivisionError('float division by zero')
+        return series if len(series) > 1 else series[0]
+
+    def _remember(self, key, series):
+        self._series[key] = series
+        self.nbytes += _series_nbytes(series)
+        while self.nbytes > self.max_bytes and len(self._series) > 1:
+            _, evicted = self._series.popitem(last=False)
+            self.nbytes -= _series_nbytes(evicted)
+
+    def stats(self):
+        """Статистика использования хранилища."""
+        return (f'Хранилище индикаторов: рядов={len(self._series)}, '
+                f'память={self.nbytes / 1024 / 1024:.1f} МБ, попаданий={self.hits}, промахов={self.misses}')
+
+
+def _fill_search_table(store):
+    """Ряды max(open, high) и -min(open, low), по которым ищется первый бар исполнения стоп- и
+    лимит-ордеров: ордер исполняется на баре, где значение ряда не меньше порога.
+
+    values - ряды, дополненные -inf до целого числа блоков FILL_SEARCH_BLOCK и еще одного пустого
+    блока; levels[l, ряд, b] - максимум ряда по блокам с b по b + 2**l - 1 (разреженная таблица),
+    дополненный -inf так, чтобы поиск мог перешагнуть последний блок на любое число блоков уровня."""
+    n = len(store.closes)
+    nblocks = -(-n // FILL_SEARCH_BLOCK)
+    values = np.full((2, (nblocks + 1) * FILL_SEARCH_BLOCK), -np.inf)
+    values[0, :n] = np.maximum(store.opens, store.highs)
+    values[1, :n] = -np.minimum(store.opens, store.lows)
+    nlevels = nblocks.bit_length()
+    level = np.full((2, nblocks + 1 + (1 << nlevels)), -np.inf)
+    level[:, :nblocks + 1] = values.reshape(2, nblocks + 1, FILL_SEARCH_BLOCK).max(axis=2)
+    levels = [level]
+    for width in (1 << l for l in range(nlevels - 1)):
+        level = np.maximum(level, np.concatenate([level[:, width:], np.full((2, width), -np.inf)], axis=1))
+        levels.append(level)
+    return values, np.stack(levels)
+
+
+def _series_nbytes(series):
+    return sum(values.nbytes for values in series) if series is not None else 0
+
+
+# Хранилище текущего процесса (у каждого воркера оптимизатора - свое)
+_store = None
+
+
+def get_indicator_store(data, max_bytes=DEFAULT_MAX_BYTES):
+    """Хранилище индикаторов для набора данных; пересоздается при смене набора."""
+    global _store
+    if _store is None or _store.data is not data:
+        _store = IndicatorStore(data, max_bytes=max_bytes)
+    return _store
@@ -0,0 +1,175 @@
+# indicators.py
+# Индикаторы стратегии EMAStochMACDRSI, рассчитываемые массивами NumPy по всему ряду сразу.
+# Формулы, затравочные значения и порядок операций совпадают с индикаторами backtrader,
+# поэтому значения совпадают с ними побитово.
+import math
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# Параметры MACD по умолчанию (bt.indicators.MACD)
+MACD_FAST = 12
+MACD_SLOW = 26
+MACD_SIGNAL = 9
+# Периоды сглаживания bt.indicators.Stochastic
+STOCH_DFAST = 3
+STOCH_DSLOW = 3
+
+
+def bars_to_arrays(data):
+    """Массивы цен open, high, low, close из DataFrame (database.get_bars)
+    или списка кортежей (дата, open, high, low, close, volume)."""
+    if isinstance(data, pd.DataFrame):
+        return tuple(data[column].to_numpy(dtype=np.float64)
+                     for column in ('open_price', 'high_price', 'low_price', 'close_price'))
+    prices = np.array([row[1:5] for row in data], dtype=np.float64).reshape(-1, 4)
+    return prices[:, 0], prices[:, 1], prices[:, 2], prices[:, 3]
+
+
+def sma(values, period):
+    """Простая скользящая средняя (как bt.indicators.SMA, через math.fsum)."""
+    result = np.full(len(values), np.nan)
+    start = _first_valid(values) + period - 1
+    for i in range(start, len(values)):
+        result[i] = math.fsum(values[i - period + 1:i + 1]) / period
+    return result
+
+
+def exp_smoothing(values, period, alpha):
+    """Экспоненциальное сглаживание с затравкой из SMA (как bt.indicators.ExponentialSmoothing)."""
+    result = np.full(len(values), np.nan)
+    start = _first_valid(values) + period - 1
+    if start >= len(values):
+        return result
+    alpha1 = 1.0 - alpha
+    prev = math.fsum(values[start - period + 1:start + 1]) / period
+    out = [prev]
+    for value in values[start + 1:].tolist():
+        prev = prev * alpha1 + value * alpha
+        out.append(prev)
+    result[start:] = out
+    return result
+
+
+def ema(values, period):
+    """Экспоненциальная скользящая средняя (bt.indicators.EMA)."""
+    return exp_smoothing(values, period, 2.0 / (1.0 + period))
+
+
+def smma(values, period):
+    """Сглаженная скользящая средняя Уайлдера (bt.indicators.SMMA)."""
+    return exp_smoothing(values, period, 1.0 / period)
+
+
+def _rolling_extreme(values, period, ufunc, fill):
+    """Скользящий экстремум за O(n) независимо от period (алгоритм ван Херка - Гил - Вермана).
+
+    Ряд разбивается на блоки длины period; экстремум окна равен экстремуму суффикса
+    одного блока и префикса следующего, которые считаются накоплением по блокам."""
+    n = len(values)
+    result = np.full(n, np.nan)
+    if n < period:
+        return result
+    blocks = np.concatenate([values, np.full(-n % period, fill)]).reshape(-1, period)
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    result[period - 1:] = ufunc(suffix[:n - period + 1], prefix[period - 1:n])
+    return result
+
+
+def rolling_max(values, period):
+    """Максимум за последние period значений (bt.indicators.Highest)."""
+    return _rolling_extreme(values, period, np.maximum, -np.inf)
+
+
+def rolling_min(values, period):
+    """Минимум за последние period значений (bt.indicators.Lowest)."""
+    return _rolling_extreme(values, period, np.minimum, np.inf)
+
+
+class RollingWindow:
+    """Максимум high и минимум low за последние period баров при поступлении баров по одному.
+
+    Экстремумы хранятся в монотонных очередях, поэтому добавление бара стоит
+    амортизированно O(1) вместо пересчета max()/min() по всему окну."""
+    __slots__ = ('period', 'count', '_highs', '_lows')
+
+    def __init__(self, period):
+        self.period = period
+        self.count = 0  # Сколько баров добавлено всего
+        self._highs = deque()  # Пары (номер бара, high) с убывающими high
+        self._lows = deque()  # Пары (номер бара, low) с возрастающими low
+
+    def append(self, high, low):
+        idx = self.count
+        self.count += 1
+        highs, lows = self._highs, self._lows
+        while highs and highs[-1][1] <= high:
+            highs.pop()
+        highs.append((idx, high))
+        while lows and lows[-1][1] >= low:
+            lows.pop()
+        lows.append((idx, low))
+        # Из окна выходит бар idx - period
+        if highs[0][0] <= idx - self.period:
+            highs.popleft()
+        if lows[0][0] <= idx - self.period:
+            lows.popleft()
+
+    def full(self):
+        """Окно заполнено period барами."""
+        return self.count >= self.period
+
+    @property
+    def high(self):
+        return self._highs[0][1]
+
+    @property
+    def low(self):
+        return self._lows[0][1]
+
+
+def stochastic_k(high, low, close, period):
+    """Линия %K медленного стохастика (bt.indicators.Stochastic.percK)."""
+    highest = rolling_max(high, period)
+    lowest = rolling_min(low, period)
+    knum = close - lowest
+    kden = highest - lowest
+    if np.any(kden[period - 1:] == 0):
+        # backtrader без safediv падает на делении на ноль, run_backtest обрабатывает это исключение
+        raise ZeroDivisionError('float division by zero')
+    k = 100.0 * (knum / kden)
+    return sma(k, STOCH_DFAST)
+
+
+def macd(close):
+    """Линии MACD и сигнальная (bt.indicators.MACD с параметрами по умолчанию)."""
+    macd_line = ema(close, MACD_FAST) - ema(close, MACD_SLOW)
+    return macd_line, ema(macd_line, MACD_SIGNAL)
+
+
+def rsi(close, period):
+    """Индекс относительной силы (bt.indicators.RSI со сглаживанием Уайлдера)."""
+    upday = np.full(len(close), np.nan)
+    downday = np.full(len(close), np.nan)
+    upday[1:] = np.maximum(close[1:] - close[:-1], 0.0)
+    downday[1:] = np.maximum(close[:-1] - close[1:], 0.0)
+    maup = smma(upday, period)
+    madown = smma(downday, period)
+    if np.any(madown[period:] == 0):
+        raise ZeroDivisionError('float division by zero')
+    rs = maup / madown
+    return 100.0 - 100.0 / (1.0 + rs)
+
+
+def pivot_levels(high, low, close, period):
+    """Уровни R1 и S1 Pivot Points по максимуму и минимуму за последние period баров и закрытию бара."""
+    highest = rolling_max(high, period)
+    lowest = rolling_min(low, period)
+    pp = (highest + lowest + close) / 3
+    return 2 * pp - lowest, 2 * pp - highest
+
+
+def _first_valid(values):
+    valid = np.flatnonzero(~np.isnan(values))
+    return valid[0] if len(valid) else len(values)
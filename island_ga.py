@@ -0,0 +1,228 @@
+# island_ga.py
+# Островная модель генетического алгоритма: несколько подпопуляций эволюционируют независимо
+# в отдельных процессах (или на отдельных машинах) и раз в migration_interval поколений
+# передают лучших индивидов соседнему острову по кольцу. Острова обмениваются только
+# мигрантами, поэтому вычисления масштабируются почти линейно с числом процессов.
+import queue
+import random
+import time
+import traceback
+import multiprocessing
+from multiprocessing.managers import BaseManager
+from deap import algorithms, creator, tools
+import ga_optimization as ga
+from backtest import run_backtest, run_backtest_batch
+from database import DEFAULT_SYMBOL, DEFAULT_TIMEFRAME, load_bars
+from fitness_cache import FitnessCache, dataset_fingerprint
+
+# Адрес и ключ брокера очередей по умолчанию для запуска островов на разных машинах
+BROKER_ADDRESS = ('127.0.0.1', 50000)
+BROKER_AUTHKEY = b'ga-islands'
+
+# Сколько секунд остров ждет мигрантов от соседа, прежде чем продолжить без них
+MIGRATION_TIMEOUT = 600
+
+# Как часто (в секундах) проверяются результаты и процессы островов
+RESULT_POLL_INTERVAL = 1
+
+
+def run_island(island_id, inbox, outbox, population_size=10, ngen=10, migration_interval=2, migrants=1,
+               cxpb=0.8, mutpb=0.2, seed=None, engine='numpy', bar_store=None,
+               symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME, verbose=False):
+    """Эволюция одного острова; возвращает лучших индивидов с результатами бэктеста.
+
+    inbox - очередь, из которой приходят мигранты, outbox - очередь соседнего острова.
+    Нормализация оценок у каждого острова своя, поэтому мигранты оцениваются заново
+    (повторного бэктеста нет, если набор параметров уже есть в кэше фитнеса)."""
+    ga.reset_normalization()
+    if seed is not None:
+        random.seed(seed + island_id)
+    ga.create_types()
+
+    data = load_bars(bar_store, symbol, timeframe)
+    cache = FitnessCache(dataset_fingerprint(data))
+
+    def backtest_map(params_list):
+        if engine == 'numpy' and params_list:
+            return [tuple(row) for row in run_backtest_batch(params_list, data=data).tolist()]
+        return [run_backtest(*params, data=data, engine=engine) for params in params_list]
+
+    toolbox = ga.create_toolbox(cache, backtest_map)
+    stats = ga.create_stats()
+    hall_of_fame = tools.HallOfFame(migrants)
+    logbook = tools.Logbook()
+    logbook.header = ['gen', 'nevals'] + stats.fields
+
+    def evaluate(individuals):
+        invalid = [ind for ind in individuals if not ind.fitness.valid]
+        for ind, fit in zip(invalid, toolbox.map(toolbox.evaluate, invalid)):
+            ind.fitness.values = fit
+        return len(invalid)
+
+    pop = toolbox.population(n=population_size)
+    nevals = evaluate(pop)
+    received = 0  # Получено мигрантов от соседа
+    hall_of_fame.update(pop)
+    logbook.record(gen=0, nevals=nevals, **stats.compile(pop))
+
+    # Тот же цикл, что и в algorithms.eaSimple, с миграцией между поколениями
+    for gen in range(1, ngen + 1):
+        offspring = toolbox.select(pop, len(pop))
+        offspring = algorithms.varAnd(offspring, toolbox, cxpb, mutpb)
+        nevals = evaluate(offspring)
+        hall_of_fame.update(offspring)
+        pop[:] = offspring
+
+        if migration_interval and gen % migration_interval == 0 and gen < ngen:
+            outbox.put([list(ind) for ind in tools.selBest(pop, migrants)])
+            try:
+                arrived = inbox.get(timeout=MIGRATION_TIMEOUT)
+            except queue.Empty:
+                arrived = []
+            received += len(arrived)
+            # Мигранты заменяют худших индивидов острова
+            for worst, genes in zip(tools.selWorst(pop, len(arrived)), arrived):
+                pop[pop.index(worst)] = creator.Individual(genes)
+            nevals += evaluate(pop)
+
+        logbook.record(gen=gen, nevals=nevals, **stats.compile(pop))
+        if verbose:
+            print(f'Остров {island_id}: {logbook.stream}')
+
+    best = []
+    for ind in hall_of_fame:
+        params = ga.clamp_individual(ind)
+        result = cache.get(params)
+        if result is None:  # Результат мог быть вытеснен из кэша
+            result = backtest_map([params])[0]
+        best.append((params, result))
+    return {'island': island_id, 'best': best, 'evaluations': cache.misses, 'migrants': received,
+            'logbook': logbook}
+
+
+def _island_error(island_id):
+    """Сообщение об ошибке острова для очереди результатов (вместо результата run_island)."""
+    return {'island': island_id, 'error': traceback.format_exc()}
+
+
+def _island_process(island_id, inbox, outbox, results, kwargs):
+    try:
+        result = run_island(island_id, inbox, outbox, **kwargs)
+    except Exception:
+        result = _island_error(island_id)
+    results.put(result)
+
+
+def _collect_results(results, islands, processes=(), timeout=None):
+    """Ожидание результатов islands островов из очереди results.
+
+    Очередь опрашивается раз в RESULT_POLL_INTERVAL секунд; RuntimeError выбрасывается сразу,
+    если остров сообщил об ошибке, процесс острова из processes аварийно завершился
+    или за timeout секунд (None - без ограничения) пришли не все результаты."""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    island_results = []
+    while len(island_results) < islands:
+        try:
+            result = results.get(timeout=RESULT_POLL_INTERVAL)
+        except queue.Empty:
+            # Процесс, завершившийся с кодом 0, всегда успевает отправить результат или ошибку
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    raise RuntimeError(f'Процесс острова {process.name} завершился с кодом {process.exitcode}')
+            if deadline is not None and time.monotonic() > deadline:
+                raise RuntimeError(f'За {timeout} с получены результаты {len(island_results)} островов из {islands}')
+            continue
+        if 'error' in result:
+            raise RuntimeError(f'Ошибка на острове {result["island"]}:\n{result["error"]}')
+        island_results.append(result)
+    return island_results
+
+
+def _select_best(island_results):
+    """Лучший набор параметров среди островов.
+
+    Оценки островов нормализованы по-разному, поэтому наборы сравниваются по исходным
+    результатам бэктеста: сначала доходность, затем процент прибыльных сделок
+    (тот же порядок, что и у HallOfFame с лексикографическим сравнением фитнеса)."""
+    candidates = [(params, result) for island in island_results for params, result in island['best']]
+    params, result = max(candidates, key=lambda candidate: candidate[1])
+    for island in sorted(island_results, key=lambda island: island['island']):
+        print(f'Остров {island["island"]}: бэктестов={island["evaluations"]}, мигрантов={island["migrants"]}, '
+              f'лучший={island["best"][0]}')
+    print(f'Лучшие параметры островов: {params}, результат: {result}')
+    return creator.Individual(params)
+
+
+def run_island_optimization(islands=4, population_size=10, ngen=10, migration_interval=2, migrants=1,
+                            seed=None, **kwargs):
+    """Островная оптимизация на локальной машине: по процессу на остров.
+
+    islands - количество островов, population_size - размер популяции каждого острова,
+    migration_interval - через сколько поколений острова обмениваются migrants лучшими индивидами.
+    Остальные аргументы (engine, bar_store, symbol, timeframe, cxpb, mutpb, verbose) передаются в run_island.
+    Возвращает лучшего индивида."""
+    ga.create_types()
+    kwargs.update(population_size=population_size, ngen=ngen, migration_interval=migration_interval,
+                  migrants=migrants, seed=seed)
+    inboxes = [multiprocessing.Queue() for _ in range(islands)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_island_process, name=f'island-{i}',
+                                         args=(i, inboxes[i], inboxes[(i + 1) % islands], results, kwargs))
+                 for i in range(islands)]
+    for process in processes:
+        process.start()
+    try:
+        island_results = _collect_results(results, islands, processes)
+    except BaseException:
+        # Остальные острова без упавшего не завершатся (ждут мигрантов), поэтому останавливаются
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+    return _select_best(island_results)
+
+
+# Брокер очередей для островов на разных машинах: у каждого острова своя входящая очередь,
+# плюс общая очередь результатов
+class IslandBroker(BaseManager):
+    pass
+
+
+def serve_island_broker(islands, address=BROKER_ADDRESS, authkey=BROKER_AUTHKEY):
+    """Запуск брокера очередей (блокирует текущий процесс)."""
+    inboxes = [queue.Queue() for _ in range(islands)]
+    results = queue.Queue()
+    IslandBroker.register('get_inbox', callable=lambda island_id: inboxes[island_id])
+    IslandBroker.register('get_results', callable=lambda: results)
+    IslandBroker(address=address, authkey=authkey).get_server().serve_forever()
+
+
+def _connect_broker(address, authkey):
+    IslandBroker.register('get_inbox')
+    IslandBroker.register('get_results')
+    broker = IslandBroker(address=address, authkey=authkey)
+    broker.connect()
+    return broker
+
+
+def run_island_node(island_id, islands, address=BROKER_ADDRESS, authkey=BROKER_AUTHKEY, **kwargs):
+    """Запуск одного острова на узле, подключенном к брокеру; результат (или ошибка) отправляется брокеру."""
+    broker = _connect_broker(address, authkey)
+    try:
+        result = run_island(island_id, broker.get_inbox(island_id), broker.get_inbox((island_id + 1) % islands),
+                            **kwargs)
+    except Exception:
+        broker.get_results().put(_island_error(island_id))
+        raise
+    broker.get_results().put(result)
+    return result
+
+
+def collect_island_results(islands, address=BROKER_ADDRESS, authkey=BROKER_AUTHKEY, timeout=None):
+    """Ожидание результатов всех островов через брокер (не дольше timeout секунд, None - без ограничения);
+    возвращает лучшего индивида."""
+    ga.create_types()
+    results = _connect_broker(address, authkey).get_results()
+    return _select_best(_collect_results(results, islands, timeout=timeout))
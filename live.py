@@ -0,0 +1,389 @@
+# live.py
+# Режим реального времени: бары поступают по одному из источника (дописываемый файл или
+# локальный сокет), индикаторы стратегии EMAStochMACDRSI обновляются инкрементально за O(1)
+# на бар, сигналы исполняются бумажным брокером той же модели, что и в vector_backtest.
+# Cerebro не перезапускается, а бары пачками дописываются в stock_data фоновым потоком BarWriter,
+# так что запись в базу не задерживает расчет сигнала.
+import argparse
+import math
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from indicators import MACD_FAST, MACD_SLOW, MACD_SIGNAL, STOCH_DFAST, RollingWindow
+from vector_backtest import _Broker, strategy_minperiod, submit_orders
+from database import DEFAULT_SYMBOL, DEFAULT_TIMEFRAME, append_bars, fetch_ga_runs, get_bars
+import telegram_bot
+
+# Параметры по умолчанию, если нет сохраненных запусков оптимизатора
+DEFAULT_PARAMS = (10, 30, 14, 14, 80, 20, 70, 30)
+
+# Бары пишутся в базу пачкой, когда их накопилось FLUSH_BARS или прошло FLUSH_SECONDS
+FLUSH_BARS = 100
+FLUSH_SECONDS = 5.0
+
+# Адрес локального сокета, на который подаются бары
+SOCKET_ADDRESS = ('127.0.0.1', 9009)
+
+
+def parse_bar(line):
+    """Бар (дата, open, high, low, close, volume) из строки в формате data_output.txt; None для заголовка."""
+    fields = line.split('\t')
+    if len(fields) < 6 or fields[0] == 'DATETIME':
+        return None
+    return (datetime.fromisoformat(fields[0]), float(fields[1]), float(fields[2]),
+            float(fields[3]), float(fields[4]), int(float(fields[5])))
+
+
+class FileTailSource:
+    """Источник баров из дописываемого файла (как tail -f)."""
+
+    def __init__(self, path, poll_interval=0.2, from_start=False):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.from_start = from_start
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def __iter__(self):
+        with open(self.path, 'r') as file:
+            if not self.from_start:
+                file.seek(0, os.SEEK_END)
+            partial = ''
+            while not self._stopped.is_set():
+                line = file.readline()
+                if not line:
+                    self._stopped.wait(self.poll_interval)
+                    continue
+                partial += line
+                if not partial.endswith('\n'):
+                    continue  # Строка дописана не полностью
+                bar = parse_bar(partial.rstrip('\r\n'))
+                partial = ''
+                if bar is not None:
+                    yield bar
+
+
+class SocketSource:
+    """Источник баров из локального TCP-сокета: строки в формате data_output.txt от любого числа
+    последовательных подключений."""
+
+    def __init__(self, address=SOCKET_ADDRESS, poll_interval=0.2):
+        self.address = address
+        self._server = socket.create_server(address)
+        # accept() с таймаутом, чтобы остановка не ждала следующего подключения
+        self._server.settimeout(poll_interval)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def __iter__(self):
+        with self._server:
+            while not self._stopped.is_set():
+                try:
+                    connection, _ = self._server.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                with connection, connection.makefile('r') as lines:
+                    for line in lines:
+                        bar = parse_bar(line.rstrip('\r\n'))
+                        if bar is not None:
+                            yield bar
+
+
+class ExpSmoothing:
+    """Экспоненциальное сглаживание по одному значению (как indicators.exp_smoothing):
+    затравка - среднее первых period значений через math.fsum, NaN до затравки."""
+    __slots__ = ('period', 'alpha', 'alpha1', 'value', '_seed')
+
+    def __init__(self, period, alpha):
+        self.period = period
+        self.alpha = alpha
+        self.alpha1 = 1.0 - alpha
+        self.value = math.nan
+        self._seed = []
+
+    def update(self, value):
+        if self._seed is None:
+            self.value = self.value * self.alpha1 + value * self.alpha
+        elif not math.isnan(value):
+            self._seed.append(value)
+            if len(self._seed) == self.period:
+                self.value = math.fsum(self._seed) / self.period
+                self._seed = None
+        return self.value
+
+
+class SMA:
+    """Простая скользящая средняя по одному значению (как indicators.sma)."""
+    __slots__ = ('period', 'value', '_window')
+
+    def __init__(self, period):
+        self.period = period
+        self.value = math.nan
+        self._window = deque(maxlen=period)
+
+    def update(self, value):
+        if self._window or not math.isnan(value):
+            self._window.append(value)
+            if len(self._window) == self.period:
+                self.value = math.fsum(self._window) / self.period
+        return self.value
+
+
+class LiveIndicators:
+    """Индикаторы стратегии EMAStochMACDRSI с обновлением по одному бару.
+
+    Значения совпадают с рядами indicators.py. Там, где backtrader упал бы на делении на ноль
+    (бары без диапазона цен или без падений), значение индикатора становится NaN и условие
+    сигнала на этом баре не выполняется."""
+
+    def __init__(self, fast_ema_period, slow_ema_period, stoch_period, rsi_period):
+        self.fast = ExpSmoothing(fast_ema_period, 2.0 / (1.0 + fast_ema_period))
+        self.slow = ExpSmoothing(slow_ema_period, 2.0 / (1.0 + slow_ema_period))
+        self.stoch_window = RollingWindow(stoch_period)
+        self.stoch_sma = SMA(STOCH_DFAST)
+        self.macd_fast = ExpSmoothing(MACD_FAST, 2.0 / (1.0 + MACD_FAST))
+        self.macd_slow = ExpSmoothing(MACD_SLOW, 2.0 / (1.0 + MACD_SLOW))
+        self.macd_signal = ExpSmoothing(MACD_SIGNAL, 2.0 / (1.0 + MACD_SIGNAL))
+        self.rsi_up = ExpSmoothing(rsi_period, 1.0 / rsi_period)
+        self.rsi_down = ExpSmoothing(rsi_period, 1.0 / rsi_period)
+        self.prev_close = None
+
+    def update(self, high, low, close):
+        """Обработка бара; возвращает (fast, slow, percK, macd, signal, rsi)."""
+        fast = self.fast.update(close)
+        slow = self.slow.update(close)
+
+        window = self.stoch_window
+        window.append(high, low)
+        k = math.nan
+        if window.full():
+            kden = window.high - window.low
+            if kden != 0:
+                k = 100.0 * ((close - window.low) / kden)
+        perck = self.stoch_sma.update(k)
+
+        macd_line = self.macd_fast.update(close) - self.macd_slow.update(close)
+        signal_line = self.macd_signal.update(macd_line)
+
+        rsi_value = math.nan
+        if self.prev_close is not None:
+            maup = self.rsi_up.update(max(close - self.prev_close, 0.0))
+            madown = self.rsi_down.update(max(self.prev_close - close, 0.0))
+            if madown != 0:
+                rsi_value = 100.0 - 100.0 / (1.0 + maup / madown)
+        self.prev_close = close
+        return fast, slow, perck, macd_line, signal_line, rsi_value
+
+
+class LiveTrader:
+    """Стратегия EMAStochMACDRSI на поступающих барах с бумажным брокером (_Broker из vector_backtest)."""
+
+    def __init__(self, fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+                 stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold,
+                 cash=150000, commission=0.0005, percent=25, max_positions=10, pivot_period=14,
+                 risk_reward_ratio=2.0, notify=True):
+        self.params = (fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+                       stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold)
+        self.indicators = LiveIndicators(fast_ema_period, slow_ema_period, stoch_period, rsi_period)
+        self.broker = _Broker(cash, commission)
+        self.percent = percent
+        self.max_positions = max_positions
+        self.risk_reward_ratio = risk_reward_ratio
+        self.pivot_window = RollingWindow(pivot_period)
+        self.start = strategy_minperiod(fast_ema_period, slow_ema_period, stoch_period, rsi_period) - 1
+        self.notify = notify
+        self.bars = 0
+        self.warmup_bars = 0
+        self.last_date = None
+        self.equity = cash
+        # Время обработки баров в секундах (без записи в базу)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def warmup(self, bars):
+        """Прогрев индикаторов и буфера Pivot Points на истории без сделок."""
+        for date, _, high, low, close, _ in bars:
+            self.indicators.update(high, low, close)
+            if self.bars >= self.start:
+                self.pivot_window.append(high, low)
+            self.bars += 1
+            self.warmup_bars += 1
+            self.last_date = date
+
+    def on_bar(self, bar):
+        """Обработка нового бара; возвращает размер отправленной заявки (>0 покупка, <0 продажа, 0 - нет)."""
+        started = time.perf_counter()
+        date, popen, high, low, close, _ = bar
+        broker = self.broker
+        if broker.pending or broker.submitted or broker.to_activate:
+            broker.next(popen, high, low)
+        fast, slow, perck, macd_line, signal_line, rsi_value = self.indicators.update(high, low, close)
+
+        size = 0
+        if self.bars >= self.start:
+            window = self.pivot_window
+            window.append(high, low)
+            r1 = s1 = 0
+            if window.full():
+                pp = (window.high + window.low + close) / 3
+                r1 = 2 * pp - window.low
+                s1 = 2 * pp - window.high
+            (_, _, _, _, stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold) = self.params
+            buy_signals = ((close > fast and fast > slow) + (perck < stoch_oversold)
+                           + (macd_line > signal_line) + (rsi_value < rsi_oversold))
+            sell_signals = ((close < fast and fast < slow) + (perck > stoch_overbought)
+                            + (macd_line < signal_line) + (rsi_value > rsi_overbought))
+            if buy_signals >= 2 or sell_signals >= 2:
+                size = submit_orders(broker, close, buy_signals >= 2, sell_signals >= 2, r1, s1,
+                                     self.percent, self.max_positions, self.risk_reward_ratio)
+        self.bars += 1
+        self.last_date = date
+        self.equity = broker.value(close)
+
+        elapsed = time.perf_counter() - started
+        self.latency_total += elapsed
+        self.latency_max = max(self.latency_max, elapsed)
+
+        telegram_bot.update_balance(self.equity)
+        if size and self.notify:
+            side = 'LONG' if size > 0 else 'SHORT'
+            telegram_bot.send_message(f'{date}: {side} Entry, Size: {abs(size)}, Price: {close:.2f}, '
+                                      f'Equity: {self.equity:.2f}')
+        return size
+
+    def stats(self):
+        """Статистика задержки обработки баров."""
+        live_bars = max(self.bars - self.warmup_bars, 1)
+        return (f'Баров: {self.bars}, сделок: {self.broker.total_trades}, стоимость портфеля: {self.equity:.2f}, '
+                f'задержка: средняя {self.latency_total / live_bars * 1e6:.1f} мкс, '
+                f'максимальная {self.latency_max * 1e6:.1f} мкс')
+
+
+class BarWriter:
+    """Запись баров в stock_data в фоновом потоке.
+
+    put() не ждет базы: бары копятся в очереди и пишутся одним append_bars, когда их
+    накопилось flush_bars или с первого незаписанного бара прошло flush_seconds."""
+
+    _STOP = object()
+
+    def __init__(self, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME, flush_bars=FLUSH_BARS,
+                 flush_seconds=FLUSH_SECONDS):
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.flush_bars = flush_bars
+        self.flush_seconds = flush_seconds
+        self.written = 0  # Записано баров
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='bar-writer', daemon=True)
+        self._thread.start()
+
+    def put(self, bar):
+        """Постановка бара в очередь на запись."""
+        self._queue.put(bar)
+
+    def close(self, timeout=None):
+        """Запись оставшихся баров и остановка потока."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                bar = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                bar = None
+            if bar is self._STOP:
+                break
+            if bar is not None:
+                if not pending:
+                    deadline = time.monotonic() + self.flush_seconds
+                pending.append(bar)
+            if len(pending) >= self.flush_bars or (pending and time.monotonic() >= deadline):
+                self._write(pending)
+                pending = []
+                deadline = None
+        if pending:
+            self._write(pending)
+
+    def _write(self, bars):
+        try:
+            append_bars(bars, self.symbol, self.timeframe)
+            self.written += len(bars)
+        except Exception as e:
+            print(f'Ошибка записи баров в базу: {e}')
+
+
+def latest_params(symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME):
+    """Лучшие параметры последнего запуска оптимизатора для инструмента (или DEFAULT_PARAMS)."""
+    runs = fetch_ga_runs(symbol, timeframe)
+    if runs and runs[0].params:
+        return tuple(int(value) for value in runs[0].params.split(','))
+    return DEFAULT_PARAMS
+
+
+def run_live(source, params=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME, warmup=True,
+             flush_bars=FLUSH_BARS, flush_seconds=FLUSH_SECONDS, **trader_options):
+    """Торговля на барах из источника до его остановки; возвращает LiveTrader.
+
+    История инструмента из базы прогревает индикаторы, бары не новее последнего известного
+    пропускаются, новые дописываются в stock_data пачками в фоновом потоке (BarWriter)."""
+    trader = LiveTrader(*(params or latest_params(symbol, timeframe)), **trader_options)
+    if warmup:
+        history = get_bars(symbol=symbol, timeframe=timeframe)
+        trader.warmup(zip(history['date'].dt.to_pydatetime(), history['open_price'].tolist(),
+                          history['high_price'].tolist(), history['low_price'].tolist(),
+                          history['close_price'].tolist(), history['volume'].tolist()))
+
+    writer = BarWriter(symbol, timeframe, flush_bars, flush_seconds)
+    try:
+        for bar in source:
+            if trader.last_date is not None and bar[0] <= trader.last_date:
+                continue
+            trader.on_bar(bar)
+            writer.put(bar)
+    finally:
+        writer.close()
+        print(trader.stats())
+    return trader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Торговля стратегией EMAStochMACDRSI на поступающих барах')
+    parser.add_argument('--file', default=None, help='дописываемый файл с барами в формате data_output.txt')
+    parser.add_argument('--from-start', action='store_true', help='читать файл с начала, а не только новые строки')
+    parser.add_argument('--port', type=int, default=SOCKET_ADDRESS[1], help='порт локального сокета (без --file)')
+    parser.add_argument('--params', default=None, help='8 параметров стратегии через запятую')
+    parser.add_argument('--symbol', default=DEFAULT_SYMBOL)
+    parser.add_argument('--timeframe', default=DEFAULT_TIMEFRAME)
+    parser.add_argument('--no-bot', action='store_true', help='не запускать Telegram-бота')
+    args = parser.parse_args()
+
+    # /balance бота показывает стоимость бумажного портфеля. Опрос идет в потоках Updater без idle(),
+    # поэтому при остановке торговли его нужно остановить, иначе процесс не завершится
+    updater = telegram_bot.start_polling() if not args.no_bot else None
+    if args.file is not None:
+        live_source = FileTailSource(args.file, from_start=args.from_start)
+    else:
+        live_source = SocketSource((SOCKET_ADDRESS[0], args.port))
+    live_params = tuple(int(value) for value in args.params.split(',')) if args.params else None
+    try:
+        run_live(live_source, live_params, symbol=args.symbol, timeframe=args.timeframe)
+    except KeyboardInterrupt:
+        live_source.stop()
+    finally:
+        if updater is not None:
+            updater.stop()
@@ -1,19 +1,33 @@
-import threading
-from ga_optimization import run_ga_optimization
-from backtest import run_backtest
-from telegram_bot import main as start_bot
-from database import load_data_to_db
-
-def main():
-    # Загрузка данных в базу данных из текстового файла
-    load_data_to_db('data_output.txt')
-
-    # Telegram-бот в отдельном потоке
-    bot_thread = threading.Thread(target=start_bot)
-    bot_thread.start()
-
-    best_ind = run_ga_optimization()
-    run_backtest(*best_ind, plot=True)
-
-if __name__ == '__main__':
-    main()
+import argparse
+import os
+import threading
+from ga_optimization import run_ga_optimization
+from backtest import run_backtest
+from telegram_bot import init_bot, main as start_bot
+from database import init_db, load_data_to_db, refresh_bar_store
+
+def main(bot=True, report=None):
+    # Подключение к базе данных и проверка схемы (при импорте модулей база не открывается)
+    init_db()
+    # Загрузка данных в базу данных из текстового файла (дописываются только новые бары)
+    load_data_to_db('data_output.txt', incremental=True)
+    # Бинарная копия баров, которую воркеры оптимизатора открывают через np.memmap
+    bar_store = refresh_bar_store()
+
+    if bot:
+        # Telegram-бот в отдельном потоке
+        init_bot()
+        bot_thread = threading.Thread(target=start_bot)
+        bot_thread.start()
+
+    # Оценка индивидов распределяется по всем ядрам процессора
+    best_ind = run_ga_optimization(workers=os.cpu_count(), engine='numpy', bar_store=bar_store)
+    run_backtest(*best_ind, plot=True, bar_store=bar_store, report=report)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Оптимизация и бэктест стратегии EMAStochMACDRSI')
+    parser.add_argument('--no-bot', action='store_true', help='без Telegram-бота (не нужны сеть и TOKEN)')
+    parser.add_argument('--report', default=None,
+                        help='файл отчета .png или .html вместо окон графиков (строится в фоновом процессе)')
+    args = parser.parse_args()
+    main(bot=not args.no_bot, report=args.report)
@@ -0,0 +1,155 @@
+# recorder.py
+# Журнал финального прогона бэктеста: исполненные ордера, закрытые сделки и кривая стоимости
+# портфеля. Записи хранятся в памяти компактно (объекты со __slots__ и массивы array) и пачками
+# сбрасываются в таблицы SQLite с идентификатором прогона, поэтому память не растет с длиной
+# прогона, а статистику (доходность, просадку) можно получить позже без повторного бэктеста.
+from array import array
+from datetime import datetime
+import numpy as np
+from backtrader import num2date
+from database import (BacktestEquity, BacktestFill, BacktestTrade, SQLITE_DATETIME_FORMAT, create_backtest_run,
+                      fetch_backtest_records, fetch_backtest_runs, finish_backtest_run, save_backtest_records)
+
+# Сколько записей накапливается в памяти до записи в базу
+FLUSH_RECORDS = 10000
+
+
+def _date(num):
+    """Дата backtrader (число дней) в строку формата SQLite."""
+    return num2date(num).strftime(SQLITE_DATETIME_FORMAT)
+
+
+class FillRecord:
+    """Исполненный ордер."""
+    __slots__ = ('date', 'size', 'price', 'comm')
+
+    def __init__(self, date, size, price, comm):
+        self.date = date
+        self.size = size
+        self.price = price
+        self.comm = comm
+
+
+class TradeRecord:
+    """Закрытая сделка."""
+    __slots__ = ('open_date', 'close_date', 'long', 'price', 'pnl', 'pnlcomm', 'bars')
+
+    def __init__(self, open_date, close_date, long, price, pnl, pnlcomm, bars):
+        self.open_date = open_date
+        self.close_date = close_date
+        self.long = long
+        self.price = price
+        self.pnl = pnl
+        self.pnlcomm = pnlcomm
+        self.bars = bars
+
+
+class TradeRecorder:
+    """Накопление журнала прогона и пакетная запись в backtest_fills, backtest_trades и backtest_equity.
+
+    Даты передаются в формате backtrader (число дней, как self.datas[0].datetime[0])."""
+
+    def __init__(self, flush_every=FLUSH_RECORDS):
+        self.flush_every = flush_every
+        self.run_id = None
+        self.fills = []
+        self.trades = []
+        self.equity_dates = array('d')
+        self.equity_values = array('d')
+
+    def start(self, **fields):
+        """Создание записи прогона (params, cash, ...); возвращает идентификатор прогона."""
+        self.run_id = create_backtest_run(started_at=datetime.now(), **fields)
+        return self.run_id
+
+    def add_fill(self, date, size, price, comm):
+        self.fills.append(FillRecord(date, size, price, comm))
+        self._maybe_flush()
+
+    def add_trade(self, open_date, close_date, long, price, pnl, pnlcomm, bars):
+        self.trades.append(TradeRecord(open_date, close_date, long, price, pnl, pnlcomm, bars))
+        self._maybe_flush()
+
+    def add_equity(self, date, value):
+        self.equity_dates.append(date)
+        self.equity_values.append(value)
+        if len(self.equity_dates) >= self.flush_every:
+            self.flush()
+
+    def _maybe_flush(self):
+        if len(self.fills) + len(self.trades) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Запись накопленных записей в базу и очистка буферов."""
+        run_id = self.run_id
+        save_backtest_records(BacktestFill, [(run_id, _date(fill.date), fill.size, fill.price, fill.comm)
+                                             for fill in self.fills])
+        save_backtest_records(BacktestTrade, [(run_id, _date(trade.open_date), _date(trade.close_date),
+                                               int(trade.long), trade.price, trade.pnl, trade.pnlcomm, trade.bars)
+                                              for trade in self.trades])
+        save_backtest_records(BacktestEquity, [(run_id, _date(date), value)
+                                               for date, value in zip(self.equity_dates, self.equity_values)])
+        self.fills = []
+        self.trades = []
+        self.equity_dates = array('d')
+        self.equity_values = array('d')
+
+    def close(self, **fields):
+        """Запись оставшихся записей и итогов прогона (final_value, total_trades, profitable_trades)."""
+        self.flush()
+        finish_backtest_run(self.run_id, finished_at=datetime.now(), **fields)
+
+
+def max_drawdown(values):
+    """Максимальная просадка ряда стоимости портфеля: (в деньгах, в долях от максимума)."""
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return 0.0, 0.0
+    peaks = np.maximum.accumulate(values)
+    drawdowns = peaks - values
+    idx = int(drawdowns.argmax())
+    return float(drawdowns[idx]), float(drawdowns[idx] / peaks[idx]) if peaks[idx] > 0 else 0.0
+
+
+def run_statistics(run_id=None):
+    """Статистика прогона по сохраненному журналу (по умолчанию - последнего); None, если прогонов нет."""
+    runs = fetch_backtest_runs(limit=1, run_id=run_id)
+    if not runs:
+        return None
+    run = runs[0]
+    trades = fetch_backtest_records(BacktestTrade, run.id)
+    equity = fetch_backtest_records(BacktestEquity, run.id)
+    drawdown, drawdown_pct = max_drawdown(equity['value'])
+    pnl = trades['pnlcomm']
+    return {
+        'run_id': run.id,
+        'started_at': run.started_at,
+        'symbol': run.symbol,
+        'timeframe': run.timeframe,
+        'params': run.params,
+        'cash': run.cash,
+        'final_value': run.final_value,
+        'profit': run.final_value - run.cash if run.final_value is not None else None,
+        'trades': len(trades),
+        'profitable_pct': float((pnl > 0).mean() * 100) if len(trades) else 0.0,
+        'gross_profit': float(pnl[pnl > 0].sum()),
+        'gross_loss': float(pnl[pnl < 0].sum()),
+        'best_trade': float(pnl.max()) if len(trades) else 0.0,
+        'worst_trade': float(pnl.min()) if len(trades) else 0.0,
+        'max_drawdown': drawdown,
+        'max_drawdown_pct': drawdown_pct * 100,
+    }
+
+
+def format_statistics(stats):
+    """Текст статистики прогона для вывода и Telegram."""
+    if stats is None:
+        return 'Сохраненных прогонов бэктеста нет'
+    profit = f'{stats["profit"]:.2f}' if stats['profit'] is not None else 'прогон не завершен'
+    return (f'Прогон {stats["run_id"]} от {stats["started_at"]:%d.%m.%Y %H:%M}, параметры {stats["params"]}\n'
+            f'Доходность: {profit}\n'
+            f'Сделок: {stats["trades"]}, прибыльных {stats["profitable_pct"]:.1f}%\n'
+            f'Прибыль/убыток по сделкам: {stats["gross_profit"]:.2f} / {stats["gross_loss"]:.2f}\n'
+            f'Лучшая/худшая сделка: {stats["best_trade"]:.2f} / {stats["worst_trade"]:.2f}\n'
+            f'Максимальная просадка: {stats["max_drawdown"]:.2f} ({stats["max_drawdown_pct"]:.2f}%)')
@@ -0,0 +1,139 @@
+# report.py
+# Отчет о прогоне бэктеста: цены, сделки и кривая стоимости портфеля в PNG или HTML.
+# В отличие от cerebro.plot отчет строится без дисплея (matplotlib Agg без pyplot) по журналу
+# прогона из базы данных (recorder.py), а длинные ряды прореживаются с сохранением минимумов
+# и максимумов, поэтому время и память не зависят от количества баров. Отчет можно строить
+# в фоновом процессе, не блокируя основной.
+import base64
+import html
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from database import (DEFAULT_SYMBOL, DEFAULT_TIMEFRAME, BacktestEquity, BacktestFill, fetch_backtest_records,
+                      get_engine, init_db, load_bars)
+from recorder import format_statistics, run_statistics
+
+# Больше стольких баров отчет прореживается, а run_backtest строит отчет вместо cerebro.plot
+REPORT_MAX_BARS = 5000
+
+# Размер изображения отчета в дюймах и разрешение
+REPORT_FIGSIZE = (14, 8)
+REPORT_DPI = 100
+
+
+def _bucket_starts(n, buckets):
+    """Начала не более buckets групп подряд идущих элементов примерно одинаковой длины."""
+    return np.unique(np.linspace(0, n, buckets + 1).astype(np.int64)[:-1])
+
+
+def decimate_ohlc(dates, opens, highs, lows, closes, max_bars=REPORT_MAX_BARS):
+    """Прореживание баров до max_bars: соседние бары объединяются в один (open первого, максимум high,
+    минимум low, close последнего), поэтому экстремумы цены сохраняются."""
+    n = len(closes)
+    if n <= max_bars:
+        return dates, opens, highs, lows, closes
+    starts = _bucket_starts(n, max_bars)
+    ends = np.append(starts[1:], n) - 1
+    return (dates[starts], opens[starts], np.maximum.reduceat(highs, starts),
+            np.minimum.reduceat(lows, starts), closes[ends])
+
+
+def decimate_minmax(dates, values, max_points=REPORT_MAX_BARS):
+    """Прореживание линии до max_points точек: в каждой группе остаются минимум и максимум в порядке времени."""
+    n = len(values)
+    if n <= max_points:
+        return dates, values
+    starts = _bucket_starts(n, max_points // 2)
+    ends = np.append(starts[1:], n)
+    indices = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        chunk = values[start:end]
+        lowest, highest = start + int(chunk.argmin()), start + int(chunk.argmax())
+        indices.extend(sorted({lowest, highest}))
+    return dates[indices], values[indices]
+
+
+def render_report(path, bars, equity, fills, title='', summary='', max_bars=REPORT_MAX_BARS):
+    """Отрисовка отчета в файл path (.png или .html).
+
+    bars - бары (DataFrame как у database.get_bars), equity и fills - журнал прогона
+    (database.fetch_backtest_records). summary - текст статистики для HTML-отчета."""
+    # matplotlib загружается только при построении отчета; Figure без pyplot не требует дисплея
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    dates, opens, highs, lows, closes = decimate_ohlc(
+        bars['date'].to_numpy(), bars['open_price'].to_numpy(), bars['high_price'].to_numpy(),
+        bars['low_price'].to_numpy(), bars['close_price'].to_numpy(), max_bars)
+    equity_dates, equity_values = decimate_minmax(equity['date'].to_numpy(), equity['value'].to_numpy(), max_bars)
+
+    figure = Figure(figsize=REPORT_FIGSIZE)
+    FigureCanvasAgg(figure)
+    price_axes, equity_axes = figure.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [3, 1]})
+    price_axes.vlines(dates, lows, highs, colors=np.where(closes >= opens, 'green', 'red'), linewidth=0.6)
+    price_axes.plot(dates, closes, color='black', linewidth=0.3)
+    buys = fills[fills['size'] > 0]
+    sells = fills[fills['size'] < 0]
+    price_axes.scatter(buys['date'], buys['price'], marker='^', color='blue', s=16, label='Покупка', zorder=3)
+    price_axes.scatter(sells['date'], sells['price'], marker='v', color='orange', s=16, label='Продажа', zorder=3)
+    price_axes.legend(loc='upper left')
+    price_axes.set_title(title)
+    equity_axes.plot(equity_dates, equity_values, color='navy', linewidth=0.8)
+    equity_axes.set_ylabel('Стоимость портфеля')
+    figure.autofmt_xdate()
+    figure.tight_layout()
+
+    if not path.endswith('.html'):
+        figure.savefig(path, dpi=REPORT_DPI)
+        return path
+    image = io.BytesIO()
+    figure.savefig(image, format='png', dpi=REPORT_DPI)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'<html><head><meta charset="utf-8"><title>{html.escape(title)}</title></head><body>'
+                f'<pre>{html.escape(summary)}</pre>'
+                f'<img src="data:image/png;base64,{base64.b64encode(image.getvalue()).decode()}"></body></html>')
+    return path
+
+
+def build_report(run_id=None, path=None, bar_store=None, symbol=None, timeframe=None, max_bars=REPORT_MAX_BARS):
+    """Отчет о сохраненном прогоне бэктеста (по умолчанию - последнем); возвращает путь к файлу или None.
+
+    Бары берутся из bar_store или SQLite за период кривой стоимости прогона; инструмент
+    (symbol, timeframe) по умолчанию - сохраненный в записи прогона.
+    path - файл .png или .html (по умолчанию report_<номер прогона>.png)."""
+    stats = run_statistics(run_id)
+    if stats is None:
+        return None
+    run_id = stats['run_id']
+    symbol = symbol or stats['symbol'] or DEFAULT_SYMBOL
+    timeframe = timeframe or stats['timeframe'] or DEFAULT_TIMEFRAME
+    equity = fetch_backtest_records(BacktestEquity, run_id)
+    fills = fetch_backtest_records(BacktestFill, run_id)
+    bars = load_bars(bar_store, symbol, timeframe)
+    if len(equity):
+        dates = bars['date']
+        bars = bars[(dates >= equity['date'].iloc[0]) & (dates <= equity['date'].iloc[-1])]
+    path = path or f'report_{run_id}.png'
+    return render_report(path, bars, equity, fills, title=f'Прогон {run_id}, параметры {stats["params"]}',
+                         summary=format_statistics(stats), max_bars=max_bars)
+
+
+# Процесс построения отчетов, создается при первом обращении
+_executor = None
+
+
+def _init_report_worker(database_url):
+    init_db(database_url)
+
+
+def submit_report(run_id=None, path=None, bar_store=None, symbol=None, timeframe=None, max_bars=REPORT_MAX_BARS):
+    """Построение отчета в фоновом процессе; возвращает Future с путем к файлу (см. build_report).
+
+    Процесс запускается через spawn и открывает свое подключение к той же базе данных."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_report_worker,
+                                        initargs=(get_engine().url.render_as_string(hide_password=False),))
+    return _executor.submit(build_report, run_id, path, bar_store, symbol, timeframe, max_bars)
@@ -0,0 +1,61 @@
+# surrogate.py
+# Суррогатная модель фитнеса для генетического алгоритма: предсказание результата бэктеста
+# по 8 целочисленным генам методом k ближайших соседей среди уже выполненных бэктестов.
+# Предсказание стоит микросекунды, поэтому потомков можно отсеять до настоящего бэктеста
+# и бэктестить только наиболее перспективных.
+import numpy as np
+
+
+class KNNSurrogate:
+    """k-NN регрессия результата (доходность, процент прибыльных сделок) по генам индивида.
+
+    Гены масштабируются на диапазоны bounds, соседи взвешиваются обратно расстоянию;
+    для уже оцененного набора параметров возвращается его точный результат."""
+
+    def __init__(self, bounds, k=5):
+        self.k = k
+        self.low = np.array([low for low, _ in bounds], dtype=np.float64)
+        self.scale = np.array([high - low for low, high in bounds], dtype=np.float64)
+        self._results = {}  # Набор параметров -> результат бэктеста
+        self._features = None
+        self._targets = None
+
+    def __len__(self):
+        return len(self._results)
+
+    def update(self, results):
+        """Добавление результатов бэктестов (словарь набор параметров -> результат) в обучающую выборку."""
+        for params, result in results.items():
+            if params not in self._results:
+                self._results[params] = result
+                self._features = None
+
+    def predict(self, params_list):
+        """Предсказанные результаты бэктеста для списка наборов параметров (массив len x 2)."""
+        if self._features is None:
+            self._features = (np.array(list(self._results), dtype=np.float64) - self.low) / self.scale
+            self._targets = np.array(list(self._results.values()), dtype=np.float64)
+        queries = (np.asarray(params_list, dtype=np.float64) - self.low) / self.scale
+        distances = np.sqrt(((queries[:, None, :] - self._features[None, :, :]) ** 2).sum(axis=2))
+        k = min(self.k, len(self._targets))
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        weights = 1.0 / np.maximum(nearest_distances, 1e-12)
+        predictions = (weights[:, :, None] * self._targets[nearest]).sum(axis=1) / weights.sum(axis=1)[:, None]
+        # Уже оцененные наборы (расстояние 0) получают свой точный результат
+        exact = nearest_distances.min(axis=1) == 0
+        if exact.any():
+            closest = nearest[np.arange(len(nearest)), nearest_distances.argmin(axis=1)]
+            predictions[exact] = self._targets[closest[exact]]
+        return predictions
+
+
+def rank_correlation(predicted, actual):
+    """Ранговая корреляция Спирмена (без поправки на связанные ранги); None для менее чем двух значений."""
+    if len(predicted) < 2:
+        return None
+    predicted_ranks = np.argsort(np.argsort(predicted))
+    actual_ranks = np.argsort(np.argsort(actual))
+    if predicted_ranks.std() == 0 or actual_ranks.std() == 0:
+        return None
+    return float(np.corrcoef(predicted_ranks, actual_ranks)[0, 1])
@@ -1,68 +1,263 @@
-import logging
-from telegram import Bot, Update
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters
-import os
-from dotenv import load_dotenv
-
-# Загружаем переменные окружения из файла .env
-load_dotenv()
-
-TOKEN = os.getenv("TOKEN")
-CHAT_ID = os.getenv("CHAT_ID")
-
-# Настройка логирования
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-bot = Bot(token=TOKEN)
-
-# Начальный баланс
-current_balance = 1000000
-
-def send_message(text):
-    """Отправка сообщения в Telegram."""
-    try:
-        bot.send_message(chat_id=CHAT_ID, text=text)
-        logger.info(f'Сообщение отправлено: {text}')
-    except Exception as e:
-        logger.error(f'Ошибка при отправке сообщения: {e}')
-
-def get_balance():
-    """Получение текущего баланса."""
-    return f'Текущий баланс: {current_balance:.2f}'
-
-def update_balance(new_balance):
-    """Обновление текущего баланса."""
-    global current_balance
-    current_balance = new_balance
-
-def start(update: Update, context: CallbackContext):
-    """Обработчик команды /start."""
-    update.message.reply_text('Добро пожаловать! Используйте команду /balance для проверки текущего баланса.')
-    logger.info('Команда /start получена.')
-
-def balance(update: Update, context: CallbackContext):
-    """Обработчик команды /balance."""
-    balance_message = get_balance()
-    update.message.reply_text(balance_message)
-    logger.info('Команда /balance получена.')
-
-def main():
-    """Запуск бота."""
-    updater = Updater(token=TOKEN, use_context=True)
-    dp = updater.dispatcher
-
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("balance", balance))
-
-    # Логирование всех текстовых сообщений для отладки
-    def log_updates(update: Update, context: CallbackContext):
-        logger.info(f'Получено сообщение: {update}')
-
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, log_updates))  # Логирование текстовых сообщений
-
-    updater.start_polling()
-    updater.idle()
-
-if __name__ == '__main__':
+import atexit
+import logging
+import queue
+import threading
+import time
+import os
+from collections import namedtuple
+
+# Модуль не имеет побочных эффектов при импорте: переменные окружения, логирование и бот
+# настраиваются в init_bot(), а библиотека telegram импортируется только при первом обращении.
+# Поэтому воркеры оптимизатора и бэктест без Telegram не платят за это и не требуют TOKEN.
+TOKEN = None
+CHAT_ID = None
+logger = logging.getLogger(__name__)
+
+bot = None
+_initialized = False
+
+# Начальный баланс
+current_balance = 1000000
+
+# Ограничения Telegram: не больше одного сообщения в секунду в один чат (кратковременно
+# допускаются всплески) и не больше 4096 символов в сообщении
+MESSAGES_PER_SECOND = 1.0
+MESSAGES_BURST = 3
+MAX_MESSAGE_LENGTH = 4096
+
+
+def init_bot():
+    """Загрузка переменных окружения из .env, настройка логирования и создание бота.
+
+    Повторный вызов ничего не делает. Возвращает бота или None, если TOKEN не задан."""
+    global TOKEN, CHAT_ID, bot, _initialized
+    if _initialized:
+        return bot
+    from dotenv import load_dotenv
+    # Загружаем переменные окружения из файла .env
+    load_dotenv()
+    TOKEN = os.getenv("TOKEN")
+    CHAT_ID = os.getenv("CHAT_ID")
+    # Настройка логирования
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if TOKEN:
+        from telegram import Bot
+        bot = Bot(token=TOKEN)
+    else:
+        logger.warning('TOKEN не задан, сообщения в Telegram отправляться не будут')
+    _initialized = True
+    return bot
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity накопленных токенов."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """Получение токена; ждет, если токены закончились."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+# Изображение для отправки через очередь уведомлений (отправляется отдельным сообщением)
+Photo = namedtuple('Photo', ['path', 'caption'])
+
+
+class NotificationQueue:
+    """Очередь уведомлений с отправкой в фоновом потоке.
+
+    notify() не ждет сети. Пока поток ждет токен ограничителя частоты, сообщения
+    накапливаются и затем отправляются одним сообщением Telegram (до max_length символов);
+    уведомление длиннее max_length делится на несколько сообщений."""
+
+    _STOP = object()
+
+    def __init__(self, bot, chat_id, rate=MESSAGES_PER_SECOND, burst=MESSAGES_BURST,
+                 max_length=MAX_MESSAGE_LENGTH):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(rate, burst)
+        self.max_length = max_length
+        self.sent = 0  # Отправлено сообщений Telegram
+        self.queued = 0  # Поставлено уведомлений в очередь
+        self._queue = queue.Queue()
+        self._carry = None  # Уведомление, не поместившееся в предыдущее сообщение
+        self._thread = threading.Thread(target=self._run, name='telegram-notifier', daemon=True)
+        self._thread.start()
+
+    def notify(self, text):
+        """Постановка уведомления (строки или Photo) в очередь."""
+        self.queued += 1
+        self._queue.put(text)
+
+    def close(self, timeout=None):
+        """Отправка оставшихся уведомлений и остановка потока."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping or self._carry is not None:
+            first = self._carry if self._carry is not None else self._queue.get()
+            self._carry = None
+            if first is self._STOP:
+                break
+            self.bucket.acquire()
+            if isinstance(first, Photo):
+                self._send_photo(first)
+                continue
+            if len(first) > self.max_length:
+                # Длинное уведомление уходит несколькими сообщениями (по возможности по границе строки)
+                cut = first.rfind('\n', 0, self.max_length + 1)
+                if cut > 0:
+                    head, rest = first[:cut], first[cut + 1:]
+                else:
+                    head, rest = first[:self.max_length], first[self.max_length:]
+                self._send(head)
+                self._carry = rest or None
+                continue
+            texts = [first]
+            length = len(first)
+            # Все, что накопилось за время ожидания, уходит одним сообщением
+            while True:
+                try:
+                    text = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if text is self._STOP:
+                    stopping = True
+                    break
+                if isinstance(text, Photo) or length + 1 + len(text) > self.max_length:
+                    self._carry = text
+                    break
+                texts.append(text)
+                length += 1 + len(text)
+            self._send('\n'.join(texts))
+
+    def _send(self, text):
+        try:
+            self.bot.send_message(chat_id=self.chat_id, text=text)
+            self.sent += 1
+            logger.info(f'Сообщение отправлено: {text}')
+        except Exception as e:
+            logger.error(f'Ошибка при отправке сообщения: {e}')
+
+    def _send_photo(self, photo):
+        try:
+            with open(photo.path, 'rb') as f:
+                self.bot.send_photo(chat_id=self.chat_id, photo=f, caption=photo.caption)
+            self.sent += 1
+            logger.info(f'Изображение отправлено: {photo.path}')
+        except Exception as e:
+            logger.error(f'Ошибка при отправке изображения: {e}')
+
+
+# Очередь уведомлений процесса, создается при первой отправке
+_notifier = None
+_notifier_lock = threading.Lock()
+
+def get_notifier():
+    """Очередь уведомлений процесса; при завершении программы оставшиеся сообщения отправляются.
+
+    Возвращает None, если бот не настроен (нет TOKEN)."""
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None and init_bot() is not None:
+            _notifier = NotificationQueue(bot, CHAT_ID)
+            atexit.register(_notifier.close)
+    return _notifier
+
+def send_message(text):
+    """Отправка сообщения в Telegram через фоновую очередь (без ожидания сети)."""
+    notifier = get_notifier()
+    if notifier is not None:
+        notifier.notify(text)
+
+def send_photo(path, caption=None):
+    """Отправка изображения (например, отчета о бэктесте) в Telegram через фоновую очередь."""
+    notifier = get_notifier()
+    if notifier is not None:
+        notifier.notify(Photo(path, caption))
+
+def get_balance():
+    """Получение текущего баланса."""
+    return f'Текущий баланс: {current_balance:.2f}'
+
+def update_balance(new_balance):
+    """Обновление текущего баланса."""
+    global current_balance
+    current_balance = new_balance
+
+def start(update, context):
+    """Обработчик команды /start."""
+    update.message.reply_text('Добро пожаловать! Используйте команду /balance для проверки текущего баланса и /stats для статистики последнего бэктеста.')
+    logger.info('Команда /start получена.')
+
+def balance(update, context):
+    """Обработчик команды /balance."""
+    balance_message = get_balance()
+    update.message.reply_text(balance_message)
+    logger.info('Команда /balance получена.')
+
+def stats(update, context):
+    """Обработчик команды /stats [номер прогона]: статистика прогона бэктеста из базы данных."""
+    from recorder import format_statistics, run_statistics
+    run_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    update.message.reply_text(format_statistics(run_statistics(run_id)))
+    logger.info('Команда /stats получена.')
+
+def report(update, context):
+    """Обработчик команды /report [номер прогона]: график прогона бэктеста из базы данных."""
+    from report import build_report
+    run_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    path = build_report(run_id)
+    if path is None:
+        update.message.reply_text('Сохраненных прогонов бэктеста нет')
+    else:
+        with open(path, 'rb') as f:
+            update.message.reply_photo(photo=f)
+    logger.info('Команда /report получена.')
+
+def start_polling():
+    """Запуск опроса Telegram в фоновых потоках без ожидания сигналов (можно вызывать из любого потока);
+    возвращает Updater, который останавливается через updater.stop(), или None, если TOKEN не задан."""
+    from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+    if init_bot() is None:
+        return None
+    updater = Updater(token=TOKEN, use_context=True)
+    dp = updater.dispatcher
+
+    dp.add_handler(CommandHandler("start", start))
+    dp.add_handler(CommandHandler("balance", balance))
+    dp.add_handler(CommandHandler("stats", stats))
+    dp.add_handler(CommandHandler("report", report))
+
+    # Логирование всех текстовых сообщений для отладки
+    def log_updates(update, context):
+        logger.info(f'Получено сообщение: {update}')
+
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, log_updates))  # Логирование текстовых сообщений
+
+    updater.start_polling()
+    return updater
+
+def main():
+    """Запуск бота."""
+    updater = start_polling()
+    if updater is not None:
+        updater.idle()
+
+if __name__ == '__main__':
     main()
\ No newline at end of file
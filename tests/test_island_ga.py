@@ -0,0 +1,62 @@
+# Островная оптимизация на numpy-движке с хранилищем баров из временной базы
+import multiprocessing
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+import database
+import island_ga
+from ga_optimization import GENE_NAMES
+
+ISLANDS = 2
+
+
+@pytest.fixture
+def bar_store(tmp_path, monkeypatch):
+    """Хранилище баров, выгруженное export_bar_store из временной базы со случайным блужданием цены."""
+    previous = database.engine
+    monkeypatch.setattr(database, 'engine', None)
+    database.init_db(f'sqlite:///{tmp_path / "stocks.db"}')
+    rng = np.random.default_rng(1)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, 800)))
+    start = datetime(2024, 1, 1)
+    database.append_bars([(start + timedelta(minutes=i), price, price * 1.004, price * 0.996, price, 100)
+                          for i, price in enumerate(close.tolist())])
+    path = database.export_bar_store(str(tmp_path / 'store'))
+    yield path
+    database.engine.dispose()
+    database.Session.configure(bind=previous)
+    database.clear_bars_cache()
+
+
+def test_islands_exchange_migrants(bar_store, monkeypatch):
+    island_results = []
+    select_best = island_ga._select_best
+    monkeypatch.setattr(island_ga, '_select_best',
+                        lambda results: island_results.extend(results) or select_best(results))
+    best = island_ga.run_island_optimization(islands=ISLANDS, population_size=4, ngen=2, migration_interval=1,
+                                             migrants=1, seed=1, engine='numpy', bar_store=bar_store)
+    # Миграция после первого поколения: каждый остров получил мигранта от соседа
+    assert sorted(result['island'] for result in island_results) == list(range(ISLANDS))
+    assert all(result['migrants'] == 1 for result in island_results)
+    assert all(len(result['logbook']) == 3 for result in island_results)
+    assert len(best) == len(GENE_NAMES) and all(isinstance(value, int) for value in best)
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork',
+                    reason='подмена run_island передается процессам островов только при fork')
+def test_failing_island_raises(bar_store, monkeypatch):
+    run_island = island_ga.run_island
+
+    def failing_island(island_id, *args, **kwargs):
+        if island_id == 1:
+            raise ValueError('остров не запустился')
+        return run_island(island_id, *args, **kwargs)
+
+    monkeypatch.setattr(island_ga, 'run_island', failing_island)
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match='Ошибка на острове 1'):
+        island_ga.run_island_optimization(islands=ISLANDS, population_size=4, ngen=2, migration_interval=1,
+                                          seed=1, engine='numpy', bar_store=bar_store)
+    # Остров 0 ждет мигрантов от упавшего соседа, но оптимизация не ждет MIGRATION_TIMEOUT
+    assert time.monotonic() - started < island_ga.MIGRATION_TIMEOUT / 10
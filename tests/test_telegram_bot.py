@@ -0,0 +1,111 @@
+# Очередь уведомлений Telegram с ботом-заглушкой вместо сети
+import threading
+import time
+from telegram_bot import NotificationQueue, Photo
+
+# Частота без заметного ожидания для тестов, не проверяющих ограничение частоты
+FAST_RATE = 1000.0
+
+
+class FakeBot:
+    """Бот, запоминающий отправленные сообщения и изображения с временем отправки.
+
+    Если передан gate, первая отправка ждет его, чтобы в очереди успели накопиться уведомления."""
+
+    def __init__(self, gate=None):
+        self.sent = []
+        self.times = []
+        self.gate = gate
+        self.started = threading.Event()
+
+    def _record(self, item):
+        self.started.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.sent.append(item)
+        self.times.append(time.monotonic())
+
+    def send_message(self, chat_id, text):
+        self._record(('message', text))
+
+    def send_photo(self, chat_id, photo, caption=None):
+        self._record(('photo', photo.read(), caption))
+
+
+def queue_while_blocked(texts, **kwargs):
+    """Уведомления texts ставятся в очередь, пока бот отправляет первое; возвращает бота после close()."""
+    gate = threading.Event()
+    bot = FakeBot(gate)
+    notifier = NotificationQueue(bot, 'chat', **kwargs)
+    notifier.notify(texts[0])
+    assert bot.started.wait(5)
+    for text in texts[1:]:
+        notifier.notify(text)
+    gate.set()
+    notifier.close(5)
+    assert notifier.sent == len(bot.sent)
+    return bot
+
+
+def test_batches_queued_messages():
+    bot = queue_while_blocked(['a', 'b', 'c', 'd'], rate=FAST_RATE)
+    assert bot.sent == [('message', 'a'), ('message', 'b\nc\nd')]
+
+
+def test_keeps_order_with_photos(tmp_path):
+    path = tmp_path / 'report.png'
+    path.write_bytes(b'png')
+    bot = queue_while_blocked(['a', 'b', Photo(str(path), 'report'), 'c', 'd'], rate=FAST_RATE)
+    assert bot.sent == [('message', 'a'), ('message', 'b'), ('photo', b'png', 'report'), ('message', 'c\nd')]
+
+
+def test_batch_respects_max_length():
+    bot = queue_while_blocked(['a', 'bbbb', 'cccc', 'dddd'], rate=FAST_RATE, max_length=10)
+    assert bot.sent == [('message', 'a'), ('message', 'bbbb\ncccc'), ('message', 'dddd')]
+
+
+def test_default_max_length_is_telegram_limit():
+    bot = queue_while_blocked(['a', 'x' * 4000, 'y' * 95, 'z'], rate=FAST_RATE)
+    assert [len(text) for _, text in bot.sent] == [1, 4096, 1]
+
+
+def test_splits_long_message():
+    bot = queue_while_blocked(['a', 'x' * 25, 'b'], rate=FAST_RATE, max_length=10)
+    # Остаток длинного уведомления объединяется со следующими
+    assert bot.sent == [('message', 'a'), ('message', 'x' * 10), ('message', 'x' * 10), ('message', 'xxxxx\nb')]
+
+
+def test_splits_long_message_at_newline():
+    bot = queue_while_blocked(['a', 'line one\nline two\nend'], rate=FAST_RATE, max_length=12)
+    assert bot.sent == [('message', 'a'), ('message', 'line one'), ('message', 'line two\nend')]
+
+
+def test_token_bucket_rate(tmp_path):
+    path = tmp_path / 'report.png'
+    path.write_bytes(b'png')
+    bot = FakeBot()
+    notifier = NotificationQueue(bot, 'chat', rate=10.0, burst=2)
+    # Изображения не объединяются, поэтому каждое требует своего токена
+    for _ in range(5):
+        notifier.notify(Photo(str(path), None))
+    notifier.close(5)
+    assert len(bot.sent) == 5
+    intervals = [later - earlier for earlier, later in zip(bot.times, bot.times[1:])]
+    # Два сообщения уходят сразу (burst), следующие - не чаще rate в секунду
+    assert intervals[0] < 0.05
+    assert all(interval > 0.08 for interval in intervals[1:])
+
+
+def test_close_flushes_pending():
+    gate = threading.Event()
+    bot = FakeBot(gate)
+    notifier = NotificationQueue(bot, 'chat', rate=FAST_RATE, max_length=3)
+    for text in ['a', 'b', 'c', 'd']:
+        notifier.notify(text)
+    closer = threading.Thread(target=notifier.close, args=(5,))
+    closer.start()
+    gate.set()
+    closer.join(5)
+    assert not notifier._thread.is_alive()
+    assert ''.join(text for _, text in bot.sent).replace('\n', '') == 'abcd'
+    assert notifier.sent == len(bot.sent) and notifier.queued == 4
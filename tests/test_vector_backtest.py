@@ -0,0 +1,126 @@
+# Совпадение результатов векторного движка (engine='numpy') и backtrader на синтетических барах,
+# а также пакетного движка и векторного движка для каждого набора
+import random
+import numpy as np
+import pandas as pd
+import pytest
+import backtest
+from backtest import run_backtest
+from indicator_store import IndicatorStore
+from ga_optimization import GENE_BOUNDS
+from vector_backtest import (BATCH_OK, BATCH_PRUNED, BATCH_ZERO_DIVISION, BacktestPruned, PruneRules,
+                             run_vector_backtest, run_vector_backtest_batch)
+
+# Наборы параметров: fast_ema, slow_ema, stoch, rsi, stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold
+PARAMS = [
+    (12, 26, 14, 14, 80, 20, 70, 30),
+    (5, 13, 5, 5, 70, 30, 50, 50),
+    (8, 40, 9, 11, 90, 10, 60, 40),
+    (20, 60, 20, 20, 100, 0, 100, 0),
+    (30, 13, 7, 6, 75, 25, 65, 35),
+    (10, 21, 12, 8, 85, 5, 55, 45),
+]
+
+# Без правил, правила по умолчанию и правила, под которые часть прогонов не попадает
+PRUNE_RULES = [
+    None,
+    PruneRules(),
+    PruneRules(max_drawdown=0.01, checkpoints=(), min_trades=1),
+    PruneRules(max_drawdown=None, checkpoints=(0.5,), min_trades=1),
+]
+
+
+def make_bars(n, seed=0, base=100.0, volatility=0.002, tick=None):
+    """Бары случайного блуждания в формате database.get_bars; tick - шаг цены для округления."""
+    rng = np.random.default_rng(seed)
+    closes = base * np.exp(np.cumsum(rng.normal(0, volatility, n)))
+    opens = np.r_[closes[0], closes[:-1]]
+    highs = np.maximum(opens, closes) * (1 + rng.uniform(0, 0.001, n))
+    lows = np.minimum(opens, closes) * (1 - rng.uniform(0, 0.001, n))
+    if tick is not None:
+        opens, highs, lows, closes = (np.round(prices / tick) * tick for prices in (opens, highs, lows, closes))
+    return pd.DataFrame({'date': pd.date_range('2020-01-01', periods=n, freq='min'), 'open_price': opens,
+                         'high_price': highs, 'low_price': lows, 'close_price': closes,
+                         'volume': rng.integers(1, 1000, n).astype(np.float64)})
+
+
+# Данные, на которых все наборы PARAMS совершают сделки
+DATASETS = {
+    'random_walk': make_bars(1500),
+    # Цена выше доли счета на сделку: сайзер покупает по одному лоту
+    'one_lot': make_bars(1500, seed=1, base=50000.0),
+}
+
+# Цена почти не меняется и округлена до шага: стохастик делит на нулевой диапазон
+FLAT_TICKS = make_bars(1500, seed=2, volatility=0.0002, tick=1.0)
+
+
+@pytest.mark.parametrize('prune', PRUNE_RULES)
+@pytest.mark.parametrize('params', PARAMS)
+@pytest.mark.parametrize('dataset', DATASETS)
+def test_numpy_engine_matches_backtrader(dataset, params, prune):
+    data = DATASETS[dataset]
+    expected = run_backtest(*params, data=data, prune=prune)
+    assert run_backtest(*params, data=data, engine='numpy', prune=prune) == expected
+
+
+@pytest.mark.parametrize('prune', [None, PruneRules()])
+@pytest.mark.parametrize('params', PARAMS)
+@pytest.mark.parametrize('dataset', DATASETS)
+def test_numpy_engine_matches_native_backtrader(dataset, params, prune, monkeypatch):
+    # Без хранилища стратегия считает индикаторы через bt.ind.*, а не берет ряды indicators.py,
+    # поэтому проверяется и расчет индикаторов векторного движка
+    data = DATASETS[dataset]
+    result = run_backtest(*params, data=data, engine='numpy', prune=prune)
+    monkeypatch.setattr(backtest, 'get_indicator_store', lambda data: None)
+    assert run_backtest(*params, data=data, prune=prune) == result
+
+
+def test_flat_ticks_divide_by_zero(monkeypatch):
+    store = IndicatorStore(FLAT_TICKS)
+    for params in PARAMS:
+        with pytest.raises(ZeroDivisionError):
+            run_vector_backtest(*params, store=store)
+        assert run_backtest(*params, data=FLAT_TICKS) == (0, 0)
+        assert run_backtest(*params, data=FLAT_TICKS, engine='numpy') == (0, 0)
+    monkeypatch.setattr(backtest, 'get_indicator_store', lambda data: None)
+    for params in PARAMS:
+        assert run_backtest(*params, data=FLAT_TICKS) == (0, 0)
+
+
+def make_gapped_bars(n, seed=3, flat_start=700, flat_length=12):
+    """Случайное блуждание с участком постоянной цены: стохастик с периодом не больше длины
+    участка делит на ноль, с большим периодом - нет."""
+    data = make_bars(n, seed=seed).copy()
+    for column in ('open_price', 'high_price', 'low_price', 'close_price'):
+        data.loc[flat_start:flat_start + flat_length - 1, column] = data['close_price'][flat_start]
+    return data
+
+
+def random_params(k, seed=0):
+    rng = random.Random(seed)
+    return [tuple(rng.randint(low, high) for low, high in GENE_BOUNDS) for _ in range(k)]
+
+
+@pytest.mark.parametrize('max_positions', [10, 2])
+def test_batch_matches_scalar(max_positions):
+    # Сайзер покупает max_positions лотов сразу на 'random_walk' и по одному лоту на 'one_lot',
+    # поэтому лимит позиций достигается и одной заявкой, и наращиванием позиции
+    datasets = [DATASETS['random_walk'], DATASETS['one_lot'], make_gapped_bars(1500)]
+    params = PARAMS + random_params(40)
+    statuses = set()
+    for data in datasets:
+        store = IndicatorStore(data)
+        for prune in PRUNE_RULES:
+            results = run_vector_backtest_batch(params, store=store, max_positions=max_positions, prune=prune)
+            for row, values in zip(results.tolist(), params):
+                statuses.add(row[3])
+                try:
+                    expected = run_vector_backtest(*values, store=store, max_positions=max_positions, prune=prune)
+                except ZeroDivisionError:
+                    assert row[3] == BATCH_ZERO_DIVISION
+                except BacktestPruned as e:
+                    assert row[3] == BATCH_PRUNED and row[0] == e.value
+                else:
+                    assert row == [*expected, BATCH_OK]
+    assert statuses == {BATCH_OK, BATCH_PRUNED, BATCH_ZERO_DIVISION}
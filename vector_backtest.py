@@ -0,0 +1,789 @@
+# vector_backtest.py
+# Быстрый движок бэктеста стратегии EMAStochMACDRSI на NumPy.
+# Индикаторы рассчитываются массивами по всему ряду сразу (см. indicators.py), а исполнение
+# брекет-ордеров и расчет размера позиции как в PositionAwareSizer моделируются
+# в одном цикле по барам без объектов Cerebro.
+import math
+from bisect import bisect_left
+from collections import namedtuple
+import numpy as np
+from indicators import STOCH_DFAST, STOCH_DSLOW, MACD_SLOW, MACD_SIGNAL
+from indicator_store import FILL_SEARCH_BLOCK, IndicatorStore
+
+
+# Коды состояния строк результата run_vector_backtest_batch
+BATCH_OK, BATCH_ZERO_DIVISION, BATCH_PRUNED = range(3)
+
+# Длина первого участка ряда, просматриваемого при поиске бара исполнения ордера
+FILL_SEARCH_CHUNK = 64
+
+# Наибольшее число баров, проверяемых правилами PruneRules за одну итерацию пакетного бэктеста
+PRUNE_SEGMENT = 64
+
+# Правила досрочной остановки заведомо плохих бэктестов при оптимизации:
+# max_drawdown - допустимая просадка стоимости портфеля от максимума (доля, None - без проверки);
+# checkpoints - доли ряда, к которым должно быть закрыто не меньше min_trades сделок.
+PruneRules = namedtuple('PruneRules', ['max_drawdown', 'checkpoints', 'min_trades'],
+                        defaults=[0.3, (0.25, 0.5), 1])
+
+
+class BacktestPruned(Exception):
+    """Бэктест остановлен досрочно по правилам PruneRules."""
+
+    def __init__(self, value, bar):
+        super().__init__(f'Бэктест остановлен на баре {bar}, стоимость портфеля {value:.2f}')
+        self.value = value
+        self.bar = bar
+
+
+def prune_checkpoints(rules, n):
+    """Номера баров, на которых проверяется количество закрытых сделок."""
+    return {int(fraction * n) for fraction in rules.checkpoints}
+
+
+def strategy_minperiod(fast_ema_period, slow_ema_period, stoch_period, rsi_period):
+    """Количество баров, после которого backtrader начинает вызывать next() стратегии."""
+    return max(fast_ema_period, slow_ema_period,
+               stoch_period + STOCH_DFAST + STOCH_DSLOW - 2,
+               MACD_SLOW + MACD_SIGNAL - 1,
+               rsi_period + 1)
+
+
+def _position_size(cash, price, current_size, isbuy, percent, max_positions):
+    """Размер сделки, повторяет PositionAwareSizer._getsizing."""
+    if price == 0:
+        return 0
+    desired_size = (cash * percent / 100) / price
+    available_size = max_positions - current_size if isbuy else max_positions + current_size
+    size = min(desired_size, available_size)
+    return math.floor(size) if math.floor(size) > 0 else 1 if available_size > 0 else 0
+
+
+def _update_position(pos_size, pos_price, size, price):
+    """Обновление позиции, повторяет bt.Position.update; возвращает размер, цену, opened и closed."""
+    oldsize = pos_size
+    pos_size += size
+    if not pos_size:
+        return pos_size, 0.0, 0, size
+    if not oldsize:
+        return pos_size, price, size, 0
+    if (oldsize > 0) == (size > 0):
+        return pos_size, (pos_price * oldsize + size * price) / pos_size, size, 0
+    if (oldsize > 0) == (pos_size > 0):
+        return pos_size, pos_price, 0, size
+    return pos_size, price, pos_size, -oldsize
+
+
+class _Order:
+    """Ордер брекет-заявки: рыночный (родительский), стоп или лимит."""
+    __slots__ = ('exectype', 'size', 'price', 'active', 'bracket', 'fill_bar')
+
+    MARKET, STOP, LIMIT = range(3)
+
+    def __init__(self, exectype, size, price, active, bracket):
+        self.exectype = exectype
+        self.size = size
+        self.price = price
+        self.active = active
+        self.bracket = bracket
+        self.fill_bar = None  # Первый бар, на котором активный ордер может исполниться
+
+
+class _Broker:
+    """Упрощенная модель bt.brokers.BackBroker для акций (stocklike, shortcash, без проскальзывания)."""
+
+    def __init__(self, cash, commission):
+        self.cash = cash
+        self.commission = commission
+        self.pos_size = 0
+        self.pos_price = 0.0
+        self.pending = []
+        self.submitted = []
+        self.to_activate = []
+        # Текущая сделка (bt.Trade) и счетчики закрытых сделок
+        self.trade_size = 0
+        self.trade_price = 0.0
+        self.trade_pnl = 0.0
+        self.trade_comm = 0.0
+        self.total_trades = 0
+        self.profitable_trades = 0
+
+    def submit_bracket(self, size, price, stopprice, limitprice):
+        """Отправка брекет-заявки: рыночный ордер со связанными стоп- и лимит-ордерами."""
+        bracket = []
+        bracket.append(_Order(_Order.MARKET, size, price, True, bracket))
+        bracket.append(_Order(_Order.STOP, -size, stopprice, False, bracket))
+        bracket.append(_Order(_Order.LIMIT, -size, limitprice, False, bracket))
+        self.submitted.append(bracket)
+
+    def _check_submitted(self):
+        """Проверка достаточности средств псевдо-исполнением по цене создания ордеров."""
+        for bracket in self.submitted:
+            cash = self.cash
+            pos_size, pos_price = self.pos_size, self.pos_price
+            accepted = True
+            for order in bracket:
+                pos_size, pos_price, opened, closed = _update_position(pos_size, pos_price,
+                                                                       order.size, order.price)
+                if closed:
+                    cash += -closed * order.price
+                    cash -= abs(closed) * self.commission * order.price
+                if opened:
+                    cash -= opened * order.price
+                    cash -= abs(opened) * self.commission * order.price
+                if cash < 0.0:
+                    accepted = False
+                    break
+            if accepted:
+                self.pending.extend(bracket)
+        self.submitted = []
+
+    def _execute(self, order, price):
+        """Исполнение ордера по цене price; False, если не хватило средств на открытие позиции."""
+        size = order.size
+        pprice_orig = self.pos_price
+        _, _, opened, closed = _update_position(self.pos_size, self.pos_price, size, price)
+        cash = self.cash
+        comm = 0.0
+        if closed:
+            pnl = -closed * (price - pprice_orig) * 1.0
+            cash += -closed * pprice_orig + pnl
+            closedcomm = abs(closed) * self.commission * price
+            cash -= closedcomm
+            self.cash = cash
+            self._update_trade(closed, price, closedcomm)
+        popened = opened
+        if opened:
+            cash -= opened * price
+            openedcomm = abs(opened) * self.commission * price
+            cash -= openedcomm
+            if cash < 0.0:
+                opened = 0
+            else:
+                self.cash = cash
+                comm = openedcomm
+        execsize = closed + opened
+        if execsize:
+            self.pos_size, self.pos_price, _, _ = _update_position(self.pos_size, self.pos_price,
+                                                                   execsize, price)
+        if opened:
+            self._update_trade(opened, price, comm)
+        return not (popened and not opened)
+
+    def _update_trade(self, size, price, commission):
+        """Учет сделки, как в bt.Trade.update; закрытые сделки попадают в счетчики."""
+        self.trade_comm += commission
+        oldsize = self.trade_size
+        self.trade_size += size
+        if abs(self.trade_size) > abs(oldsize):
+            self.trade_price = (oldsize * self.trade_price + size * price) / self.trade_size
+        else:
+            self.trade_pnl += -size * (price - self.trade_price) * 1.0
+        if oldsize and not self.trade_size:
+            self.total_trades += 1
+            if self.trade_pnl - self.trade_comm > 0:
+                self.profitable_trades += 1
+            self.trade_price = self.trade_pnl = self.trade_comm = 0.0
+
+    def _cancel_bracket(self, bracket):
+        for order in bracket:
+            if order in self.pending:
+                self.pending.remove(order)
+        bracket.clear()
+
+    def value(self, pclose):
+        """Стоимость портфеля с тем же порядком операций, что и в BackBroker._get_value."""
+        dvalue = self.pos_size * pclose
+        if dvalue > 0:
+            unrealized = self.pos_size * (pclose - self.pos_price) * 1.0
+            return self.cash + ((dvalue - unrealized) / 1.0 + unrealized)
+        return self.cash + dvalue
+
+    def next(self, popen, phigh, plow):
+        """Обработка ордеров на очередном баре (BackBroker.next)."""
+        for order in self.to_activate:
+            order.active = True
+        self.to_activate = []
+
+        if self.submitted:
+            self._check_submitted()
+
+        for order in list(self.pending):
+            if order not in self.pending or not order.active:
+                continue
+
+            price = None
+            if order.exectype == _Order.MARKET:
+                price = popen
+            elif order.exectype == _Order.STOP:
+                if order.size > 0:
+                    if popen >= order.price:
+                        price = popen
+                    elif phigh >= order.price:
+                        price = order.price
+                else:
+                    if popen <= order.price:
+                        price = popen
+                    elif plow <= order.price:
+                        price = order.price
+            else:
+                if order.size > 0:
+                    if order.price >= popen:
+                        price = popen
+                    elif order.price >= plow:
+                        price = order.price
+                else:
+                    if order.price <= popen:
+                        price = popen
+                    elif order.price <= phigh:
+                        price = order.price
+            if price is None:
+                continue
+
+            self.pending.remove(order)
+            if not self._execute(order, price):
+                self._cancel_bracket(order.bracket)
+            elif order.exectype == _Order.MARKET:
+                # Родительский ордер исполнен - стоп и тейк активируются со следующего бара
+                order.bracket.remove(order)
+                self.to_activate.extend(order.bracket)
+            else:
+                # Исполнен стоп или тейк - второй связанный ордер отменяется
+                self._cancel_bracket(order.bracket)
+
+
+def _first_index(values, start, price, compare):
+    """Первый номер бара >= start, для которого compare(values, price) истинно (len(values), если нет).
+
+    Ряд просматривается участками растущей длины: исполнение обычно близко."""
+    n = len(values)
+    step = FILL_SEARCH_CHUNK
+    while start < n:
+        mask = compare(values[start:start + step], price)
+        idx = int(mask.argmax())
+        if mask[idx]:
+            return start + idx
+        start += step
+        step *= 4
+    return n
+
+
+def _fill_bar(order, start, fill_lows, fill_highs):
+    """Первый бар >= start, на котором активный стоп- или лимит-ордер исполнится (см. _Broker.next).
+
+    Стоп на покупку и лимит на продажу срабатывают, когда max(open, high) >= цены ордера,
+    стоп на продажу и лимит на покупку - когда min(open, low) <= цены ордера."""
+    if (order.exectype == _Order.STOP) == (order.size > 0):
+        return _first_index(fill_highs, start, order.price, np.greater_equal)
+    return _first_index(fill_lows, start, order.price, np.less_equal)
+
+
+def _signal_bars(store, params, start):
+    """Номера баров не раньше start, на которых выполнено не меньше двух условий покупки и продажи."""
+    (fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+     stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold) = params
+    closes = store.closes
+    fast = store.get('ema', fast_ema_period)
+    slow = store.get('ema', slow_ema_period)
+    perck = store.get('stoch_k', stoch_period)
+    macd_line, signal_line = store.get('macd')
+    rsi_line = store.get('rsi', rsi_period)
+
+    with np.errstate(invalid='ignore'):
+        buy_signals = ((closes > fast) & (fast > slow)).astype(np.int8) \
+            + (perck < stoch_oversold) + (macd_line > signal_line) + (rsi_line < rsi_oversold)
+        sell_signals = ((closes < fast) & (fast < slow)).astype(np.int8) \
+            + (perck > stoch_overbought) + (macd_line < signal_line) + (rsi_line > rsi_overbought)
+    return (np.flatnonzero(buy_signals[start:] >= 2) + start,
+            np.flatnonzero(sell_signals[start:] >= 2) + start)
+
+
+def _segment_values(broker, closes):
+    """Стоимость портфеля на закрытии баров, пока позиция не меняется (как _Broker.value)."""
+    dvalue = broker.pos_size * closes
+    unrealized = broker.pos_size * (closes - broker.pos_price) * 1.0
+    return np.where(dvalue > 0, broker.cash + ((dvalue - unrealized) / 1.0 + unrealized), broker.cash + dvalue)
+
+
+def submit_orders(broker, price, is_buy, is_sell, r1, s1, percent, max_positions, risk_reward_ratio):
+    """Реакция стратегии на сигналы бара (EMAStochMACDRSI.next): отправка брекет-заявки
+    со стопом и тейком от уровней Pivot Points. Возвращает размер заявки (0, если ее нет)."""
+    pos_size = broker.pos_size
+    if is_buy and pos_size >= 0 and pos_size < max_positions:
+        stop_loss = s1 if s1 != 0 else price * 0.95
+        take_profit = price + risk_reward_ratio * (price - stop_loss)
+        if stop_loss >= price or take_profit <= price:
+            stop_loss = price * 0.95
+            take_profit = price * 1.1
+        size = _position_size(broker.cash, price, pos_size, True, percent, max_positions)
+        if size > 0:
+            broker.submit_bracket(size, price, stop_loss, take_profit)
+            return size
+
+    elif is_sell and pos_size <= 0 and -pos_size < max_positions:
+        stop_loss = r1 if r1 != 0 else price * 1.05
+        take_profit = price - risk_reward_ratio * (stop_loss - price)
+        if stop_loss <= price or take_profit >= price:
+            stop_loss = price * 1.05
+            take_profit = price * 0.9
+        size = _position_size(broker.cash, price, pos_size, False, percent, max_positions)
+        if size > 0:
+            broker.submit_bracket(-size, price, stop_loss, take_profit)
+            return -size
+    return 0
+
+
+def _simulate(store, start, buy_bars, sell_bars, cash, commission, percent, max_positions, pivot_period,
+              risk_reward_ratio, prune):
+    """Исполнение сигналов стратегии брокером; возвращает стоимость портфеля, количество сделок
+    и количество прибыльных сделок.
+
+    Моделируются только бары-события: бар после отправки заявки или исполнения родительского
+    ордера, первый бар исполнения активного стоп- или лимит-ордера и бары с сигналами, которые
+    в текущей позиции могут привести к заявке. На остальных барах состояние брокера не меняется,
+    поэтому результат совпадает с пошаговым моделированием."""
+    opens, highs, lows, closes = store.opens, store.highs, store.lows, store.closes
+    fill_lows, fill_highs = store.get('fill_low'), store.get('fill_high')
+    # Уровни Pivot Points по буферу, который стратегия заполняет начиная с первого вызова next()
+    r1, s1 = store.get('pivot', pivot_period)
+    pivot_start = start + pivot_period - 1
+    n = len(closes)
+    broker = _Broker(cash, commission)
+    buy_list, sell_list = buy_bars.tolist(), sell_bars.tolist()
+    buy_count, sell_count = len(buy_list), len(sell_list)
+
+    if prune is not None:
+        checkpoints = sorted(prune_checkpoints(prune, n))
+        floor = 1 - prune.max_drawdown if prune.max_drawdown is not None else None
+        peak = cash
+
+    i = start
+    while i < n:
+        if broker.pending or broker.submitted or broker.to_activate:
+            broker.next(opens.item(i), highs.item(i), lows.item(i))
+
+        # Позиции ближайших сигналов не раньше текущего бара
+        next_buy = bisect_left(buy_list, i)
+        next_sell = bisect_left(sell_list, i)
+        is_buy = next_buy < buy_count and buy_list[next_buy] == i
+        is_sell = next_sell < sell_count and sell_list[next_sell] == i
+
+        if is_buy or is_sell:
+            pivots = (r1.item(i), s1.item(i)) if i >= pivot_start else (0.0, 0.0)
+            submit_orders(broker, closes.item(i), is_buy, is_sell, *pivots, percent, max_positions, risk_reward_ratio)
+
+        # Следующий бар, на котором что-то может измениться
+        if broker.submitted or broker.to_activate:
+            following = i + 1
+        else:
+            following = n
+            for order in broker.pending:
+                if order.active:
+                    if order.fill_bar is None:
+                        order.fill_bar = _fill_bar(order, i + 1, fill_lows, fill_highs)
+                    following = min(following, order.fill_bar)
+            pos_size = broker.pos_size
+            if pos_size >= 0 and pos_size < max_positions:
+                idx = next_buy + is_buy
+                if idx < buy_count:
+                    following = min(following, buy_list[idx])
+            if pos_size <= 0 and -pos_size < max_positions:
+                idx = next_sell + is_sell
+                if idx < sell_count:
+                    following = min(following, sell_list[idx])
+
+        if prune is not None:
+            # Проверка баров [i, following): стоимость портфеля и число сделок на них не меняются
+            # относительно состояния после бара i, кроме переоценки позиции по цене закрытия
+            values = _segment_values(broker, closes[i:following])
+            running_peak = np.maximum.accumulate(np.maximum(values, peak))
+            pruned = following
+            if floor is not None:
+                violated = values < running_peak * floor
+                if violated.any():
+                    pruned = i + int(violated.argmax())
+            if broker.total_trades < prune.min_trades:
+                for checkpoint in checkpoints:
+                    if i <= checkpoint < pruned:
+                        pruned = checkpoint
+                        break
+            if pruned < following:
+                raise BacktestPruned(values.item(pruned - i), pruned)
+            peak = running_peak.item(-1)
+
+        i = following
+
+    return broker.value(closes.item(n - 1)), broker.total_trades, broker.profitable_trades
+
+
+def run_vector_backtest(fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+                        stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold,
+                        data=None, store=None, cash=150000, commission=0.0005, percent=25,
+                        max_positions=10, pivot_period=14, risk_reward_ratio=2.0, prune=None):
+    """Бэктест стратегии EMAStochMACDRSI без backtrader.
+
+    Индикаторы берутся из хранилища store (IndicatorStore), если оно передано, иначе
+    рассчитываются по data. Возвращает итоговую стоимость портфеля, количество сделок
+    и количество прибыльных сделок. Если заданы правила prune (PruneRules) и бэктест
+    их нарушил, выбрасывается BacktestPruned."""
+    if store is None:
+        store = IndicatorStore(data)
+    params = (fast_ema_period, slow_ema_period, stoch_period, rsi_period,
+              stoch_overbought, stoch_oversold, rsi_overbought, rsi_oversold)
+    start = strategy_minperiod(fast_ema_period, slow_ema_period, stoch_period, rsi_period) - 1
+
+    # Сигналы считаются векторно, цикл моделирует только исполнение ордеров
+    buy_bars, sell_bars = _signal_bars(store, params, start)
+    if start >= len(store.closes):
+        return cash, 0, 0
+    return _simulate(store, start, buy_bars, sell_bars, cash, commission, percent, max_positions, pivot_period,
+                     risk_reward_ratio, prune)
+
+
+def _position_sizes(cash, price, current_size, isbuy, percent, max_positions):
+    """_position_size для массивов: размеры сделок (isbuy - покупка или продажа для каждого элемента)."""
+    available_size = np.where(isbuy, max_positions - current_size, max_positions + current_size)
+    desired_size = np.divide(cash * percent / 100, price, out=np.zeros_like(price), where=price != 0)
+    size = np.floor(np.minimum(desired_size, available_size))
+    size = np.where(size > 0, size, np.where(available_size > 0, 1, 0))
+    return np.where(price == 0, 0, size).astype(np.int64)
+
+
+def _first_fill_bars(table, side, start, threshold, n):
+    """Первые бары не раньше start, на которых ряд side таблицы 'fill_search' не меньше threshold
+    (n, если таких нет), для массивов запросов.
+
+    Сначала просматриваются FILL_SEARCH_BLOCK баров от start; следующий блок начинается внутри
+    просмотренного участка, поэтому дальше по разреженной таблице максимумов блоков находится
+    первый блок с подходящим баром и просматривается он."""
+    values, levels = table
+    values_row = values.shape[1]
+    levels_row = levels.shape[2]
+    nblocks = values_row // FILL_SEARCH_BLOCK - 1
+    values = values.ravel()
+    levels = levels.reshape(len(levels), -1)
+    offsets = np.arange(FILL_SEARCH_BLOCK)
+    hits = values[(side * values_row + start)[:, None] + offsets] >= threshold[:, None]
+    result = start + hits.argmax(axis=1)
+    missed = np.flatnonzero(~hits.any(axis=1))
+    if len(missed):
+        side, threshold = side[missed], threshold[missed]
+        # Номер блока в строке разреженной таблицы ряда side
+        position = side * levels_row + start[missed] // FILL_SEARCH_BLOCK + 1
+        for level in range(len(levels) - 1, -1, -1):
+            # Блоки [block, block + 2**level) пропускаются, если в них нет подходящего бара
+            position += (levels[level, position] < threshold).astype(np.int64) << level
+        block = np.minimum(position - side * levels_row, nblocks)
+        hits = values[(side * values_row + block * FILL_SEARCH_BLOCK)[:, None] + offsets] >= threshold[:, None]
+        result[missed] = np.where(hits.any(axis=1), block * FILL_SEARCH_BLOCK + hits.argmax(axis=1), n)
+    return np.minimum(result, n)
+
+
+class _BrokerBatch:
+    """_Broker для многих наборов параметров сразу: счет, позиция и текущая сделка каждого набора
+    хранятся в массивах длины k, методы обрабатывают переданные номера наборов rows с теми же
+    операциями над числами и в том же порядке, что и _Broker, поэтому результаты совпадают побитово.
+
+    Брекет-заявки с исполненным родительским ордером занимают слоты матриц k x slots в порядке
+    отправки (размер 0 - свободный слот); стоп и тейк слота исполняются на баре fill_bar.
+    Покупка отправляется только без короткой позиции, продажа - без длинной, поэтому позиция всегда
+    равна сумме размеров таких брекетов: рыночный ордер только открывает или увеличивает позицию,
+    стоп и тейк только уменьшают ее, а размер текущей сделки (bt.Trade) равен размеру позиции."""
+
+    def __init__(self, k, cash, commission, slots, n):
+        self.commission = commission
+        self.n = n
+        self.cash = np.full(k, float(cash))
+        self.pos_size = np.zeros(k, dtype=np.int64)
+        self.pos_price = np.zeros(k)
+        self.trade_price = np.zeros(k)
+        self.trade_pnl = np.zeros(k)
+        self.trade_comm = np.zeros(k)
+        self.total_trades = np.zeros(k, dtype=np.int64)
+        self.profitable_trades = np.zeros(k, dtype=np.int64)
+        # Заявка, отправленная на текущем баре: размер (0 - нет заявки), цена, стоп и тейк
+        self.submitted = np.zeros(k, dtype=np.int64)
+        self.submitted_price = np.zeros(k)
+        self.submitted_stop = np.zeros(k)
+        self.submitted_limit = np.zeros(k)
+        # Слоты брекетов, число слотов, занятых с последнего уплотнения, и ближайший бар исполнения
+        self.size = np.zeros((k, slots), dtype=np.int64)
+        self.stop = np.zeros((k, slots))
+        self.limit = np.zeros((k, slots))
+        self.fill_bar = np.full((k, slots), n)
+        self.used = np.zeros(k, dtype=np.int64)
+        self.next_fill_bar = np.full(k, n)
+
+    def submit(self, rows, is_buy, is_sell, price, r1, s1, percent, max_positions, risk_reward_ratio):
+        """submit_orders для наборов rows с сигналами на текущих барах."""
+        pos_size = self.pos_size[rows]
+        buy = is_buy & (pos_size >= 0) & (pos_size < max_positions)
+        sell = ~buy & is_sell & (pos_size <= 0) & (-pos_size < max_positions)
+        buy_stop = np.where(s1 != 0, s1, price * 0.95)
+        buy_take = price + risk_reward_ratio * (price - buy_stop)
+        invalid = (buy_stop >= price) | (buy_take <= price)
+        buy_stop = np.where(invalid, price * 0.95, buy_stop)
+        buy_take = np.where(invalid, price * 1.1, buy_take)
+        sell_stop = np.where(r1 != 0, r1, price * 1.05)
+        sell_take = price - risk_reward_ratio * (sell_stop - price)
+        invalid = (sell_stop <= price) | (sell_take >= price)
+        sell_stop = np.where(invalid, price * 1.05, sell_stop)
+        sell_take = np.where(invalid, price * 0.9, sell_take)
+        size = _position_sizes(self.cash[rows], price, pos_size, buy, percent, max_positions)
+        self.submitted[rows] = np.where(buy, size, np.where(sell, -size, 0))
+        self.submitted_price[rows] = price
+        self.submitted_stop[rows] = np.where(buy, buy_stop, sell_stop)
+        self.submitted_limit[rows] = np.where(buy, buy_take, sell_take)
+
+    def check_submitted(self, rows):
+        """_check_submitted для заявок наборов rows; возвращает маску принятых заявок."""
+        size, pos_size, commission = self.submitted[rows], self.pos_size[rows], self.commission
+        price, stop, limit = self.submitted_price[rows], self.submitted_stop[rows], self.submitted_limit[rows]
+        # Рыночный ордер открывает позицию или добавляет к ней, стоп закрывает добавленное
+        cash = self.cash[rows] - size * price - abs(size) * commission * price
+        accepted = ~(cash < 0.0)
+        cash = cash + size * stop - abs(size) * commission * stop
+        accepted &= ~(cash < 0.0)
+        # Тейк закрывает добавленное (без позиции - открывает встречную), а если позиция до заявки
+        # была меньше заявки - закрывает ее и открывает встречную на разницу
+        reverse = (pos_size != 0) & (abs(pos_size) < abs(size))
+        closed = np.where(reverse, pos_size, size)
+        cash = cash + closed * limit - abs(closed) * commission * limit
+        opened = pos_size - size
+        cash = np.where(reverse, cash - opened * limit - abs(opened) * commission * limit, cash)
+        return accepted & ~(cash < 0.0)
+
+    def open_brackets(self, rows, price):
+        """Исполнение рыночных ордеров заявок наборов rows по цене price (_execute); возвращает
+        номера наборов, у которых хватило средств."""
+        size = self.submitted[rows]
+        openedcomm = abs(size) * self.commission * price
+        cash = self.cash[rows] - size * price - openedcomm
+        filled = ~(cash < 0.0)
+        rows, size, price, openedcomm = rows[filled], size[filled], price[filled], openedcomm[filled]
+        self.cash[rows] = cash[filled]
+        pos_size = self.pos_size[rows]
+        new_size = pos_size + size
+        self.pos_price[rows] = np.where(pos_size == 0, price, (self.pos_price[rows] * pos_size + size * price) / new_size)
+        self.pos_size[rows] = new_size
+        self.trade_comm[rows] += openedcomm
+        self.trade_price[rows] = (pos_size * self.trade_price[rows] + size * price) / new_size
+        return rows
+
+    def close_brackets(self, rows, closed, price):
+        """Исполнение стопов или тейков наборов rows размера closed по цене price (_execute)."""
+        pos_price = self.pos_price[rows]
+        pnl = -closed * (price - pos_price) * 1.0
+        closedcomm = abs(closed) * self.commission * price
+        self.cash[rows] = self.cash[rows] + (-closed * pos_price + pnl) - closedcomm
+        self.trade_comm[rows] += closedcomm
+        self.trade_pnl[rows] += -closed * (price - self.trade_price[rows]) * 1.0
+        pos_size = self.pos_size[rows] + closed
+        self.pos_size[rows] = pos_size
+        flat = rows[pos_size == 0]
+        if len(flat):
+            # Позиция закрыта - сделка учитывается в счетчиках
+            self.pos_price[flat] = 0.0
+            self.total_trades[flat] += 1
+            self.profitable_trades[flat] += self.trade_pnl[flat] - self.trade_comm[flat] > 0
+            self.trade_price[flat] = 0.0
+            self.trade_pnl[flat] = 0.0
+            self.trade_comm[flat] = 0.0
+
+    def fill_brackets(self, rows, bars, opens, highs, lows):
+        """Исполнение стопов и тейков наборов rows, бар исполнения которых совпадает с текущим баром,
+        в порядке отправки брекетов; второй ордер брекета отменяется."""
+        due_rows = self.next_fill_bar[rows] == bars
+        rows, bars = rows[due_rows], bars[due_rows]
+        if not len(rows):
+            return
+        used = self.used[rows].max()
+        popen, phigh, plow = opens[bars], highs[bars], lows[bars]
+        due = (self.size[rows, :used] != 0) & (self.fill_bar[rows, :used] == bars[:, None])
+        for slot in np.flatnonzero(due.any(axis=0)).tolist():
+            slot_rows = due[:, slot]
+            slot_open, slot_high, slot_low = popen[slot_rows], phigh[slot_rows], plow[slot_rows]
+            filled = rows[slot_rows]
+            size, stop, limit = self.size[filled, slot], self.stop[filled, slot], self.limit[filled, slot]
+            long = size > 0
+            # Стоп проверяется раньше тейка (порядок ордеров брекета в _Broker.pending)
+            stop_hit = np.where(long, (slot_open <= stop) | (slot_low <= stop),
+                                (slot_open >= stop) | (slot_high >= stop))
+            stop_price = np.where((slot_open <= stop) == long, slot_open, stop)
+            limit_price = np.where((limit <= slot_open) == long, slot_open, limit)
+            self.close_brackets(filled, -size, np.where(stop_hit, stop_price, limit_price))
+            self.size[filled, slot] = 0
+        size = self.size[rows]
+        self.next_fill_bar[rows] = np.where(size != 0, self.fill_bar[rows], self.n).min(axis=1)
+        self.used[rows[~(size != 0).any(axis=1)]] = 0
+
+    def add_brackets(self, rows, bars, table):
+        """Брекеты заявок наборов rows, рыночный ордер которых исполнен на текущем баре, занимают слоты;
+        бар исполнения стопа или тейка ищется начиная со следующего бара."""
+        full = rows[self.used[rows] == self.size.shape[1]]
+        if len(full):
+            # Уплотнение слотов с сохранением порядка отправки
+            order = np.argsort(self.size[full] == 0, axis=1, kind='stable')
+            for slots in (self.size, self.stop, self.limit, self.fill_bar):
+                slots[full] = np.take_along_axis(slots[full], order, axis=1)
+            self.used[full] = (self.size[full] != 0).sum(axis=1)
+        slot = self.used[rows]
+        size, stop, limit = self.submitted[rows], self.submitted_stop[rows], self.submitted_limit[rows]
+        self.size[rows, slot] = size
+        self.stop[rows, slot] = stop
+        self.limit[rows, slot] = limit
+        self.used[rows] += 1
+        # Ряд 0 таблицы - max(open, high), ряд 1 - -min(open, low)
+        long = size > 0
+        side = np.concatenate([long, ~long]).astype(np.int64)
+        threshold = np.concatenate([np.where(long, -stop, stop), np.where(long, limit, -limit)])
+        fill_bars = _first_fill_bars(table, side, np.tile(bars + 1, 2), threshold, self.n)
+        fill_bar = np.minimum(fill_bars[:len(rows)], fill_bars[len(rows):])
+        self.fill_bar[rows, slot] = fill_bar
+        self.next_fill_bar[rows] = np.minimum(self.next_fill_bar[rows], fill_bar)
+
+    def value(self, closes):
+        """Стоимость портфелей по ценам closes (как _Broker.value)."""
+        dvalue = self.pos_size * closes
+        unrealized = self.pos_size * (closes - self.pos_price) * 1.0
+        return np.where(dvalue > 0, self.cash + ((dvalue - unrealized) / 1.0 + unrealized), self.cash + dvalue)
+
+
+def _simulate_batch(store, starts, buy_keys, sell_keys, cash, commission, percent, max_positions, pivot_period,
+                    risk_reward_ratio, prune):
+    """Исполнение сигналов стратегии для k наборов параметров одним проходом по барам; возвращает
+    массив k x 4 как run_vector_backtest_batch.
+
+    Каждый набор переходит по своим барам-событиям (как в _simulate), но все наборы продвигаются
+    вместе: одна итерация обрабатывает очередное событие каждого набора операциями над массивами.
+    Сигналы набора r - ключи r * (n + 1) + номер бара в отсортированных массивах buy_keys и sell_keys,
+    которые завершаются ключом больше всех остальных."""
+    opens, highs, lows, closes = store.opens, store.highs, store.lows, store.closes
+    r1_levels, s1_levels = store.get('pivot', pivot_period)
+    table = store.get('fill_search')
+    n = len(closes)
+    k = len(starts)
+    broker = _BrokerBatch(k, cash, commission, 2 * max_positions, n)
+    base = np.arange(k) * (n + 1)
+    pivot_starts = starts + pivot_period - 1
+    results = np.zeros((k, 4))
+
+    if prune is not None:
+        checkpoints = np.array(sorted(prune_checkpoints(prune, n)) + [n])
+        floor = 1 - prune.max_drawdown if prune.max_drawdown is not None else None
+        peak = np.full(k, float(cash))
+        segment = np.arange(PRUNE_SEGMENT)
+
+    bars = starts.copy()
+    rows = np.arange(k)
+    while len(rows):
+        current = bars[rows]
+
+        # Ордера (_Broker.next): проверка средств по новым заявкам, стопы и тейки, рыночные ордера
+        pending = rows[broker.submitted[rows] != 0]
+        if len(pending):
+            accepted = pending[broker.check_submitted(pending)]
+        broker.fill_brackets(rows, current, opens, highs, lows)
+        if len(pending):
+            if len(accepted):
+                filled = broker.open_brackets(accepted, opens[bars[accepted]])
+                broker.add_brackets(filled, bars[filled], table)
+            broker.submitted[pending] = 0
+
+        # Сигналы стратегии на текущих барах
+        keys = base[rows] + current
+        buy_idx = np.searchsorted(buy_keys, keys)
+        sell_idx = np.searchsorted(sell_keys, keys)
+        is_buy = buy_keys[buy_idx] == keys
+        is_sell = sell_keys[sell_idx] == keys
+        signal = is_buy | is_sell
+        if signal.any():
+            signal_bars = current[signal]
+            pivot = signal_bars >= pivot_starts[rows[signal]]
+            broker.submit(rows[signal], is_buy[signal], is_sell[signal], closes[signal_bars],
+                          np.where(pivot, r1_levels[signal_bars], 0.0), np.where(pivot, s1_levels[signal_bars], 0.0),
+                          percent, max_positions, risk_reward_ratio)
+
+        # Следующий бар, на котором что-то может измениться
+        following = np.where(broker.submitted[rows] != 0, current + 1, broker.next_fill_bar[rows])
+        pos_size = broker.pos_size[rows]
+        next_buy = buy_keys[buy_idx + is_buy] - keys + current
+        next_sell = sell_keys[sell_idx + is_sell] - keys + current
+        following = np.where((pos_size >= 0) & (pos_size < max_positions), np.minimum(following, next_buy), following)
+        following = np.where((pos_size <= 0) & (-pos_size < max_positions), np.minimum(following, next_sell), following)
+        following = np.minimum(following, n)
+
+        if prune is not None:
+            # Проверка баров [current, following) как в _simulate; длинные участки проверяются по частям
+            following = np.minimum(following, current + PRUNE_SEGMENT)
+            length = following - current
+            idx = np.minimum(current[:, None] + segment[:length.max()], n - 1)
+            valid = segment[:length.max()] < length[:, None]
+            segment_closes = closes[idx]
+            pos_size, pos_price, account = pos_size[:, None], broker.pos_price[rows, None], broker.cash[rows, None]
+            dvalue = pos_size * segment_closes
+            unrealized = pos_size * (segment_closes - pos_price) * 1.0
+            values = np.where(dvalue > 0, account + ((dvalue - unrealized) / 1.0 + unrealized), account + dvalue)
+            running_peak = np.maximum.accumulate(np.maximum(np.where(valid, values, -np.inf), peak[rows, None]),
+                                                 axis=1)
+            pruned = following
+            if floor is not None:
+                violated = valid & (values < running_peak * floor)
+                pruned = np.where(violated.any(axis=1), current + violated.argmax(axis=1), pruned)
+            checkpoint = checkpoints[np.searchsorted(checkpoints, current)]
+            pruned = np.where((broker.total_trades[rows] < prune.min_trades) & (checkpoint < pruned),
+                              checkpoint, pruned)
+            stopped = np.flatnonzero(pruned < following)
+            if len(stopped):
+                results[rows[stopped], 0] = values[stopped, pruned[stopped] - current[stopped]]
+                results[rows[stopped], 3] = BATCH_PRUNED
+                following[stopped] = n
+            peak[rows] = running_peak[np.arange(len(rows)), length - 1]
+
+        bars[rows] = following
+        rows = rows[following < n]
+
+    finished = results[:, 3] != BATCH_PRUNED
+    results[finished, 0] = broker.value(closes[n - 1])[finished]
+    results[finished, 1] = broker.total_trades[finished]
+    results[finished, 2] = broker.profitable_trades[finished]
+    return results
+
+
+def run_vector_backtest_batch(params, data=None, store=None, cash=150000, commission=0.0005, percent=25,
+                              max_positions=10, pivot_period=14, risk_reward_ratio=2.0, prune=None):
+    """Бэктест многих наборов параметров (матрица k x 8, например поколение ГА или сетка) за один проход по барам.
+
+    Ряды индикаторов, общие для наборов с одинаковыми периодами, рассчитываются один раз, сигналы
+    каждого набора - векторно, а состояние брокеров всех наборов хранится в массивах и обновляется
+    вместе (_simulate_batch). Результаты совпадают с run_vector_backtest для каждого набора.
+    Возвращает массив k x 4: итоговая стоимость портфеля, количество сделок, количество прибыльных
+    сделок и код состояния (BATCH_OK, BATCH_ZERO_DIVISION или BATCH_PRUNED; у остановленного
+    прогона - стоимость портфеля на баре остановки)."""
+    if store is None:
+        store = IndicatorStore(data)
+    params = np.asarray(params, dtype=np.int64).reshape(-1, 8)
+    n = len(store.closes)
+    results = np.zeros((len(params), 4))
+    rows, starts, buy_keys, sell_keys = [], [], [], []
+    for row, values in enumerate(params.tolist()):
+        start = strategy_minperiod(*values[:4]) - 1
+        try:
+            buy_bars, sell_bars = _signal_bars(store, values, start)
+        except ZeroDivisionError:
+            results[row] = np.nan, 0, 0, BATCH_ZERO_DIVISION
+            continue
+        if start >= n:
+            results[row] = cash, 0, 0, BATCH_OK
+            continue
+        offset = len(rows) * (n + 1)
+        buy_keys.append(buy_bars + offset)
+        sell_keys.append(sell_bars + offset)
+        rows.append(row)
+        starts.append(start)
+    if rows:
+        sentinel = [np.array([len(rows) * (n + 1)])]
+        results[rows] = _simulate_batch(store, np.array(starts), np.concatenate(buy_keys + sentinel),
+                                        np.concatenate(sell_keys + sentinel), cash, commission, percent,
+                                        max_positions, pivot_period, risk_reward_ratio, prune)
+    return results
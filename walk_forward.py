@@ -0,0 +1,142 @@
+# walk_forward.py
+# Walk-forward оптимизация: история баров делится на скользящие окна "обучение/проверка",
+# на каждом обучающем окне запускается генетический алгоритм, а лучший набор параметров
+# проверяется на следующем за ним окне, которого оптимизатор не видел.
+# Фолды выполняются параллельно; бары открываются каждым процессом из общего хранилища
+# np.memmap, а окна - это срезы без копирования данных.
+import argparse
+import multiprocessing
+import pandas as pd
+from backtest import run_backtest
+from database import DEFAULT_SYMBOL, DEFAULT_TIMEFRAME, load_bars, refresh_bar_store
+from ga_optimization import run_ga_optimization
+
+# Бары текущего процесса-фолда и параметры оптимизации, задаваемые при старте процесса
+_fold_data = None
+_fold_options = None
+
+
+def date_range_bounds(dates, start=None, end=None):
+    """Номера первого и следующего за последним бара в диапазоне дат [start, end]."""
+    first = dates.searchsorted(pd.Timestamp(start), side='left') if start is not None else 0
+    last = dates.searchsorted(pd.Timestamp(end), side='right') if end is not None else len(dates)
+    return int(first), int(last)
+
+
+def walk_forward_windows(first, last, train_bars, test_bars, step=None):
+    """Окна фолдов в номерах баров: список ((начало, конец) обучения, (начало, конец) проверки).
+
+    step - сдвиг между фолдами (по умолчанию test_bars, проверочные окна идут встык)."""
+    step = test_bars if step is None else step
+    windows = []
+    train_start = first
+    while train_start + train_bars + test_bars <= last:
+        train_end = train_start + train_bars
+        windows.append(((train_start, train_end), (train_end, train_end + test_bars)))
+        train_start += step
+    return windows
+
+
+def _init_fold(bar_store, symbol, timeframe, options):
+    global _fold_data, _fold_options
+    _fold_data = load_bars(bar_store, symbol, timeframe)
+    _fold_options = options
+
+
+def _run_fold(args):
+    """Оптимизация на обучающем окне и проверка лучшего набора на следующем окне."""
+    fold, (train_start, train_end), (test_start, test_end) = args
+    options = dict(_fold_options)
+    seed = options.pop('seed')
+    engine = options['engine']
+    train = _fold_data.iloc[train_start:train_end]
+    test = _fold_data.iloc[test_start:test_end]
+
+    best = run_ga_optimization(data=train, seed=seed + fold if seed is not None else None, **options)
+    params = tuple(best)
+    train_profit, train_pct = run_backtest(*params, data=train, engine=engine)
+    test_profit, test_pct = run_backtest(*params, data=test, engine=engine)
+    return {
+        'fold': fold,
+        'train_start': str(train['date'].iloc[0]), 'train_end': str(train['date'].iloc[-1]),
+        'test_start': str(test['date'].iloc[0]), 'test_end': str(test['date'].iloc[-1]),
+        'params': params,
+        'train_profit': train_profit, 'train_profitable_pct': train_pct,
+        'test_profit': test_profit, 'test_profitable_pct': test_pct,
+    }
+
+
+def aggregate_folds(folds, train_bars, test_bars):
+    """Сводные метрики по проверочным окнам всех фолдов."""
+    test_profit = sum(fold['test_profit'] for fold in folds)
+    train_profit = sum(fold['train_profit'] for fold in folds)
+    return {
+        'folds': len(folds),
+        'test_profit': test_profit,
+        'test_profit_mean': test_profit / len(folds),
+        'test_profitable_pct_mean': sum(fold['test_profitable_pct'] for fold in folds) / len(folds),
+        'profitable_folds_pct': sum(fold['test_profit'] > 0 for fold in folds) / len(folds) * 100,
+        # Эффективность walk-forward: доходность на бар вне выборки относительно доходности на бар при обучении
+        'efficiency': (test_profit / test_bars) / (train_profit / train_bars) if train_profit > 0 else None,
+    }
+
+
+def run_walk_forward(train_bars, test_bars, step=None, start=None, end=None, workers=None, seed=None,
+                     engine='numpy', bar_store=None, symbol=DEFAULT_SYMBOL, timeframe=DEFAULT_TIMEFRAME,
+                     **ga_options):
+    """Walk-forward оптимизация на барах инструмента в диапазоне дат [start, end].
+
+    train_bars, test_bars - длина обучающего и проверочного окон в барах, step - сдвиг между фолдами.
+    workers - количество фолдов, выполняемых параллельно (None или 1 - последовательно);
+    генетический алгоритм внутри фолда всегда выполняется в процессе фолда.
+    Результаты фолдов записываются в ga_runs из процессов фолдов; одновременные записи
+    ждут друг друга (SQLITE_BUSY_TIMEOUT_MS).
+    Остальные аргументы (population_size, ngen, prune, ...) передаются в run_ga_optimization.
+    Возвращает словарь с метриками по фолдам ('folds') и сводными метриками ('aggregate')."""
+    if bar_store is None:
+        bar_store = refresh_bar_store(symbol=symbol, timeframe=timeframe)
+    data = load_bars(bar_store)
+    first, last = date_range_bounds(data['date'], start, end)
+    windows = walk_forward_windows(first, last, train_bars, test_bars, step)
+    if not windows:
+        raise ValueError('Недостаточно баров для одного фолда walk-forward')
+
+    # Параллельны фолды, а не бэктесты внутри фолда: пул воркеров run_ga_optimization
+    # не создается из процессов пула фолдов, поэтому каждый фолд оптимизируется последовательно
+    options = dict(ga_options, seed=seed, engine=engine, symbol=symbol, timeframe=timeframe, workers=None)
+    tasks = [(fold, train, test) for fold, (train, test) in enumerate(windows)]
+    if workers is not None and workers > 1:
+        with multiprocessing.Pool(processes=min(workers, len(tasks)), initializer=_init_fold,
+                                  initargs=(bar_store, symbol, timeframe, options)) as pool:
+            folds = pool.map(_run_fold, tasks, chunksize=1)
+    else:
+        _init_fold(bar_store, symbol, timeframe, options)
+        folds = [_run_fold(task) for task in tasks]
+
+    aggregate = aggregate_folds(folds, train_bars, test_bars)
+    for fold in folds:
+        print(f'Фолд {fold["fold"]}: обучение {fold["train_start"]} - {fold["train_end"]}, '
+              f'проверка {fold["test_start"]} - {fold["test_end"]}, параметры {fold["params"]}, '
+              f'доходность {fold["train_profit"]:.2f} / {fold["test_profit"]:.2f}, '
+              f'прибыльных сделок {fold["train_profitable_pct"]:.1f}% / {fold["test_profitable_pct"]:.1f}%')
+    print(f'Итого вне выборки: доходность {aggregate["test_profit"]:.2f}, '
+          f'прибыльных фолдов {aggregate["profitable_folds_pct"]:.1f}%, '
+          f'эффективность {aggregate["efficiency"]}')
+    return {'folds': folds, 'aggregate': aggregate}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward оптимизация параметров стратегии')
+    parser.add_argument('--train', type=int, required=True, help='длина обучающего окна в барах')
+    parser.add_argument('--test', type=int, required=True, help='длина проверочного окна в барах')
+    parser.add_argument('--step', type=int, default=None, help='сдвиг между фолдами в барах')
+    parser.add_argument('--start', default=None, help='начальная дата диапазона')
+    parser.add_argument('--end', default=None, help='конечная дата диапазона')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='параллельных фолдов')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--symbol', default=DEFAULT_SYMBOL)
+    parser.add_argument('--timeframe', default=DEFAULT_TIMEFRAME)
+    args = parser.parse_args()
+
+    run_walk_forward(args.train, args.test, step=args.step, start=args.start, end=args.end,
+                     workers=args.workers, seed=args.seed, symbol=args.symbol, timeframe=args.timeframe)